@@ -0,0 +1,164 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import numpy as np
+import time
+
+from datetime import datetime, timedelta
+from django.db.models import Sum
+from monitor.analysis import energy_data, energy_steps
+from monitor.models import Rollup
+from monitor.rollup import bucket_start, rollups_enabled
+from monitor.segments import station_reading_data
+from monitor.states import state_array, station_states
+from monitor.util import get_station_readings
+
+# Calendar resolutions of aggregate buckets
+AGGREGATE_RESOLUTIONS = ('hour', 'day', 'week', 'month')
+
+# Microseconds per day
+DAY_MICROS = 86400 * 1000000
+
+# Days from the epoch, a Thursday, to the following Monday, where weeks start
+MONDAY_OFFSET = 4
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+def calendar_starts(times, resolution):
+  """Gets the start of the calendar bucket containing each of the given reading times at the given resolution.
+  Times are int64 microseconds since the epoch as produced by monitor.analysis.columns, which represent the local
+  time of each reading as stored, so buckets follow the wall clock of the site time zone: days start at local
+  midnight and weeks on Monday regardless of daylight saving time."""
+  if resolution == 'hour':
+    return times.astype('datetime64[us]').astype('datetime64[h]').astype('datetime64[us]').astype(np.int64)
+  days = times // DAY_MICROS
+  if resolution == 'day':
+    return days * DAY_MICROS
+  if resolution == 'week':
+    return (days - (days - MONDAY_OFFSET) % 7) * DAY_MICROS
+  return times.astype('datetime64[us]').astype('datetime64[M]').astype('datetime64[us]').astype(np.int64)
+
+
+def calendar_start(timestamp, resolution):
+  """Gets the start of the calendar bucket containing a datetime at the given resolution."""
+  micros = np.array([np.datetime64(timestamp, 'us').astype(np.int64)])
+  return UNIX_EPOCH + timedelta(microseconds=int(calendar_starts(micros, resolution)[0]))
+
+
+def calendar_next(start, resolution):
+  """Gets the start of the calendar bucket following the one starting at the given datetime."""
+  if resolution == 'hour':
+    return start + timedelta(hours=1)
+  elif resolution == 'day':
+    return start + timedelta(days=1)
+  elif resolution == 'week':
+    return start + timedelta(days=7)
+  return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def calendar_count(start, end, resolution, limit):
+  """Counts the calendar buckets from the one starting at the given datetime up to the one containing end,
+  stopping once the count exceeds limit."""
+  count = 0
+  while start <= end and count <= limit:
+    count += 1
+    start = calendar_next(start, resolution)
+  return count
+
+
+def elapsed_hours(start, end):
+  """Gets the hours that actually elapse between two local times of the site time zone, e.g. 23 for the day of
+  the switch to daylight saving time. Relies on the TZ environment variable Django sets from TIME_ZONE."""
+  return (time.mktime(end.timetuple()) - time.mktime(start.timetuple())) / 3600.0
+
+
+def aggregate_readings(data, resolution, percentiles=()):
+  """Aggregates readings into calendar buckets at the given resolution with grouped NumPy reductions.
+  The data is a map of timestamp, watts and watt_hours arrays in chronological order and optionally power_cycle,
+  as accepted by monitor.analysis.energy_steps. The energy of each interval between readings counts towards the
+  bucket of the reading that ends it.
+  Returns a list of maps, one per bucket that holds readings, of start, the bucket start datetime, hours, the
+  real length of the bucket, count, watt_hours, watts_mean, watts_min, watts_max, watts_pN for each N in
+  percentiles and flags, the ENERGY_* quality flags of any interval in the bucket."""
+  data = energy_data(data)
+  times = data['timestamp']
+  if len(times) == 0:
+    return []
+  starts = calendar_starts(times, resolution)
+  first = np.concatenate(([0], np.flatnonzero(np.diff(starts)) + 1))
+  counts = np.diff(np.concatenate((first, [len(times)])))
+  watts = data['watts'].astype(np.int64)
+  (steps, step_flags) = energy_steps(data)
+  energy = np.add.reduceat(np.concatenate(([0.0], steps)), first)
+  flags = np.bitwise_or.reduceat(np.concatenate(([0], step_flags)), first)
+  columns = {
+    'count': counts,
+    'watt_hours': energy,
+    'watts_mean': np.add.reduceat(watts, first) / counts.astype(np.float64),
+    'watts_min': np.minimum.reduceat(watts, first),
+    'watts_max': np.maximum.reduceat(watts, first),
+    'flags': flags,
+  }
+  if len(percentiles) > 0:
+    # Sort watts within each bucket and interpolate linearly between the closest ranks
+    group = np.repeat(np.arange(len(first)), counts)
+    ordered = watts[np.lexsort((watts, group))]
+    for p in percentiles:
+      rank = first + (counts - 1) * (p / 100.0)
+      lower = np.floor(rank).astype(np.int64)
+      upper = np.minimum(lower + 1, first + counts - 1)
+      columns['watts_p%s' % p] = ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+  buckets = []
+  for i in range(len(first)):
+    start = UNIX_EPOCH + timedelta(microseconds=int(starts[first[i]]))
+    bucket = {'start': start, 'hours': elapsed_hours(start, calendar_next(start, resolution))}
+    for (name, values) in columns.items():
+      bucket[name] = values[i].item()
+    buckets.append(bucket)
+  return buckets
+
+
+def reading_count(station_ids, start, end):
+  """Counts the readings of several stations in [start, end] without reading them. The day rollups are summed
+  if rollups are enabled, which counts the whole days at either edge, otherwise the readings are counted in
+  the database."""
+  if rollups_enabled():
+    return Rollup.objects.filter(
+      station__in=station_ids,
+      resolution='d',
+      timestamp__gte=bucket_start(start, 'd'),
+      timestamp__lte=end).aggregate(Sum('count'))['count__sum'] or 0
+  return get_station_readings(station_ids, start, end).count()
+
+
+def aggregate_stations(station_ids, start, end, resolution, percentiles=()):
+  """Aggregates the readings of several stations in [start, end] into calendar buckets with aggregate_readings.
+  The readings of all stations are read together; see monitor.segments.station_reading_data.
+  Returns a map of each of the given station IDs to its list of buckets."""
+  data = station_reading_data(station_ids, start, end, 'watts', 'watt_hours')
+  result = {}
+  for station_id in station_ids:
+    readings = data[station_id]
+    states = station_states(station_id, start, end)
+    readings['power_cycle'] = state_array(states, readings['timestamp'], 'power_cycle')
+    result[station_id] = aggregate_readings(readings, resolution, percentiles)
+  return result
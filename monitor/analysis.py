@@ -21,41 +21,249 @@
 
 import numpy as np
 from datetime import datetime, timedelta
+from django.conf import settings
+from itertools import islice
 from monitor.util import *
 
 
-def timeseries(readings, *fields):
+DOWNSAMPLE_MODES = ('lttb', 'minmax')
+
+# Microseconds per hour, the period of energy_timeseries
+HOUR_MICROS = 3600 * 1000000
+
+# Number of rows converted to arrays at a time by columns
+COLUMN_CHUNK_SIZE = 10000
+
+# Quality flags of the energy of the interval between two readings computed by energy_steps
+# Readings more than ENERGY_GAP_SECONDS apart
+ENERGY_GAP = 1
+# Meter counter restarted: the power cycle count changed or the counter decreased
+ENERGY_RESET = 2
+# Counter increased faster than ENERGY_MAX_WATTS allows
+ENERGY_SPIKE = 4
+# Energy integrated from watts rather than taken from the counter
+ENERGY_ESTIMATED = 8
+
+
+def columns(readings, *fields):
+  """Extracts the given fields from a sequence of readings as a map of field name to NumPy array.
+  The timestamp field is represented as int64 microseconds since the Unix epoch, interpreting the local time of
+  the reading as UTC the same way monitor.util.epoch does; all other fields are int32.
+  Querysets are read with a single values_list query rather than materializing model instances, and rows are
+  converted COLUMN_CHUNK_SIZE at a time so that only the arrays grow with the number of readings.
+  Other sequences of readings are read attribute by attribute. A map of arrays previously returned by this
+  function may be passed in place of readings."""
+  if isinstance(readings, dict):
+    return readings
+  if hasattr(readings, 'values_list'):
+    rows = readings.values_list(*fields).iterator()
+  else:
+    rows = (tuple([getattr(r, f) for f in fields]) for r in readings)
+  return rows_to_columns(rows, fields)
+
+
+def rows_to_columns(rows, fields, codes=None):
+  """Converts an iterator of rows of the given fields to a map of field name to NumPy array as described by
+  columns, COLUMN_CHUNK_SIZE rows at a time. If codes, a map of value to integer, is given, the values of the
+  first field are replaced by their codes rather than converted to integers."""
+  chunks = dict([(f, []) for f in fields])
+  while True:
+    values = zip(*islice(rows, COLUMN_CHUNK_SIZE))
+    if len(values) == 0:
+      break
+    for i in range(len(fields)):
+      if i == 0 and codes is not None:
+        chunks[fields[i]].append(np.array([codes[v] for v in values[i]], dtype=np.int32))
+      elif fields[i] == 'timestamp':
+        chunks[fields[i]].append(np.array(values[i], dtype='datetime64[us]').astype(np.int64))
+      else:
+        chunks[fields[i]].append(np.array(values[i], dtype=np.int32))
+  result = {}
+  for field in fields:
+    dtype = field == 'timestamp' and np.int64 or np.int32
+    result[field] = np.concatenate(chunks[field] or [np.empty(0, dtype=dtype)])
+  return result
+
+
+def station_columns(readings, station_ids, *fields):
+  """Extracts the given fields from a sequence of readings of several stations, such as the result of
+  monitor.util.get_station_readings, as a map of each of the given station IDs to a map of field name to
+  NumPy array in the form produced by columns.
+  All rows are read by a single values_list query in one pass, then grouped by station with a stable sort so
+  that the readings of each station keep their chronological order."""
+  codes = dict([(station_ids[i], i) for i in range(len(station_ids))])
+  data = rows_to_columns(readings.values_list('station', *fields).iterator(), ('station',) + fields, codes)
+  order = np.argsort(data['station'], kind='mergesort')
+  bounds = np.concatenate(([0], np.cumsum(np.bincount(data['station'], minlength=len(station_ids)))))
+  result = {}
+  for i in range(len(station_ids)):
+    selected = order[bounds[i]:bounds[i + 1]]
+    result[station_ids[i]] = dict([(f, data[f][selected]) for f in fields])
+  return result
+
+
+def epoch_millis(micros):
+  """Converts an array of epoch microseconds to the whole-second epoch milliseconds produced by monitor.util.epoch."""
+  return micros // 1000000 * 1000
+
+
+def timeseries(readings, *fields, **kwargs):
   """Converts a sequence of readings into a list of time series in each of the given variables.
   Each time series is a list of two-tuples (t, f(t)) where f is one of the fields in the power reading.
   The size of the returned list is equal to the number of fields given.
-  Times are represented as UTC Unix timestamps, i.e. milliseconds since midnight 1970-01-01."""
-  permutations = {
-    'timestamp': epoch
-  }
-  rows = queryset_to_list(readings, *(('timestamp',) + fields), permutations=permutations)
-  series = []
-  for i in range(len(fields)):
-    series.append([(row[0], row[i+1]) for row in rows])
+  Times are represented as UTC Unix timestamps, i.e. milliseconds since midnight 1970-01-01.
+  If a points keyword parameter is provided, each series is downsampled to at most that many points
+  using the algorithm named by the mode keyword parameter, one of DOWNSAMPLE_MODES."""
+  data = columns(readings, 'timestamp', *fields)
+  times = epoch_millis(data['timestamp']).tolist()
+  series = [zip(times, data[field].tolist()) for field in fields]
+  if kwargs.get('points') is not None:
+    series = [downsample(s, kwargs['points'], kwargs.get('mode', 'lttb')) for s in series]
   return series
 
 
+def downsample(series, points, mode='lttb'):
+  """Reduces a time series to at most the given number of points while preserving its visual shape.
+  The lttb mode applies the largest-triangle-three-buckets algorithm, which keeps the point in each bucket
+  that forms the largest triangle with its neighbors. The minmax mode keeps the minimum and maximum of each
+  bucket, which preserves the envelope of the series including every spike.
+  The selected points are returned unmodified and in their original order."""
+  if mode not in DOWNSAMPLE_MODES:
+    raise ValueError('Invalid downsampling mode ' + mode)
+  if points < 3 or len(series) <= points:
+    return series
+  data = np.array(series, dtype=np.float64)
+  if mode == 'lttb':
+    indices = lttb_indices(data[:,0], data[:,1], points)
+  else:
+    indices = minmax_indices(data[:,1], points)
+  return [series[i] for i in indices]
+
+
+def lttb_indices(x, y, points):
+  """Computes the indices of the points selected by the largest-triangle-three-buckets algorithm.
+  The first and last points are always kept; the interior is divided into points - 2 buckets."""
+  n = len(x)
+  edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+  indices = np.empty(points, dtype=np.int64)
+  indices[0] = 0
+  indices[-1] = n - 1
+  selected = 0
+  for i in range(points - 2):
+    lo, hi = edges[i], edges[i + 1]
+    if i + 2 < len(edges):
+      next_x = x[hi:edges[i + 2]].mean()
+      next_y = y[hi:edges[i + 2]].mean()
+    else:
+      next_x, next_y = x[-1], y[-1]
+    # Twice the triangle area; the constant factor does not affect the argmax
+    area = np.abs((x[selected] - next_x) * (y[lo:hi] - y[selected]) - (x[selected] - x[lo:hi]) * (next_y - y[selected]))
+    selected = lo + int(np.argmax(area))
+    indices[i + 1] = selected
+  return indices
+
+
+def minmax_indices(y, points):
+  """Computes the indices of the minimum and maximum points of each of points / 2 equal-count buckets."""
+  n = len(y)
+  buckets = max(points // 2, 1)
+  edges = np.linspace(0, n, buckets + 1).astype(np.int64)[:-1]
+  bucket_ids = np.repeat(np.arange(buckets), np.diff(np.append(edges, n)))
+  mins = np.minimum.reduceat(y, edges)[bucket_ids]
+  maxs = np.maximum.reduceat(y, edges)[bucket_ids]
+  positions = np.arange(n)
+  # First occurrence of each bucket minimum and maximum
+  min_first = np.unique(bucket_ids[y == mins], return_index=True)[1]
+  max_first = np.unique(bucket_ids[y == maxs], return_index=True)[1]
+  selected = np.concatenate((positions[y == mins][min_first], positions[y == maxs][max_first]))
+  return np.unique(selected)
+
+
+def energy_data(readings):
+  """Gets the timestamp, watts and watt_hours arrays of readings for energy_steps.
+  A map of arrays as produced by columns is returned as is, so it may also carry power_cycle."""
+  return columns(readings, 'timestamp', 'watts', 'watt_hours')
+
+
+def energy_steps(data):
+  """Computes the energy consumed in the interval ending at each reading after the first in one vectorized pass.
+  The data is a map of timestamp, watts and watt_hours arrays in chronological order as produced by columns
+  plus, optionally, a power_cycle array in which -1 means unknown.
+  Energy is the increase of the meter counter unless the counter is unreliable: when the meter restarted
+  counting (the power cycle count changed or the counter decreased, e.g. on rollover), the counter value after
+  the restart is a lower bound of the energy, which is raised to the watts of the reading integrated over the
+  interval if that is greater. If ENERGY_MAX_WATTS is set, counter increases faster than that are glitches and
+  replaced by the integrated watts too.
+  Returns (energy, flags): float64 watt hours and ENERGY_* quality flags of each interval, both one shorter
+  than the data."""
+  times = data['timestamp']
+  watt_hours = data['watt_hours'].astype(np.int64)
+  seconds = np.diff(times) / 1e6
+  delta = np.diff(watt_hours).astype(np.float64)
+  estimated = data['watts'][1:] * seconds / 3600.0
+  flags = np.zeros(len(delta), dtype=np.int8)
+  reset = delta < 0
+  if data.get('power_cycle') is not None and len(times) > 0:
+    # Carry the last known power cycle forward over unknown ones, which never count as a change
+    cycles = data['power_cycle']
+    known = np.maximum.accumulate(np.where(cycles >= 0, np.arange(len(cycles)), 0))
+    carried = cycles[known]
+    reset |= (carried[1:] != carried[:-1]) & (carried[:-1] >= 0)
+  energy = np.where(reset, np.maximum(watt_hours[1:], estimated), delta)
+  flags[reset] |= ENERGY_RESET
+  flags[reset & (estimated > watt_hours[1:])] |= ENERGY_ESTIMATED
+  max_watts = getattr(settings, 'ENERGY_MAX_WATTS', None)
+  if max_watts is not None:
+    spike = ~reset & (delta > max_watts * seconds / 3600.0 + 1)
+    energy[spike] = estimated[spike]
+    flags[spike] |= ENERGY_SPIKE | ENERGY_ESTIMATED
+  flags[seconds > getattr(settings, 'ENERGY_GAP_SECONDS', 300)] |= ENERGY_GAP
+  return (energy, flags)
+
+
+def energy_segments(readings):
+  """Integrates the energy of a sequence of readings with energy_steps and divides it into segments, the
+  maximal runs of consecutive intervals with equal quality flags.
+  Returns a list of maps of start and end, the times of the first and last reading of the segment as
+  milliseconds since the epoch, watt_hours, the energy consumed between them, and flags."""
+  data = energy_data(readings)
+  (energy, flags) = energy_steps(data)
+  if len(energy) == 0:
+    return []
+  starts = np.concatenate(([0], np.flatnonzero(np.diff(flags)) + 1))
+  ends = np.concatenate((starts[1:], [len(energy)]))
+  times = epoch_millis(data['timestamp'])
+  totals = np.add.reduceat(energy, starts)
+  return [
+    {'start': int(times[a]), 'end': int(times[b]), 'watt_hours': float(wh), 'flags': int(flags[a])}
+    for (a, b, wh) in zip(starts, ends, totals)]
+
+
 def energy_timeseries(readings):
-  """Creates a time series of energy consumption in watt-hours per hour."""
-  first = readings[0]
-  last = readings[len(readings) - 1]
-  period = timedelta(hours=1)
-  series = []
-  current = first
-  for reading in readings:
-    if reading.timestamp - current.timestamp >= period:
-      series.append((epoch(reading.timestamp), reading.watt_hours - current.watt_hours))
-      current = reading
-  return series
+  """Creates a time series of energy consumption in watt-hours per hour.
+  Starting from the first reading, each point is the first reading at least an hour after the previous point,
+  valued at the watt-hours consumed since the previous point as computed by energy_steps, rounded to whole
+  watt hours. Readings must be in chronological order."""
+  data = energy_data(readings)
+  times = data['timestamp']
+  indices = []
+  current = 0
+  while len(times) > 0:
+    i = int(np.searchsorted(times, times[current] + HOUR_MICROS, 'left'))
+    if i >= len(times):
+      break
+    indices.append(i)
+    current = i
+  indices = np.array(indices, dtype=np.int64)
+  previous = np.concatenate(([0], indices))[:-1].astype(np.int64)
+  consumed = np.concatenate(([0.0], np.cumsum(energy_steps(data)[0])))
+  watt_hours = np.rint(consumed[indices] - consumed[previous]).astype(np.int64)
+  return zip(epoch_millis(times[indices]).tolist(), watt_hours.tolist())
 
 
 def to_nparray(nsequence):
   """Converts a n-dimensional sequence of integers into a numpy array."""
-  return np.array(nsequence, dtype=np.int32)
+  return np.array(nsequence, dtype=np.int64)
 
 
 def median(timeseries):
@@ -65,11 +273,31 @@ def median(timeseries):
 
 def median_watts(readings):
   """Computes the median watts over all given readings."""
-  return median(timeseries(readings, 'watts')[0])
+  return np.median(columns(readings, 'watts')['watts'])
 
 
 def total_kWh(readings):
-  """Computes the total kWh used over all given readings.
+  """Computes the total kWh used over all given readings as computed by energy_steps, in whole kWh.
   Readings are assumed to be ordered in ascending chronological order, which is the natural order for readings."""
-  return (readings[len(readings) - 1].watt_hours - readings[0].watt_hours) / 1000
+  return int(round(energy_steps(energy_data(readings))[0].sum())) / 1000
+
 
+def usage_summary(readings):
+  """Summarizes power usage over a sequence of readings or a map of timestamp, watts and watt hours arrays.
+  Returns a map containing the reading count, w_max and w_min, the extremes of watts, and median_kwh_day and
+  kwh_tot, all computed from a single columnar fetch of timestamps, watts and watt hours. A map may also carry
+  power_cycle for energy_steps. Returns None if there are no readings."""
+  data = energy_data(readings)
+  if len(data['watts']) == 0:
+    return None
+  summary = {
+    'count': len(data['watts']),
+    'w_max': int(data['watts'].max()),
+    'w_min': int(data['watts'].min()),
+  }
+  energy_series = energy_timeseries(data)
+  summary['median_kwh_day'] = 'ERR'
+  if len(energy_series) > 0:
+    summary['median_kwh_day'] = median(energy_series) * 24 / 1000
+  summary['kwh_tot'] = total_kWh(data)
+  return summary
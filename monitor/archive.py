@@ -0,0 +1,215 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import copy
+
+from datetime import datetime
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+from django.db.models import Count, Max, Min, Sum
+from itertools import chain
+from monitor.models import Reading, ReadingArchive, Rollup
+from monitor.rollup import rebuild_rollups
+
+# Name of the table holding the readings of the month starting at a given time
+ARCHIVE_TABLE_FORMAT = 'monitor_reading_%Y%m'
+
+# Combines the per-table results of an aggregate by the name of its class
+AGGREGATE_COMBINERS = {
+  'Count': sum,
+  'Sum': sum,
+  'Max': max,
+  'Min': min,
+}
+
+_models = {}
+
+
+def archive_horizon():
+  """Returns the age in days after which readings are archived, ARCHIVE_AFTER_DAYS, or None if disabled."""
+  return getattr(settings, 'ARCHIVE_AFTER_DAYS', None)
+
+
+def month_start(timestamp):
+  """Truncates a time to the start of its calendar month."""
+  return datetime(timestamp.year, timestamp.month, 1)
+
+
+def next_month(month):
+  """Returns the start of the calendar month following the month starting at the given time."""
+  if month.month == 12:
+    return datetime(month.year + 1, 1, 1)
+  return datetime(month.year, month.month + 1, 1)
+
+
+def archive_model(table):
+  """Returns an unmanaged model with the fields of Reading stored in the given archive table.
+  Archive tables have no foreign key constraint on the station so that stations with archived readings can
+  still be deleted."""
+  if table not in _models:
+    attrs = {
+      '__module__': Reading.__module__,
+      'Meta': type('Meta', (), {'db_table': table, 'managed': False}),
+    }
+    for field in Reading._meta.local_fields:
+      field = copy.deepcopy(field)
+      field.db_index = False
+      if field.rel is not None:
+        field.rel.related_name = '+'
+      attrs[field.name] = field
+    _models[table] = type(str('Reading_%s' % table), (models.Model,), attrs)
+  return _models[table]
+
+
+def create_archive_table(model):
+  """Creates the table of an archive model, indexed on (station, timestamp), unless it already exists."""
+  table = model._meta.db_table
+  if table in connection.introspection.table_names():
+    return
+  # Django only generates SQL for managed models
+  model._meta.managed = True
+  try:
+    (statements, pending) = connection.creation.sql_create_model(model, no_style(), set())
+  finally:
+    model._meta.managed = False
+  statements.append('CREATE INDEX %s ON %s (%s, %s)' % (
+    connection.ops.quote_name(table + '_station_timestamp'),
+    connection.ops.quote_name(table),
+    connection.ops.quote_name('station_id'),
+    connection.ops.quote_name('timestamp')))
+  cursor = connection.cursor()
+  for statement in statements:
+    cursor.execute(statement)
+
+
+@transaction.commit_on_success
+def archive_month(month):
+  """Moves the readings of the calendar month starting at the given time into its archive table.
+  Rollups of any station whose readings in the month are not fully covered by day rollups are rebuilt first,
+  so that rollups remain available for the whole archived range. Returns the number of readings moved."""
+  following = next_month(month)
+  readings = Reading.objects.filter(timestamp__gte=month, timestamp__lt=following)
+  counts = dict(readings.values_list('station').annotate(Count('id')).order_by())
+  if len(counts) == 0:
+    return 0
+  covered = dict(Rollup.objects.filter(
+    resolution='d',
+    timestamp__gte=month,
+    timestamp__lt=following).values_list('station').annotate(Sum('count')).order_by())
+  for (station_id, count) in counts.items():
+    if covered.get(station_id) != count:
+      rebuild_rollups(station_id, month, following)
+  model = archive_model(month.strftime(ARCHIVE_TABLE_FORMAT))
+  create_archive_table(model)
+  columns = ', '.join([connection.ops.quote_name(f.column) for f in Reading._meta.local_fields])
+  where = '%s >= %%s AND %s < %%s' % (connection.ops.quote_name('timestamp'), connection.ops.quote_name('timestamp'))
+  params = (connection.ops.value_to_db_datetime(month), connection.ops.value_to_db_datetime(following))
+  cursor = connection.cursor()
+  cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s' % (
+    connection.ops.quote_name(model._meta.db_table),
+    columns,
+    columns,
+    connection.ops.quote_name(Reading._meta.db_table),
+    where), params)
+  # Only readings that were copied are deleted, since readings may be inserted between the two statements.
+  # QuerySet.delete would load every reading to collect related objects.
+  cursor.execute('DELETE FROM %s WHERE %s AND %s IN (SELECT %s FROM %s WHERE %s)' % (
+    connection.ops.quote_name(Reading._meta.db_table),
+    where,
+    connection.ops.quote_name('id'),
+    connection.ops.quote_name('id'),
+    connection.ops.quote_name(model._meta.db_table),
+    where), params + params)
+  moved = cursor.rowcount
+  (archive, created) = ReadingArchive.objects.get_or_create(
+    month=month,
+    defaults={'table': model._meta.db_table, 'archived': datetime.now()})
+  archive.count += moved
+  archive.archived = datetime.now()
+  archive.save()
+  return moved
+
+
+def archived_querysets(station_id, start, end):
+  """Gets querysets over the archived readings of a station in [start, end], one per overlapping archive
+  table in chronological order, each ordered by time."""
+  archives = ReadingArchive.objects.filter(month__gte=month_start(start), month__lte=end).order_by('month')
+  return [
+    archive_model(a.table).objects.filter(
+      station=station_id,
+      timestamp__gte=start,
+      timestamp__lte=end).order_by('timestamp')
+    for a in archives]
+
+
+def archived_station_querysets(station_ids, start, end):
+  """Gets querysets over the archived readings of several stations in [start, end], one per overlapping archive
+  table in chronological order, each ordered by station and time."""
+  archives = ReadingArchive.objects.filter(month__gte=month_start(start), month__lte=end).order_by('month')
+  return [
+    archive_model(a.table).objects.filter(
+      station__in=station_ids,
+      timestamp__gte=start,
+      timestamp__lte=end).order_by('station', 'timestamp')
+    for a in archives]
+
+
+class ReadingSet(object):
+  """Chronological sequence of readings that spans archive tables and the reading table.
+  Supports the subset of the QuerySet API used to read readings: values_list, iterator, iteration, count,
+  exists and aggregates whose per-table results can be combined: Count, Sum, Max and Min."""
+  def __init__(self, querysets):
+    self.querysets = querysets
+
+
+  def values_list(self, *fields, **kwargs):
+    return ReadingSet([qs.values_list(*fields, **kwargs) for qs in self.querysets])
+
+
+  def iterator(self):
+    return chain(*[qs.iterator() for qs in self.querysets])
+
+
+  def __iter__(self):
+    return self.iterator()
+
+
+  def count(self):
+    return sum([qs.count() for qs in self.querysets])
+
+
+  def exists(self):
+    return any([qs.exists() for qs in self.querysets])
+
+
+  def aggregate(self, *args, **kwargs):
+    aggregates = dict([(a.default_alias, a) for a in args])
+    aggregates.update(kwargs)
+    results = [qs.aggregate(**aggregates) for qs in self.querysets]
+    combined = {}
+    for (alias, aggregate) in aggregates.items():
+      values = [r[alias] for r in results if r[alias] is not None]
+      if len(values) == 0:
+        combined[alias] = None
+      else:
+        combined[alias] = AGGREGATE_COMBINERS[aggregate.name](values)
+    return combined
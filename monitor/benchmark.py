@@ -0,0 +1,259 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import cPickle
+import math
+import os
+import random
+import resource
+import time
+
+from datetime import timedelta
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test.client import Client
+from monitor.analysis import columns, energy_timeseries, median, timeseries, total_kWh, usage_summary
+from monitor.leaderboard import leaderboard, leaderboard_enabled, rebuild_leaderboard
+from monitor.models import Reading, Station
+from monitor.rollup import rebuild_rollups, rollups_enabled
+from monitor.segments import rebuild_segment, reading_data, segment_root
+from monitor.util import epoch, get_readings, parse_period
+
+# Number of synthetic readings inserted per bulk insert
+INSERT_BATCH_SIZE = 5000
+
+# Time format of the end of flotseries URIs
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def synthetic_readings(station, start, end, interval=1, seed=0):
+  """Generates deterministic readings for a station every interval seconds in [start, end).
+  Watts follow a daily cycle with random drift and occasional spikes; watt hours integrate the watts so the
+  counter behaves like that of a real meter."""
+  rng = random.Random('%s-%s' % (station.id, seed))
+  base = rng.randint(40, 400)
+  drift = 0.0
+  watt_hours = float(rng.randint(0, 100000))
+  timestamp = start
+  step = timedelta(seconds=interval)
+  while timestamp < end:
+    hour = timestamp.hour + timestamp.minute / 60.0
+    drift = max(-base / 2.0, min(base, drift + rng.gauss(0, 2)))
+    watts = int(base + drift + base * 0.5 * (1 + math.sin((hour - 6) * math.pi / 12)))
+    if rng.random() < 0.001:
+      watts += rng.randint(500, 1500)
+    watt_hours += watts * interval / 3600.0
+    yield Reading(
+      station=station,
+      timestamp=timestamp,
+      watts=watts,
+      volts=1200 + rng.randint(-20, 20),
+      amps=watts * 1000 / 120,
+      watt_hours=int(watt_hours),
+      power_factor=95,
+      volt_amps=watts * 105 / 100)
+    timestamp += step
+
+
+def populate(station, start, end, interval=1, seed=0):
+  """Inserts synthetic readings for a station and returns the number of readings inserted."""
+  count = 0
+  batch = []
+  for reading in synthetic_readings(station, start, end, interval, seed):
+    batch.append(reading)
+    if len(batch) == INSERT_BATCH_SIZE:
+      count += insert(batch)
+      batch = []
+  return count + insert(batch)
+
+
+@transaction.commit_on_success
+def insert(readings):
+  Reading.objects.bulk_create(readings)
+  return len(readings)
+
+
+def current_rss():
+  """Returns the resident set size of this process in kilobytes."""
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * resource.getpagesize() / 1024
+
+
+def measure(function, *args):
+  """Calls a function in a forked child process and returns (seconds, peak RSS growth in kilobytes, result).
+  Running in a child isolates the peak resident set size of the call from everything done before it.
+  The result must be picklable."""
+  (read_fd, write_fd) = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    try:
+      if connection.vendor != 'sqlite':
+        # Never share a server connection with the parent
+        connection.close()
+      baseline = current_rss()
+      started = time.time()
+      result = function(*args)
+      elapsed = time.time() - started
+      peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+      with os.fdopen(write_fd, 'wb') as out:
+        cPickle.dump((elapsed, peak, result), out, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      os._exit(0)
+  os.close(write_fd)
+  with os.fdopen(read_fd, 'rb') as f:
+    data = f.read()
+  os.waitpid(pid, 0)
+  return cPickle.loads(data)
+
+
+def legacy_usage_summary(readings):
+  """Summarizes usage the way the usage view did before aggregation moved into the database.
+  Every reading is materialized as a model instance and walked several times; kept only for comparison."""
+  readings = list(readings)
+  series = []
+  current = readings[0]
+  for reading in readings:
+    if reading.timestamp - current.timestamp >= timedelta(hours=1):
+      series.append((epoch(reading.timestamp), reading.watt_hours - current.watt_hours))
+      current = reading
+  median_usage = 'ERR'
+  if len(series) > 0:
+    median_usage = median(series) * 24 / 1000
+  return {
+    'count': len(readings),
+    'median_kwh_day': median_usage,
+    'kwh_tot': (readings[-1].watt_hours - readings[0].watt_hours) / 1000,
+    'w_max': max(r.watts for r in readings),
+    'w_min': min(r.watts for r in readings),
+  }
+
+
+def populate_stations(count, start, end, interval=1, seed=0):
+  """Creates count synthetic stations with readings every interval seconds in [start, end), which must be day
+  aligned, and builds their rollups, leaderboard state and segments where those are enabled.
+  Returns (stations, number of readings)."""
+  stations = []
+  total = 0
+  for i in range(count):
+    station = Station.objects.create(id='bench%03d' % i, name='Benchmark Station %d' % i)
+    total += populate(station, start, end, interval, seed)
+    if rollups_enabled():
+      rebuild_rollups(station.id, start, end)
+    if leaderboard_enabled():
+      transaction.commit_on_success(rebuild_leaderboard)(station, end)
+    if segment_root():
+      day = start
+      while day < end:
+        rebuild_segment(station.id, day)
+        day += timedelta(days=1)
+    stations.append(station)
+  return (stations, total)
+
+
+def data_access_client():
+  """Returns a test client logged in as a new user with the monitor.data_access permission."""
+  user = User.objects.create_user('benchmark', 'benchmark@example.com', 'benchmark')
+  user.user_permissions.add(Permission.objects.get(codename='data_access'))
+  client = Client()
+  client.login(username='benchmark', password='benchmark')
+  return client
+
+
+def benchmark_suite(stations, end, windows):
+  """Lists the benchmarks of the suite as (name, readings, function) for data sets of the given stations.
+  Analysis functions and the flotseries view are timed on the first station over each window, a period string
+  such as '7d' ending at end; readings is the number of readings in the window. The usage and leaders views
+  are timed once over all stations and need the NOW setting to equal end."""
+  client = data_access_client()
+  def get(url, cookies={}):
+    cache.clear()
+    client.cookies.update(cookies)
+    response = client.get(url, **{'wsgi.url_scheme': 'https'})
+    if response.status_code != 200:
+      raise Exception('GET %s returned status %d' % (url, response.status_code))
+    return response.content
+  station_id = stations[0].id
+  benchmarks = []
+  for window in windows:
+    start = end - parse_period(window)
+    readings = get_readings(station_id, start, end)
+    size = readings.count()
+    benchmarks += [
+      ('columns/' + window, size, lambda r=readings: columns(r, 'timestamp', 'watts', 'watt_hours')),
+      ('timeseries/' + window, size,
+        lambda s=start: timeseries(reading_data(station_id, s, end, 'watts'), 'watts', points=1000)),
+      ('energy_timeseries/' + window, size, lambda r=readings: energy_timeseries(r)),
+      ('total_kWh/' + window, size, lambda r=readings: total_kWh(r)),
+      ('usage_summary/' + window, size,
+        lambda s=start: usage_summary(reading_data(station_id, s, end, 'watts', 'watt_hours'))),
+      ('view:flotseries/' + window, size,
+        lambda w=window: get('/powermon/flotseries/%s/watts/%s/%s/' % (station_id, w, end.strftime(ISO_FORMAT)))),
+    ]
+  total = Reading.objects.count()
+  benchmarks += [
+    ('view:usage', total, lambda: get('/powermon/usage/', {'powermon_station': station_id})),
+    ('view:leaders', total, lambda: get('/powermon/leaders/')),
+  ]
+  return benchmarks
+
+
+def best_time(function, repeat):
+  """Calls a function repeat times and returns the shortest time in seconds, the least disturbed by noise."""
+  best = None
+  for i in range(repeat):
+    started = time.time()
+    function()
+    elapsed = time.time() - started
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def run_suite(benchmarks, repeat=3):
+  """Times each of the given benchmarks and returns a map of benchmark name to a map of readings and either
+  seconds or error, the message of an exception raised by the benchmark."""
+  results = {}
+  for (name, readings, function) in benchmarks:
+    try:
+      results[name] = {'readings': readings, 'seconds': best_time(function, repeat)}
+    except Exception as e:
+      results[name] = {'readings': readings, 'error': '%s: %s' % (type(e).__name__, e)}
+  return results
+
+
+def compare_results(results, baseline, threshold):
+  """Compares benchmark results to baseline results of the same benchmarks.
+  Returns a list of (name, description) for the benchmarks more than threshold, a fraction, slower than their
+  baseline, those that raised an error and those in the baseline that did not run. Benchmarks without a
+  successful baseline result are otherwise not compared."""
+  regressions = []
+  for name in sorted(set(results) | set(baseline)):
+    result = results.get(name)
+    if result is None:
+      regressions.append((name, 'missing from results'))
+    elif 'error' in result:
+      regressions.append((name, result['error']))
+    elif 'seconds' in baseline.get(name, {}):
+      if result['seconds'] > baseline[name]['seconds'] * (1 + threshold):
+        regressions.append((name, '%.4fs -> %.4fs' % (baseline[name]['seconds'], result['seconds'])))
+  return regressions
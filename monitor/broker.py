@@ -0,0 +1,222 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from monitor.util import epoch
+
+# Reading fields carried by published events in addition to station and timestamp
+EVENT_FIELDS = ('watts', 'volts', 'amps', 'watt_hours')
+
+logger = logging.getLogger(__name__)
+
+
+def reading_event(reading):
+  """Converts a reading into the JSON-serializable event published to subscribers.
+  The timestamp is in milliseconds since the epoch like the points of the flotseries URI."""
+  event = {'station': reading.station_id, 'timestamp': epoch(reading.timestamp)}
+  for field in EVENT_FIELDS:
+    event[field] = int(getattr(reading, field))
+  return event
+
+
+class Subscription(object):
+  """Events awaiting delivery to one client interested in a set of stations.
+  Only the newest event of each station is held, so a client that reads slower than readings arrive receives
+  the latest reading of every station instead of an ever growing backlog. Memory per client is therefore
+  bounded by the number of stations it watches. The number of events superseded this way is counted in
+  dropped."""
+  def __init__(self, stations):
+    self.stations = frozenset(stations)
+    self.condition = threading.Condition()
+    self.events = {}
+    self.dropped = 0
+
+
+  def put(self, event):
+    """Queues an event, replacing any older undelivered event of the same station."""
+    with self.condition:
+      current = self.events.get(event['station'])
+      if current is not None:
+        self.dropped += 1
+        if current['timestamp'] > event['timestamp']:
+          return
+      self.events[event['station']] = event
+      self.condition.notify()
+
+
+  def get(self, timeout):
+    """Waits up to timeout seconds for events and returns all queued events in chronological order.
+    Returns an empty list if none arrived in time."""
+    with self.condition:
+      if len(self.events) == 0:
+        self.condition.wait(timeout)
+      events = sorted(self.events.values(), key=lambda e: e['timestamp'])
+      self.events = {}
+    return events
+
+
+class LocalBroker(object):
+  """Fans published events out to the subscriptions of this process."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.subscriptions = set()
+
+
+  def subscribe(self, stations):
+    """Creates a subscription to the events of the given station IDs."""
+    subscription = Subscription(stations)
+    with self.lock:
+      self.subscriptions.add(subscription)
+    return subscription
+
+
+  def unsubscribe(self, subscription):
+    """Stops delivering events to a subscription."""
+    with self.lock:
+      self.subscriptions.discard(subscription)
+
+
+  def publish(self, events):
+    """Publishes a sequence of events to every interested subscriber."""
+    self.deliver(events)
+
+
+  def deliver(self, events):
+    with self.lock:
+      subscriptions = list(self.subscriptions)
+    for event in events:
+      for subscription in subscriptions:
+        if event['station'] in subscription.stations:
+          subscription.put(event)
+
+
+class SQLiteBroker(LocalBroker):
+  """Broker shared by all worker processes on a host through a SQLite file.
+  Publishing appends events to the file. One thread per process tails the file every poll seconds and fans
+  new events out to the local subscriptions, so a process reads the file once per interval regardless of the
+  number of clients it serves, and exits when the process has no subscriptions left. Events older than
+  retention seconds are pruned as new ones are published."""
+  def __init__(self, path, poll=0.5, retention=60):
+    super(SQLiteBroker, self).__init__()
+    self.path = path
+    self.poll = poll
+    self.retention = retention
+    self.local = threading.local()
+    self.last_id = None
+    self.tailer = None
+    with self.connect() as db:
+      db.execute('''CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created REAL NOT NULL,
+        payload TEXT NOT NULL)''')
+
+
+  def connect(self):
+    """Returns the connection of the calling thread to the event file."""
+    db = getattr(self.local, 'db', None)
+    if db is None:
+      db = sqlite3.connect(self.path, timeout=10)
+      db.execute('PRAGMA journal_mode=WAL')
+      self.local.db = db
+    return db
+
+
+  def subscribe(self, stations):
+    subscription = super(SQLiteBroker, self).subscribe(stations)
+    self.start()
+    return subscription
+
+
+  def publish(self, events):
+    created = time.time()
+    with self.connect() as db:
+      db.executemany(
+        'INSERT INTO events (created, payload) VALUES (?, ?)',
+        [(created, json.dumps(e)) for e in events])
+      db.execute('DELETE FROM events WHERE created < ?', (created - self.retention,))
+
+
+  def start(self):
+    """Starts tailing the event file from its current end if not already started."""
+    with self.lock:
+      if self.tailer is not None:
+        return
+      self.last_id = self.connect().execute('SELECT MAX(id) FROM events').fetchone()[0] or 0
+      self.tailer = threading.Thread(target=self.tail, name='event-tailer')
+      self.tailer.daemon = True
+      self.tailer.start()
+
+
+  def tail(self):
+    while True:
+      with self.lock:
+        if len(self.subscriptions) == 0:
+          self.tailer = None
+          return
+      try:
+        rows = self.connect().execute(
+          'SELECT id, payload FROM events WHERE id > ? ORDER BY id', (self.last_id,)).fetchall()
+        if len(rows) > 0:
+          self.last_id = rows[-1][0]
+          self.deliver([json.loads(payload) for (id, payload) in rows])
+      except Exception:
+        logger.exception('Failed reading events from %s' % self.path)
+      time.sleep(self.poll)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+def get_broker():
+  """Returns the process-wide event broker or None if publishing events is disabled.
+  EVENT_BROKER selects the broker: 'local' (default) for an in-process broker, 'sqlite' for a broker shared
+  by all processes through the file named by EVENT_BROKER_FILE, or None to disable events."""
+  global _broker
+  kind = getattr(settings, 'EVENT_BROKER', 'local')
+  if kind is None:
+    return None
+  with _broker_lock:
+    if _broker is None:
+      if kind == 'local':
+        _broker = LocalBroker()
+      elif kind == 'sqlite':
+        _broker = SQLiteBroker(settings.EVENT_BROKER_FILE)
+      else:
+        raise ValueError('Unknown EVENT_BROKER %s.' % kind)
+    return _broker
+
+
+def publish_readings(readings):
+  """Publishes newly recorded readings to subscribers of their stations.
+  Failures are logged rather than raised since the readings are already stored."""
+  broker = get_broker()
+  if broker is None:
+    return
+  try:
+    broker.publish([reading_event(r) for r in readings])
+  except Exception:
+    logger.exception('Failed publishing %s readings' % len(readings))
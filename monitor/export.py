@@ -0,0 +1,186 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import csv
+import json
+import numpy as np
+import struct
+import zlib
+
+from StringIO import StringIO
+from django.db import connection
+from monitor.util import get_readings
+
+# Formats produced by export_chunks
+EXPORT_FORMATS = ('csv', 'ndjson', 'bin')
+
+# Fields exported unless others are requested
+EXPORT_FIELDS = ('watts', 'volts', 'amps', 'watt_hours', 'power_factor', 'volt_amps')
+
+# Number of rows fetched from the database and encoded at a time
+EXPORT_CHUNK_SIZE = 10000
+
+# Binary format magic number and version
+BINARY_MAGIC = 'PMRB'
+BINARY_VERSION = 1
+
+# Binary header flags
+FLAG_DELTA = 1
+FLAG_ZLIB = 2
+
+# Block header holding the number of rows and the length of the block payload
+BLOCK_HEADER = struct.Struct('<II')
+
+
+def server_cursor():
+  """Opens a cursor whose result set is kept on the database server and transferred as rows are fetched.
+  PostgreSQL gets a named cursor and MySQL an unbuffered one; SQLite cursors already step through results
+  as they are fetched. Named cursors only exist inside a transaction."""
+  if connection.vendor == 'postgresql':
+    connection.cursor()
+    cursor = connection.connection.cursor(name='monitor_export')
+    cursor.itersize = EXPORT_CHUNK_SIZE
+    return cursor
+  if connection.vendor == 'mysql':
+    from MySQLdb.cursors import SSCursor
+    connection.cursor()
+    return connection.connection.cursor(SSCursor)
+  return connection.cursor()
+
+
+def fetch_chunks(station_id, start, end, fields=EXPORT_FIELDS, chunk_size=EXPORT_CHUNK_SIZE):
+  """Generates lists of (timestamp, field, ...) rows of the readings of a station in [start, end] in
+  chronological order, at most chunk_size rows at a time, through a server-side cursor per table read."""
+  readings = get_readings(station_id, start, end)
+  for queryset in getattr(readings, 'querysets', [readings]):
+    (sql, params) = queryset.values_list('timestamp', *fields).query.sql_with_params()
+    cursor = server_cursor()
+    try:
+      cursor.execute(sql, params)
+      while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+          break
+        yield rows
+    finally:
+      cursor.close()
+
+
+def csv_chunks(chunks, fields):
+  """Encodes row chunks as CSV with a header row and ISO format times."""
+  out = StringIO()
+  writer = csv.writer(out, lineterminator='\n')
+  writer.writerow(('timestamp',) + tuple(fields))
+  for rows in chunks:
+    writer.writerows([(r[0].isoformat(),) + tuple(r[1:]) for r in rows])
+    yield out.getvalue()
+    out.seek(0)
+    out.truncate()
+  if out.tell() > 0:
+    yield out.getvalue()
+
+
+def ndjson_chunks(chunks, fields):
+  """Encodes row chunks as newline-delimited JSON objects with ISO format times."""
+  keys = ('timestamp',) + tuple(fields)
+  for rows in chunks:
+    lines = []
+    for r in rows:
+      lines.append(json.dumps(dict(zip(keys, (r[0].isoformat(),) + tuple(r[1:])))))
+      lines.append('\n')
+    yield ''.join(lines)
+
+
+def binary_chunks(chunks, fields, delta=True, compress=True):
+  """Encodes row chunks in the compact columnar binary format.
+  The header is the magic number PMRB, then one byte each for the version, the flags and the number of
+  fields, then each field name as a length byte followed by ASCII. Each chunk becomes a block: a block header
+  of little-endian uint32 row count and payload length, then the payload, which is the timestamps as int64
+  microseconds since the epoch followed by each field as int32, all little-endian. With FLAG_DELTA every
+  column holds the differences between consecutive values, the first relative to zero, which wrap around in
+  the width of the column. With FLAG_ZLIB the payload is zlib compressed. A block with zero rows ends the
+  stream. Use read_binary to decode."""
+  flags = (delta and FLAG_DELTA or 0) | (compress and FLAG_ZLIB or 0)
+  header = [BINARY_MAGIC, struct.pack('<BBB', BINARY_VERSION, flags, len(fields))]
+  for field in fields:
+    header.append(struct.pack('<B', len(field)) + field)
+  yield ''.join(header)
+  for rows in chunks:
+    values = zip(*rows)
+    arrays = [np.array(values[0], dtype='datetime64[us]').astype('<i8')]
+    arrays.extend([np.array(v, dtype='<i4') for v in values[1:]])
+    if delta:
+      arrays = [np.diff(a, prepend=a.dtype.type(0)) for a in arrays]
+    payload = ''.join([a.tostring() for a in arrays])
+    if compress:
+      payload = zlib.compress(payload)
+    yield BLOCK_HEADER.pack(len(rows), len(payload)) + payload
+  yield BLOCK_HEADER.pack(0, 0)
+
+
+def read_binary(stream):
+  """Decodes the binary export format from a file-like object.
+  Returns a map of field name to NumPy array in the form produced by monitor.analysis.columns, with timestamp
+  as int64 epoch microseconds and all other fields as int32."""
+  if stream.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+    raise ValueError('Not a binary reading export.')
+  (version, flags, count) = struct.unpack('<BBB', stream.read(3))
+  if version != BINARY_VERSION:
+    raise ValueError('Unsupported binary export version %s.' % version)
+  fields = []
+  for i in range(count):
+    (length,) = struct.unpack('<B', stream.read(1))
+    fields.append(stream.read(length))
+  dtypes = [np.dtype('<i8')] + [np.dtype('<i4')] * count
+  blocks = []
+  while True:
+    (rows, length) = BLOCK_HEADER.unpack(stream.read(BLOCK_HEADER.size))
+    if rows == 0:
+      break
+    payload = stream.read(length)
+    if flags & FLAG_ZLIB:
+      payload = zlib.decompress(payload)
+    arrays = []
+    offset = 0
+    for dtype in dtypes:
+      array = np.frombuffer(payload, dtype=dtype, count=rows, offset=offset)
+      offset += rows * dtype.itemsize
+      if flags & FLAG_DELTA:
+        array = np.cumsum(array, dtype=dtype)
+      arrays.append(array)
+    blocks.append(arrays)
+  result = {}
+  for (i, name) in enumerate(['timestamp'] + fields):
+    result[name] = np.concatenate([b[i] for b in blocks] or [np.empty(0, dtype=dtypes[i])]).astype(dtypes[i].type)
+  return result
+
+
+def export_chunks(station_id, start, end, format, fields=EXPORT_FIELDS, delta=True, compress=True):
+  """Generates the readings of a station in [start, end] encoded in one of EXPORT_FORMATS.
+  The delta and compress options only apply to the binary format."""
+  chunks = fetch_chunks(station_id, start, end, fields)
+  if format == 'csv':
+    return csv_chunks(chunks, fields)
+  if format == 'ndjson':
+    return ndjson_chunks(chunks, fields)
+  if format == 'bin':
+    return binary_chunks(chunks, fields, delta, compress)
+  raise ValueError('Invalid export format %s.' % format)
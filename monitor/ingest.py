@@ -0,0 +1,419 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import atexit
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+from datetime import datetime
+from django.conf import settings
+from django.db import connection, transaction
+from monitor.broker import publish_readings
+from monitor.leaderboard import leaderboard_enabled, update_leaderboard
+from monitor.models import Reading
+from monitor.registry import registry
+from monitor.rollup import rollups_enabled, update_rollups
+from monitor.segments import store_segments
+from monitor.states import record_states
+
+# Maps the parameter names posted by a watts up? .net meter to Reading fields
+METER_FIELDS = (
+  ('w', 'watts'),
+  ('v', 'volts'),
+  ('a', 'amps'),
+  ('wh', 'watt_hours'),
+  ('pf', 'power_factor'),
+  ('va', 'volt_amps'),
+)
+
+# Maps the parameter names of meter state that rarely changes to StationState fields
+STATE_PARAMS = (
+  ('frq', 'frequency'),
+  ('rnc', 'relay_status'),
+  ('pcy', 'power_cycle'),
+)
+
+# Meter parameter values as parsed by parse_meter_values
+MeterValues = namedtuple('MeterValues', ('station_id',) + tuple([f for (p, f) in METER_FIELDS + STATE_PARAMS]))
+
+# Optionally signed integer or decimal number posted by a meter
+NUMBER_REGEX = re.compile(r'^\s*(-?)(\d{1,12})(?:\.(\d{0,9}))?\s*$')
+
+# Station IDs that may be posted by a meter, matching those accepted in URIs
+STATION_ID_REGEX = re.compile(r'^[0-9A-Za-z._]{1,20}$')
+
+# Range of values that fit the integer fields of readings
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+# Reading attributes kept in the ingest queue, including those recorded as station state changes
+QUEUE_FIELDS = tuple([f for (p, f) in METER_FIELDS + STATE_PARAMS]) + ('ip_address',)
+
+# Ways record stores readings, selected by INGEST_MODE
+INGEST_MODES = ('direct', 'buffer', 'queue')
+
+# Format of reading times in the ingest queue, which preserves microseconds
+QUEUE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+logger = logging.getLogger(__name__)
+
+
+class MeterParseError(ValueError):
+  """Raised when a meter post lacks a parameter or has a malformed value."""
+  pass
+
+
+def parse_number(text, scale):
+  """Parses an integer or decimal number and multiplies it by scale, rounding half away from zero.
+  Arithmetic is exact, so e.g. '120.05' with a scale of 10 is 1201. Raises ValueError if text is malformed."""
+  match = NUMBER_REGEX.match(text)
+  if match is None:
+    raise ValueError('Invalid number %s.' % text)
+  (sign, whole, fraction) = match.groups()
+  if fraction:
+    divisor = 10 ** len(fraction)
+    value = (int(whole + fraction) * scale * 2 + divisor) // (2 * divisor)
+  else:
+    value = int(whole) * scale
+  return sign and -value or value
+
+
+def parse_meter_values(values):
+  """Validates and parses the parameters posted by a meter from a mapping of parameter names to values.
+  Values may be integers or decimals; each is multiplied by the scale of its parameter in METER_FIELD_SCALES,
+  which defaults to 1, to obtain the integer stored with the reading, so that a meter posting e.g. volts as
+  '120.5' can be stored in tenths of volts with a scale of 10. Numbers decoded from JSON are also accepted.
+  Returns MeterValues or raises MeterParseError without touching the database."""
+  station_id = values.get('id')
+  if isinstance(station_id, (int, long)):
+    station_id = str(station_id)
+  if not isinstance(station_id, basestring) or STATION_ID_REGEX.match(station_id) is None:
+    raise MeterParseError('Invalid station ID %r.' % (station_id,))
+  scales = getattr(settings, 'METER_FIELD_SCALES', {})
+  parsed = [str(station_id)]
+  for (param, field) in METER_FIELDS + STATE_PARAMS:
+    text = values.get(param)
+    if text is None:
+      raise MeterParseError('Missing parameter %s.' % param)
+    if isinstance(text, (int, long, float)) and not isinstance(text, bool):
+      text = str(text)
+    try:
+      if not isinstance(text, basestring):
+        raise ValueError()
+      value = parse_number(text, scales.get(param, 1))
+    except ValueError:
+      raise MeterParseError('Invalid %s %r.' % (param, text))
+    if not INTEGER_MIN <= value <= INTEGER_MAX:
+      raise MeterParseError('Parameter %s out of range: %r.' % (param, text))
+    parsed.append(value)
+  return MeterValues(*parsed)
+
+
+def build_reading(station, values, ip_address, timestamp):
+  """Creates an unsaved reading for the given station from parsed MeterValues.
+  The IP address and meter state are set as plain attributes of the reading; they are not stored with it but
+  recorded as station state changes when the reading is stored."""
+  reading = Reading()
+  reading.station = station
+  reading.timestamp = timestamp
+  reading.ip_address = ip_address
+  for (param, field) in METER_FIELDS + STATE_PARAMS:
+    setattr(reading, field, getattr(values, field))
+  return reading
+
+
+def store_readings(readings):
+  """Persists a sequence of readings and, once they are committed, appends them to the segment store and
+  publishes them to event subscribers."""
+  if len(readings) > 0:
+    save_readings(readings)
+    store_segments(readings)
+    publish_readings(readings)
+
+
+@transaction.commit_on_success
+def save_readings(readings):
+  """Persists a sequence of readings with a single bulk insert, records changes of station state and folds
+  the readings into the stored rollups and leaderboard energy totals if they are enabled."""
+  Reading.objects.bulk_create(readings)
+  record_states(readings)
+  if rollups_enabled():
+    update_rollups(readings)
+  if leaderboard_enabled():
+    update_leaderboard(readings)
+
+
+class ReadingBuffer(object):
+  """Write-behind buffer that coalesces readings and persists them in bulk.
+  The buffer is flushed when it holds size readings or when the oldest buffered reading is older than
+  max_age seconds, whichever comes first. Age-based flushes happen on a background timer so that a
+  quiet period does not strand readings in memory."""
+  def __init__(self, size, max_age):
+    self.size = size
+    self.max_age = max_age
+    self.lock = threading.Lock()
+    self.readings = []
+    self.oldest = None
+    self.timer = None
+
+
+  def add(self, reading):
+    """Adds a reading to the buffer, flushing it if either threshold has been reached."""
+    with self.lock:
+      self.readings.append(reading)
+      if self.oldest is None:
+        self.oldest = time.time()
+      full = len(self.readings) >= self.size or time.time() - self.oldest >= self.max_age
+      if not full and self.timer is None:
+        self.timer = threading.Timer(self.max_age, self._timed_flush)
+        self.timer.daemon = True
+        self.timer.start()
+    if full:
+      self.flush()
+
+
+  def flush(self):
+    """Persists all buffered readings.
+    Readings that fail to persist are returned to the buffer so the next flush retries them."""
+    with self.lock:
+      batch = self.readings
+      self.readings = []
+      self.oldest = None
+      if self.timer is not None:
+        self.timer.cancel()
+        self.timer = None
+    if len(batch) == 0:
+      return 0
+    try:
+      store_readings(batch)
+    except Exception:
+      with self.lock:
+        self.readings = batch + self.readings
+        self.oldest = time.time()
+      raise
+    logger.debug('Flushed %s buffered readings' % len(batch))
+    return len(batch)
+
+
+  def pending(self):
+    """Returns the number of readings waiting to be persisted."""
+    with self.lock:
+      return len(self.readings)
+
+
+  def _timed_flush(self):
+    with self.lock:
+      self.timer = None
+    try:
+      self.flush()
+    except Exception:
+      logger.exception('Failed flushing buffered readings')
+    finally:
+      # Timer threads hold their own database connection
+      connection.close()
+
+
+class IngestQueue(object):
+  """Durable queue of readings awaiting storage, kept in a SQLite file in WAL mode.
+  Appending commits readings to the file with a full sync, so they survive a crash of the process or the host,
+  without touching the database. Readings are drained into the database in batches in the order they were
+  received and removed from the queue only after they are committed. A drain interrupted between the two
+  replays its batch, in which readings already stored for the same station and time are skipped."""
+  def __init__(self, path):
+    self.path = path
+    self.local = threading.local()
+    with self.connect() as db:
+      db.execute('''CREATE TABLE IF NOT EXISTS readings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        received REAL NOT NULL,
+        payload TEXT NOT NULL)''')
+
+
+  def connect(self):
+    """Returns the connection of the calling thread to the queue file."""
+    db = getattr(self.local, 'db', None)
+    if db is None:
+      db = sqlite3.connect(self.path, timeout=30)
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('PRAGMA synchronous=FULL')
+      self.local.db = db
+    return db
+
+
+  def append(self, readings):
+    """Appends a sequence of unsaved readings to the queue in a single transaction."""
+    received = time.time()
+    rows = []
+    for r in readings:
+      payload = dict([(f, getattr(r, f)) for f in QUEUE_FIELDS])
+      payload['station'] = r.station_id
+      payload['timestamp'] = r.timestamp.strftime(QUEUE_TIME_FORMAT)
+      rows.append((received, json.dumps(payload)))
+    with self.connect() as db:
+      db.executemany('INSERT INTO readings (received, payload) VALUES (?, ?)', rows)
+
+
+  def drain(self, batch_size):
+    """Stores up to batch_size of the oldest queued readings in the database and removes them from the queue.
+    Returns the number of readings removed from the queue."""
+    rows = self.connect().execute(
+      'SELECT id, payload FROM readings ORDER BY id LIMIT ?', (batch_size,)).fetchall()
+    if len(rows) == 0:
+      return 0
+    payloads = [json.loads(payload) for (id, payload) in rows]
+    stations = registry.in_bulk(set([p['station'] for p in payloads]))
+    readings = self.deduplicate([self.build(p) for p in payloads if p['station'] in stations])
+    store_readings(readings)
+    with self.connect() as db:
+      db.execute('DELETE FROM readings WHERE id <= ?', (rows[-1][0],))
+    if len(readings) < len(rows):
+      logger.info('Skipped %s queued readings of deleted stations or already stored' % (len(rows) - len(readings)))
+    return len(rows)
+
+
+  def build(self, payload):
+    """Recreates an unsaved reading from its queued form."""
+    reading = Reading()
+    reading.station_id = payload['station']
+    reading.timestamp = datetime.strptime(payload['timestamp'], QUEUE_TIME_FORMAT)
+    for field in QUEUE_FIELDS:
+      setattr(reading, field, payload[field])
+    return reading
+
+
+  def deduplicate(self, readings):
+    """Removes readings whose station and time are already stored or occur earlier in the sequence.
+    Stored times are read with one range query per station, so the number of query parameters does not grow
+    with the batch, and times are compared at the precision of the database, which may drop microseconds."""
+    by_station = {}
+    for r in readings:
+      by_station.setdefault(r.station_id, []).append(stored_time(r.timestamp))
+    seen = set()
+    for (station_id, times) in by_station.items():
+      stored = Reading.objects.filter(
+        station=station_id,
+        timestamp__gte=min(times),
+        timestamp__lte=max(times)).values_list('timestamp', flat=True)
+      seen.update([(station_id, stored_time(t)) for t in stored.iterator()])
+    unique = []
+    for r in readings:
+      key = (r.station_id, stored_time(r.timestamp))
+      if key not in seen:
+        seen.add(key)
+        unique.append(r)
+    return unique
+
+
+  def stats(self):
+    """Returns a map containing depth, the number of queued readings, and lag, the age in seconds of the
+    oldest queued reading or 0 if the queue is empty."""
+    (depth, oldest) = self.connect().execute('SELECT COUNT(*), MIN(received) FROM readings').fetchone()
+    return {
+      'depth': depth,
+      'lag': oldest is not None and round(time.time() - oldest, 3) or 0,
+    }
+
+
+def stored_time(timestamp):
+  """Returns a time as the database stores it, without microseconds if the database does not support them."""
+  if connection.features.supports_microsecond_precision:
+    return timestamp
+  return timestamp.replace(microsecond=0)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def get_buffer():
+  """Returns the process-wide reading buffer or None if write-behind buffering is disabled.
+  Buffering is enabled by setting INGEST_BUFFER_SIZE to a value greater than 1."""
+  global _buffer
+  size = getattr(settings, 'INGEST_BUFFER_SIZE', 0)
+  if size <= 1:
+    return None
+  with _buffer_lock:
+    if _buffer is None:
+      _buffer = ReadingBuffer(size, getattr(settings, 'INGEST_BUFFER_SECONDS', 5))
+      atexit.register(flush_buffer)
+    return _buffer
+
+
+def flush_buffer():
+  """Flushes the process-wide reading buffer if one exists."""
+  if _buffer is not None:
+    _buffer.flush()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+  """Returns the process-wide ingest queue, which is kept in the file named by INGEST_QUEUE_FILE."""
+  global _queue
+  with _queue_lock:
+    if _queue is None:
+      _queue = IngestQueue(settings.INGEST_QUEUE_FILE)
+    return _queue
+
+
+def ingest_mode():
+  """Returns INGEST_MODE, one of INGEST_MODES. If it is not set, the mode is 'buffer' when INGEST_BUFFER_SIZE
+  is greater than 1 and 'direct' otherwise."""
+  mode = getattr(settings, 'INGEST_MODE', None)
+  if mode is None:
+    mode = get_buffer() is None and 'direct' or 'buffer'
+  if mode not in INGEST_MODES:
+    raise ValueError('Unknown INGEST_MODE %s.' % mode)
+  return mode
+
+
+def ingest_lag():
+  """Returns the maximum time in seconds between the time of a reading and its commit to the database.
+  This is INGEST_LAG_SECONDS if it is set, otherwise 0 in direct mode, INGEST_BUFFER_SECONDS in buffer mode
+  and 60 in queue mode."""
+  lag = getattr(settings, 'INGEST_LAG_SECONDS', None)
+  if lag is not None:
+    return lag
+  mode = ingest_mode()
+  if mode == 'queue':
+    return 60
+  elif mode == 'buffer':
+    return getattr(settings, 'INGEST_BUFFER_SECONDS', 5)
+  return 0
+
+
+def ingest(readings):
+  """Records a sequence of readings according to the ingest mode: stored in the database immediately
+  (direct), held in the write-behind buffer (buffer) or appended to the durable ingest queue (queue), from
+  which the drainqueue command stores them."""
+  mode = ingest_mode()
+  if mode == 'queue':
+    get_queue().append(readings)
+  elif mode == 'buffer' and get_buffer() is not None:
+    for reading in readings:
+      get_buffer().add(reading)
+  else:
+    store_readings(readings)
@@ -0,0 +1,220 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import numpy as np
+
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from itertools import islice
+from monitor.analysis import HOUR_MICROS, columns, energy_steps, rows_to_columns
+from monitor.models import EnergyBucket, EnergyState
+from monitor.rollup import bucket_start
+from monitor.states import state_array, station_states
+from monitor.util import EARLIEST, LATEST, create_or_merge, get_readings
+
+# Sliding windows maintained for each station as (EnergyState attribute, length)
+WINDOWS = (
+  ('day', timedelta(hours=24)),
+  ('week', timedelta(days=7)),
+  ('month', timedelta(days=30)),
+)
+
+# Number of readings integrated at a time when the leaderboard of a station is rebuilt
+REBUILD_CHUNK_SIZE = 100000
+
+
+def leaderboard_enabled():
+  """Determines whether the incremental leaderboard is maintained as readings are recorded and read by the
+  leaders view."""
+  return getattr(settings, 'USE_LEADERBOARD', False)
+
+
+def new_state(station_id, end):
+  """Creates an unsaved energy state for a station whose windows end at the given time."""
+  state = EnergyState(station_id=station_id)
+  for (name, length) in WINDOWS:
+    setattr(state, name + '_edge', bucket_start(end - length, 'h'))
+  return state
+
+
+def accumulate_energy(state, data, buckets):
+  """Integrates readings into hourly energy buckets with monitor.analysis.energy_steps, continuing from the last
+  reading of the state. The readings are a map of timestamp, watts, watt_hours and power_cycle arrays in
+  chronological order as produced by monitor.analysis.columns, with -1 for unknown power cycles.
+  The energy of each interval counts towards the hour of the reading that ends it; meter restarts, i.e. a changed
+  power cycle count or a decreasing counter, and counter glitches are handled by energy_steps.
+  Readings older than the last reading of the state cannot be integrated and are skipped.
+  The buckets map of hour start to whole watt hours and the last reading and total of the state are updated
+  in place."""
+  if state.last_timestamp is not None:
+    last = np.datetime64(state.last_timestamp, 'us').astype(np.int64)
+    keep = data['timestamp'] >= last
+    data = dict([(k, v[keep]) for (k, v) in data.items()])
+    previous = {
+      'timestamp': [last],
+      'watts': [0],
+      'watt_hours': [state.last_watt_hours],
+      'power_cycle': [state.last_power_cycle is None and -1 or state.last_power_cycle],
+    }
+    data = dict([(k, np.concatenate((np.array(previous[k], dtype=v.dtype), v))) for (k, v) in data.items()])
+  if len(data['timestamp']) == 0:
+    return
+  energy = energy_steps(data)[0]
+  (hours, inverse) = np.unique(data['timestamp'][1:] // HOUR_MICROS, return_inverse=True)
+  for (hour, watt_hours) in zip(hours, np.bincount(inverse, weights=energy, minlength=len(hours))):
+    watt_hours = int(round(watt_hours))
+    hour = datetime(1970, 1, 1) + timedelta(hours=int(hour))
+    buckets[hour] = buckets.get(hour, 0) + watt_hours
+    state.total += watt_hours
+  state.last_timestamp = datetime(1970, 1, 1) + timedelta(microseconds=int(data['timestamp'][-1]))
+  state.last_watt_hours = int(data['watt_hours'][-1])
+  cycles = data['power_cycle'][data['power_cycle'] >= 0]
+  if len(cycles) > 0:
+    state.last_power_cycle = int(cycles[-1])
+
+
+def locked_state(station_id, end):
+  """Gets the energy state of a station under a row lock, first inserting a new state whose windows end at the
+  given time if the station has none. If another transaction inserted the state first, that state is locked
+  and returned instead."""
+  try:
+    return EnergyState.objects.select_for_update().get(station=station_id)
+  except EnergyState.DoesNotExist:
+    pass
+  state = new_state(station_id, end)
+  sid = transaction.savepoint()
+  try:
+    state.save(force_insert=True)
+  except IntegrityError:
+    transaction.savepoint_rollback(sid)
+    return EnergyState.objects.select_for_update().get(station=station_id)
+  transaction.savepoint_commit(sid)
+  return state
+
+
+def merge_bucket(target, source):
+  """Adds the energy of the source bucket to the target bucket for the same station and hour."""
+  target.watt_hours += source.watt_hours
+
+
+def add_to_windows(state, buckets):
+  """Adds the energy of hourly buckets to every window of the state that includes them."""
+  for (hour, watt_hours) in buckets.items():
+    for (name, length) in WINDOWS:
+      if hour >= getattr(state, name + '_edge'):
+        setattr(state, name, getattr(state, name) + watt_hours)
+
+
+def update_leaderboard(readings):
+  """Folds newly recorded readings into the running energy totals of their stations.
+  This function should be called inside the transaction that saves the readings."""
+  by_station = {}
+  for r in readings:
+    by_station.setdefault(r.station_id, []).append(r)
+  for (station_id, station_readings) in by_station.items():
+    station_readings.sort(key=lambda r: r.timestamp)
+    state = locked_state(station_id, station_readings[-1].timestamp)
+    data = columns(station_readings, 'timestamp', 'watts', 'watt_hours')
+    cycles = [getattr(r, 'power_cycle', None) for r in station_readings]
+    data['power_cycle'] = np.array([c is None and -1 or c for c in cycles], dtype=np.int64)
+    buckets = {}
+    accumulate_energy(state, data, buckets)
+    existing = list(EnergyBucket.objects.select_for_update().filter(
+      station=station_id,
+      timestamp__in=buckets.keys()))
+    for bucket in existing:
+      bucket.watt_hours += buckets[bucket.timestamp]
+      bucket.save(force_update=True)
+    found = set([b.timestamp for b in existing])
+    create_or_merge(
+      EnergyBucket,
+      [EnergyBucket(station_id=station_id, timestamp=hour, watt_hours=wh)
+       for (hour, wh) in buckets.items() if hour not in found],
+      lambda b: {'station': b.station_id, 'timestamp': b.timestamp},
+      merge_bucket)
+    add_to_windows(state, buckets)
+    state.save(force_update=True)
+
+
+def advance(state, end):
+  """Slides the windows of an energy state forward so they end at the given time, subtracting the energy of
+  hourly buckets that fell out of each window. If any window moves, the state is reloaded under a row lock so
+  that totals written concurrently by update_leaderboard are neither lost nor counted twice, saved, and copied
+  into the given state."""
+  if all([bucket_start(end - length, 'h') <= getattr(state, name + '_edge') for (name, length) in WINDOWS]):
+    return
+  with transaction.commit_on_success():
+    locked = EnergyState.objects.select_for_update().get(pk=state.pk)
+    moved = False
+    for (name, length) in WINDOWS:
+      edge = getattr(locked, name + '_edge')
+      new_edge = bucket_start(end - length, 'h')
+      if new_edge <= edge:
+        continue
+      expired = EnergyBucket.objects.filter(
+        station=locked.station_id,
+        timestamp__gte=edge,
+        timestamp__lt=new_edge).aggregate(Sum('watt_hours'))['watt_hours__sum'] or 0
+      setattr(locked, name, getattr(locked, name) - expired)
+      setattr(locked, name + '_edge', new_edge)
+      moved = True
+    if moved:
+      locked.save(force_update=True)
+  for field in EnergyState._meta.fields:
+    setattr(state, field.attname, getattr(locked, field.attname))
+
+
+def leaderboard(end):
+  """Gets the energy states of all enabled stations with windows ending at the given time.
+  Windows move at most once per hour, so this is normally a single query over one row per station."""
+  states = list(EnergyState.objects.filter(station__enabled=True).select_related('station'))
+  for state in states:
+    advance(state, end)
+  return states
+
+
+def rebuild_leaderboard(station, end):
+  """Recomputes the energy state and hourly buckets of a station from its entire reading history.
+  The state is locked first, like update_leaderboard and advance do, so that readings recorded concurrently
+  are folded in after the rebuild commits rather than lost or counted twice. This function should be called
+  inside a transaction. Returns the rebuilt state."""
+  locked = locked_state(station.id, end)
+  EnergyBucket.objects.filter(station=station).delete()
+  state = new_state(station.id, end)
+  states = station_states(station.id, EARLIEST, LATEST)
+  fields = ('timestamp', 'watts', 'watt_hours')
+  rows = get_readings(station.id, EARLIEST, LATEST).values_list(*fields).iterator()
+  buckets = {}
+  while True:
+    data = rows_to_columns(islice(rows, REBUILD_CHUNK_SIZE), fields)
+    if len(data['timestamp']) == 0:
+      break
+    data['power_cycle'] = state_array(states, data['timestamp'], 'power_cycle')
+    accumulate_energy(state, data, buckets)
+  EnergyBucket.objects.bulk_create([
+    EnergyBucket(station=station, timestamp=hour, watt_hours=wh) for (hour, wh) in buckets.items()])
+  add_to_windows(state, buckets)
+  for field in EnergyState._meta.fields:
+    setattr(locked, field.attname, getattr(state, field.attname))
+  locked.save(force_update=True)
+  return locked
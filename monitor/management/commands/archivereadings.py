@@ -0,0 +1,54 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from monitor.archive import archive_horizon, archive_month, month_start, next_month
+from monitor.models import Reading
+from optparse import make_option
+
+# The leader board and status need up to a month of readings in the reading table
+MIN_HORIZON_DAYS = 31
+
+
+class Command(BaseCommand):
+  help = 'Moves readings older than the archive horizon into per-month archive tables.'
+  option_list = BaseCommand.option_list + (
+    make_option('--days', dest='days', type='int', help='Archive horizon in days; defaults to ARCHIVE_AFTER_DAYS'),
+  )
+
+  def handle(self, *args, **options):
+    days = options['days'] or archive_horizon()
+    if days is None:
+      raise CommandError('Set ARCHIVE_AFTER_DAYS or pass --days.')
+    if days < MIN_HORIZON_DAYS:
+      raise CommandError('The archive horizon must be at least %s days.' % MIN_HORIZON_DAYS)
+    cutoff = month_start(datetime.now() - timedelta(days=days))
+    earliest = Reading.objects.aggregate(Min('timestamp'))['timestamp__min']
+    if earliest is None:
+      return
+    month = month_start(earliest)
+    while month < cutoff:
+      moved = archive_month(month)
+      if moved > 0:
+        self.stdout.write('Archived %s readings from %s\n' % (moved, month.strftime('%Y-%m')))
+      month = next_month(month)
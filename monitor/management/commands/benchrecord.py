@@ -0,0 +1,69 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.client import Client
+from monitor.ingest import MeterParseError, parse_meter_values
+from monitor.models import Station
+from optparse import make_option
+
+VALID_POST = {
+  'id': 'bench', 'w': '1200', 'v': '120', 'a': '10', 'wh': '5000',
+  'pf': '99', 'frq': '60', 'va': '1212', 'rnc': '0', 'pcy': '1'
+}
+MALFORMED_POST = dict(VALID_POST, w='1.2.3', a='')
+
+
+class Command(BaseCommand):
+  help = ('Measures requests per second through the record view for valid and malformed posts, and the rate '
+    'of parsing alone, in a throwaway test database.')
+  option_list = BaseCommand.option_list + (
+    make_option('--requests', dest='requests', type='int', default=2000,
+      help='Requests per measurement; defaults to 2000'),
+  )
+
+  def handle(self, *args, **options):
+    count = options['requests']
+    database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+      Station.objects.create(id='bench', name='Benchmark Station')
+      client = Client()
+      self.stdout.write('%-12s%14s%12s\n' % ('', 'requests/s', 'status'))
+      for (name, post) in (('valid', VALID_POST), ('malformed', MALFORMED_POST)):
+        start = time.time()
+        for i in range(count):
+          response = client.post('/powermon/record/', post, **{'wsgi.url_scheme': 'https'})
+        elapsed = time.time() - start
+        self.stdout.write('%-12s%14.0f%12d\n' % (name, count / elapsed, response.status_code))
+      self.stdout.write('\n%-12s%14s\n' % ('', 'parses/s'))
+      for (name, post) in (('valid', VALID_POST), ('malformed', MALFORMED_POST)):
+        start = time.time()
+        for i in range(count):
+          try:
+            parse_meter_values(post)
+          except MeterParseError:
+            pass
+        self.stdout.write('%-12s%14.0f\n' % (name, count / (time.time() - start)))
+    finally:
+      connection.creation.destroy_test_db(database_name, verbosity=0)
@@ -0,0 +1,91 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import json
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from monitor.benchmark import benchmark_suite, compare_results, populate_stations, run_suite
+from optparse import make_option
+
+
+class Command(BaseCommand):
+  help = ('Times analysis functions and views over deterministic synthetic histories of several stations in a '
+    'throwaway test database, writes the results as JSON and optionally fails on regressions against a '
+    'baseline. For example, 50 stations with 90 days of readings at 1 Hz: --stations 50 --days 90 --interval 1')
+  option_list = BaseCommand.option_list + (
+    make_option('--stations', dest='stations', type='int', default=10,
+      help='Number of synthetic stations; defaults to 10'),
+    make_option('--days', dest='days', type='int', default=30, help='Days of synthetic history; defaults to 30'),
+    make_option('--interval', dest='interval', type='int', default=60,
+      help='Seconds between synthetic readings; defaults to 60'),
+    make_option('--windows', dest='windows', default='1d|7d|30d',
+      help='Pipe-delimited periods over which per-station benchmarks are timed; defaults to 1d|7d|30d'),
+    make_option('--repeat', dest='repeat', type='int', default=3,
+      help='Times each benchmark runs, the fastest of which is reported; defaults to 3'),
+    make_option('--output', dest='output', default=None, help='File the JSON results are written to'),
+    make_option('--baseline', dest='baseline', default=None, help='JSON results of a previous run to compare to'),
+    make_option('--threshold', dest='threshold', type='float', default=0.25,
+      help='Fraction by which a benchmark may be slower than its baseline; defaults to 0.25'),
+  )
+
+  def handle(self, *args, **options):
+    baseline = None
+    if options['baseline']:
+      with open(options['baseline']) as f:
+        baseline = json.load(f)
+    end = datetime(2012, 1, 1)
+    start = end - timedelta(days=options['days'])
+    config = dict([(k, options[k]) for k in ('stations', 'days', 'interval', 'windows', 'repeat')])
+    database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+      settings.NOW = end
+      self.stderr.write('Generating readings...\n')
+      (stations, count) = populate_stations(options['stations'], start, end, options['interval'])
+      self.stderr.write('%d readings of %d stations over %d days\n\n' % (count, len(stations), options['days']))
+      results = run_suite(benchmark_suite(stations, end, options['windows'].split('|')), options['repeat'])
+    finally:
+      del settings.NOW
+      connection.creation.destroy_test_db(database_name, verbosity=0)
+    self.stderr.write('%-28s%12s%12s\n' % ('', 'readings', 'seconds'))
+    for name in sorted(results):
+      result = results[name]
+      if 'error' in result:
+        self.stderr.write('%-28s%12d  %s\n' % (name, result['readings'], result['error']))
+      else:
+        self.stderr.write('%-28s%12d%12.4f\n' % (name, result['readings'], result['seconds']))
+    output = json.dumps({'config': config, 'results': results}, indent=2, sort_keys=True)
+    if options['output']:
+      with open(options['output'], 'w') as f:
+        f.write(output + '\n')
+    else:
+      self.stdout.write(output + '\n')
+    if baseline is not None:
+      if baseline.get('config') != config:
+        self.stderr.write('\nBaseline configuration %s differs from %s\n' % (baseline.get('config'), config))
+      regressions = compare_results(results, baseline['results'], options['threshold'])
+      for (name, description) in regressions:
+        self.stderr.write('Regression %s: %s\n' % (name, description))
+      if regressions:
+        raise CommandError('%d benchmarks failed or regressed by more than %d%%' % (
+          len(regressions), options['threshold'] * 100))
@@ -0,0 +1,61 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection
+from monitor.analysis import usage_summary
+from monitor.benchmark import legacy_usage_summary, measure, populate
+from monitor.models import Station
+from monitor.util import get_readings
+from optparse import make_option
+
+
+class Command(BaseCommand):
+  help = ('Compares latency and peak RSS of the usage summary before and after database-side aggregation '
+    'on a synthetic station in a throwaway test database.')
+  option_list = BaseCommand.option_list + (
+    make_option('--days', dest='days', type='int', default=7, help='Days of synthetic history; defaults to 7'),
+    make_option('--interval', dest='interval', type='int', default=1,
+      help='Seconds between synthetic readings; defaults to 1'),
+  )
+
+  def handle(self, *args, **options):
+    database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+      station = Station.objects.create(id='bench', name='Benchmark Station')
+      end = datetime(2012, 1, 1)
+      start = end - timedelta(days=options['days'])
+      self.stdout.write('Generating readings...\n')
+      count = populate(station, start, end, options['interval'])
+      self.stdout.write('%d readings over %d days\n\n' % (count, options['days']))
+      self.stdout.write('%-10s%12s%16s\n' % ('', 'seconds', 'peak RSS (KB)'))
+      results = {}
+      for (name, function) in (('before', legacy_usage_summary), ('after', usage_summary)):
+        (elapsed, rss, summary) = measure(function, get_readings(station.id, start, end))
+        results[name] = summary
+        self.stdout.write('%-10s%12.3f%16d\n' % (name, elapsed, rss))
+      for key in ('median_kwh_day', 'kwh_tot', 'w_max', 'w_min'):
+        if results['before'][key] != results['after'][key]:
+          self.stderr.write('Mismatched %s: %s != %s\n' % (key, results['before'][key], results['after'][key]))
+    finally:
+      connection.creation.destroy_test_db(database_name, verbosity=0)
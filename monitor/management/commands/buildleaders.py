@@ -0,0 +1,46 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from monitor.leaderboard import rebuild_leaderboard
+from monitor.models import Station
+from monitor.util import now
+from optparse import make_option
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds the running energy totals of the leaderboard from stored readings.'
+  option_list = BaseCommand.option_list + (
+    make_option('--station', dest='station', help='ID of station to rebuild; defaults to all stations'),
+  )
+
+  def handle(self, *args, **options):
+    if options['station']:
+      stations = Station.objects.filter(id=options['station'])
+      if len(stations) == 0:
+        raise CommandError('Station %s does not exist.' % options['station'])
+    else:
+      stations = Station.objects.all()
+    end = now()
+    for station in stations:
+      state = transaction.commit_on_success(rebuild_leaderboard)(station, end)
+      self.stdout.write('Rebuilt leaderboard for %s: %s kWh all time\n' % (station.id, state.total / 1000))
@@ -0,0 +1,65 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from monitor.models import Station
+from monitor.segments import rebuild_segment, segment_root
+from monitor.util import EARLIEST, LATEST, get_readings
+from optparse import make_option
+
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Command(BaseCommand):
+  help = 'Rebuilds the segment store from stored readings one station-day at a time.'
+  option_list = BaseCommand.option_list + (
+    make_option('--station', dest='station', help='ID of station to rebuild; defaults to all stations'),
+    make_option('--start', dest='start', help='ISO format start time; defaults to the earliest reading'),
+    make_option('--end', dest='end', help='ISO format end time; defaults to the latest reading'),
+  )
+
+  def handle(self, *args, **options):
+    if segment_root() is None:
+      raise CommandError('SEGMENT_ROOT is not set.')
+    if options['station']:
+      stations = Station.objects.filter(id=options['station'])
+      if len(stations) == 0:
+        raise CommandError('Station %s does not exist.' % options['station'])
+    else:
+      stations = Station.objects.all()
+    for station in stations:
+      bounds = get_readings(station.id, EARLIEST, LATEST).aggregate(Min('timestamp'), Max('timestamp'))
+      if bounds['timestamp__min'] is None:
+        continue
+      start = bounds['timestamp__min']
+      if options['start']:
+        start = datetime.strptime(options['start'], ISO_FORMAT)
+      end = bounds['timestamp__max']
+      if options['end']:
+        end = datetime.strptime(options['end'], ISO_FORMAT)
+      day = start.date()
+      count = 0
+      while day <= end.date():
+        count += rebuild_segment(station.id, day)
+        day += timedelta(days=1)
+      self.stdout.write('Wrote %s readings to segments of %s\n' % (count, station.id))
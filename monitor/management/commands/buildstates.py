@@ -0,0 +1,87 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from monitor.models import Reading, ReadingArchive, Station, StationState
+from monitor.states import STATE_FIELDS
+from optparse import make_option
+
+# Number of legacy rows fetched at a time
+FETCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+  help = 'Records station state changes from the state columns that readings stored before upgrading.'
+  option_list = BaseCommand.option_list + (
+    make_option('--station', dest='station', help='ID of station to rebuild; defaults to all stations'),
+  )
+
+  def handle(self, *args, **options):
+    tables = [a.table for a in ReadingArchive.objects.order_by('month')] + [Reading._meta.db_table]
+    columns = [c[0] for c in connection.introspection.get_table_description(connection.cursor(), tables[-1])]
+    for field in STATE_FIELDS:
+      if field not in columns:
+        raise CommandError('Column %s no longer exists in %s.' % (field, tables[-1]))
+    if options['station']:
+      stations = Station.objects.filter(id=options['station'])
+      if len(stations) == 0:
+        raise CommandError('Station %s does not exist.' % options['station'])
+    else:
+      stations = Station.objects.all()
+    for station in stations:
+      count = self.rebuild_station(station, tables)
+      self.stdout.write('Recorded %s state changes for %s\n' % (count, station.id))
+
+
+  @transaction.commit_on_success
+  def rebuild_station(self, station, tables):
+    """Replaces the states of a station up to its last legacy reading with one for every change of the state
+    columns of its readings. Readings stored since upgrading have no values in the state columns and are
+    skipped; the states recorded for them as they were stored are kept."""
+    quote = connection.ops.quote_name
+    current = None
+    last = None
+    created = []
+    for table in tables:
+      cursor = connection.cursor()
+      cursor.execute('SELECT %s, %s FROM %s WHERE %s = %%s AND (%s) ORDER BY %s' % (
+        quote('timestamp'),
+        ', '.join([quote(f) for f in STATE_FIELDS]),
+        quote(table),
+        quote('station_id'),
+        ' OR '.join(['%s IS NOT NULL' % quote(f) for f in STATE_FIELDS]),
+        quote('timestamp')), (station.id,))
+      while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if len(rows) == 0:
+          break
+        for row in rows:
+          values = tuple(row[1:])
+          if values != current:
+            created.append(StationState(station=station, timestamp=row[0], **dict(zip(STATE_FIELDS, values))))
+            current = values
+          last = row[0]
+    if last is None:
+      return 0
+    StationState.objects.filter(station=station, timestamp__lte=last).delete()
+    StationState.objects.bulk_create(created)
+    return len(created)
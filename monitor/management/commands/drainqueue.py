@@ -0,0 +1,62 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from monitor.ingest import get_queue
+from optparse import make_option
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+  help = 'Stores readings from the ingest queue in the database in batches until interrupted.'
+  option_list = BaseCommand.option_list + (
+    make_option('--batch-size', dest='batch_size', type='int', default=1000,
+      help='Maximum number of readings stored per transaction; defaults to 1000'),
+    make_option('--interval', dest='interval', type='float', default=1.0,
+      help='Seconds to wait when the queue is empty or the database fails; defaults to 1'),
+    make_option('--once', dest='once', action='store_true', default=False,
+      help='Exit once the queue is empty'),
+  )
+
+  def handle(self, *args, **options):
+    queue = get_queue()
+    while True:
+      try:
+        drained = queue.drain(options['batch_size'])
+      except Exception:
+        if options['once']:
+          raise
+        logger.exception('Failed draining ingest queue; retrying in %s seconds' % options['interval'])
+        connection.close()
+        drained = 0
+      else:
+        if drained > 0:
+          logger.debug('Drained %s readings, %s queued' % (drained, queue.stats()['depth']))
+      if drained == 0:
+        if options['once']:
+          break
+        time.sleep(options['interval'])
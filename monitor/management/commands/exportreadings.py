@@ -0,0 +1,79 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import sys
+
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from monitor.export import EXPORT_FIELDS, EXPORT_FORMATS, export_chunks
+from monitor.models import Station
+from optparse import make_option
+
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Command(BaseCommand):
+  help = 'Exports the readings of a station as CSV, newline-delimited JSON or compact binary.'
+  option_list = BaseCommand.option_list + (
+    make_option('--station', dest='station', help='ID of station to export'),
+    make_option('--start', dest='start', help='ISO format start time; defaults to one day before end'),
+    make_option('--end', dest='end', help='ISO format end time; defaults to now'),
+    make_option('--format', dest='format', default='csv', help='One of %s; defaults to csv' % ', '.join(EXPORT_FORMATS)),
+    make_option('--fields', dest='fields', help='Comma-separated fields to export; defaults to %s' % ','.join(EXPORT_FIELDS)),
+    make_option('--output', dest='output', help='File to write; defaults to standard output'),
+    make_option('--no-delta', dest='delta', action='store_false', default=True, help='Disable binary delta encoding'),
+    make_option('--no-zlib', dest='compress', action='store_false', default=True, help='Disable binary compression'),
+  )
+
+  def handle(self, *args, **options):
+    if not options['station']:
+      raise CommandError('--station is required.')
+    if not Station.objects.filter(id=options['station']).exists():
+      raise CommandError('Station %s does not exist.' % options['station'])
+    if options['format'] not in EXPORT_FORMATS:
+      raise CommandError('Invalid format %s.' % options['format'])
+    fields = EXPORT_FIELDS
+    if options['fields']:
+      fields = tuple(options['fields'].split(','))
+      for field in fields:
+        if field not in EXPORT_FIELDS:
+          raise CommandError('Invalid field %s.' % field)
+    try:
+      end = datetime.now()
+      if options['end']:
+        end = datetime.strptime(options['end'], ISO_FORMAT)
+      start = end - timedelta(days=1)
+      if options['start']:
+        start = datetime.strptime(options['start'], ISO_FORMAT)
+    except ValueError:
+      raise CommandError('Times must be in ISO format, YYYY-mm-ddTHH:MM:SS.')
+    chunks = export_chunks(
+      options['station'], start, end, options['format'], fields, options['delta'], options['compress'])
+    if options['output']:
+      out = open(options['output'], 'wb')
+    else:
+      out = sys.stdout
+    try:
+      for chunk in chunks:
+        out.write(chunk)
+    finally:
+      if options['output']:
+        out.close()
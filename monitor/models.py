@@ -39,16 +39,12 @@ class Reading(models.Model):
 
   station = models.ForeignKey(Station)
   timestamp = models.DateTimeField(db_index=True)
-  ip_address = models.CharField('IP address', max_length=40)
   watts = models.IntegerField()
   volts = models.IntegerField()
   amps = models.IntegerField()
   watt_hours = models.IntegerField('watt hours')
   power_factor = models.IntegerField('power factor')
-  frequency = models.IntegerField('frequency')
   volt_amps = models.IntegerField('volt amps')
-  relay_status = models.IntegerField('relay status')
-  power_cycle = models.IntegerField('power cycle count')
 
   class Meta:
     permissions = (
@@ -58,3 +54,104 @@ class Reading(models.Model):
   def __unicode__(self):
     return '%s::%skWh@%s' % (self.station, int(self.watt_hours) / 1000, self.timestamp.strftime('%Y-%m-%dT%H:%M:%S'))
 
+
+
+class StationState(models.Model):
+  """State of a monitoring station that rarely changes between readings, recorded only when it changes.
+  A state is in effect from its timestamp until the timestamp of the next state of the same station."""
+
+  station = models.ForeignKey(Station)
+  timestamp = models.DateTimeField('effective from', db_index=True)
+  ip_address = models.CharField('IP address', max_length=40)
+  frequency = models.IntegerField('frequency')
+  relay_status = models.IntegerField('relay status')
+  power_cycle = models.IntegerField('power cycle count')
+
+  def __unicode__(self):
+    return '%s::%s@%s' % (self.station, self.ip_address, self.timestamp.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+class ReadingArchive(models.Model):
+  """Calendar month of readings moved out of the reading table into a table of their own."""
+
+  month = models.DateTimeField('month start', unique=True)
+  table = models.CharField(max_length=64, unique=True)
+  count = models.BigIntegerField('number of readings', default=0)
+  archived = models.DateTimeField('time last archived')
+
+  def __unicode__(self):
+    return '%s::%s' % (self.table, self.count)
+
+
+class Rollup(models.Model):
+  """Aggregate of the readings provided by a monitoring station over a fixed-length time bucket."""
+
+  RESOLUTIONS = (
+    ('m', 'minute'),
+    ('h', 'hour'),
+    ('d', 'day'),
+  )
+
+  station = models.ForeignKey(Station)
+  resolution = models.CharField(max_length=1, choices=RESOLUTIONS)
+  timestamp = models.DateTimeField('bucket start')
+  count = models.IntegerField()
+  first_timestamp = models.DateTimeField()
+  last_timestamp = models.DateTimeField()
+  watts_min = models.IntegerField()
+  watts_max = models.IntegerField()
+  watts_sum = models.BigIntegerField()
+  volts_min = models.IntegerField()
+  volts_max = models.IntegerField()
+  volts_sum = models.BigIntegerField()
+  amps_min = models.IntegerField()
+  amps_max = models.IntegerField()
+  amps_sum = models.BigIntegerField()
+  watt_hours_first = models.IntegerField()
+  watt_hours_last = models.IntegerField()
+
+  class Meta:
+    unique_together = ('station', 'resolution', 'timestamp')
+
+  def watts_mean(self):
+    return float(self.watts_sum) / self.count
+
+  def volts_mean(self):
+    return float(self.volts_sum) / self.count
+
+  def amps_mean(self):
+    return float(self.amps_sum) / self.count
+
+  def __unicode__(self):
+    return '%s::%s@%s' % (self.station, self.resolution, self.timestamp.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+class EnergyState(models.Model):
+  """Running energy totals of a monitoring station maintained incrementally as readings are recorded.
+  Window totals cover the hourly energy buckets whose start is no earlier than the corresponding edge."""
+
+  station = models.OneToOneField(Station, primary_key=True)
+  last_timestamp = models.DateTimeField(null=True)
+  last_watt_hours = models.IntegerField(null=True)
+  last_power_cycle = models.IntegerField(null=True)
+  total = models.BigIntegerField('all-time watt hours', default=0)
+  day = models.BigIntegerField('past day watt hours', default=0)
+  day_edge = models.DateTimeField()
+  week = models.BigIntegerField('past week watt hours', default=0)
+  week_edge = models.DateTimeField()
+  month = models.BigIntegerField('past month watt hours', default=0)
+  month_edge = models.DateTimeField()
+
+  def __unicode__(self):
+    return '%s::%skWh' % (self.station, self.total / 1000)
+
+
+class EnergyBucket(models.Model):
+  """Energy consumed by a monitoring station in an hour, net of meter counter resets."""
+
+  station = models.ForeignKey(Station)
+  timestamp = models.DateTimeField('hour start')
+  watt_hours = models.BigIntegerField('watt hours')
+
+  class Meta:
+    unique_together = ('station', 'timestamp')
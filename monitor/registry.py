@@ -0,0 +1,143 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from monitor.models import Station
+
+logger = logging.getLogger(__name__)
+
+
+class StationRegistry(object):
+  """Process-local cache of all station descriptors.
+  The full station table is loaded in one query and served from memory until either ttl seconds elapse or
+  a station is saved or deleted in this process. IDs of stations found not to exist are remembered for as long.
+  Each lookup counts once: as a hit if it was served from memory or as a miss if it required a database
+  query."""
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.stations = None
+    self.missing = set()
+    self.loaded = 0
+    self.hits = 0
+    self.misses = 0
+
+
+  def get(self, station_id):
+    """Gets the station with the given ID or raises Station.DoesNotExist."""
+    (stations, queried) = self._stations()
+    station = stations.get(station_id)
+    if station is None and not queried and station_id not in self.missing:
+      # Possibly created by another process since the last load
+      queried = True
+      try:
+        station = Station.objects.get(id=station_id)
+      except Station.DoesNotExist:
+        pass
+      with self.lock:
+        if self.stations is stations:
+          if station is None:
+            self.missing.add(station_id)
+          else:
+            self.stations[station.id] = station
+    self._count(queried)
+    if station is None:
+      raise Station.DoesNotExist('Station %s does not exist.' % station_id)
+    return station
+
+
+  def get_by_name(self, name):
+    """Gets the station with the given name or raises Station.DoesNotExist."""
+    (stations, queried) = self._stations()
+    self._count(queried)
+    for station in stations.values():
+      if station.name == name:
+        return station
+    raise Station.DoesNotExist('Station %s does not exist.' % name)
+
+
+  def in_bulk(self, station_ids):
+    """Returns a map of station ID to station for each of the given IDs that exists."""
+    (stations, queried) = self._stations()
+    self._count(queried)
+    return dict([(i, stations[i]) for i in station_ids if i in stations])
+
+
+  def enabled(self):
+    """Returns a list of all enabled stations ordered by ID."""
+    (stations, queried) = self._stations()
+    self._count(queried)
+    return [stations[i] for i in sorted(stations.keys()) if stations[i].enabled]
+
+
+  def invalidate(self):
+    """Discards cached stations so that the next lookup reloads them."""
+    with self.lock:
+      self.stations = None
+      self.missing = set()
+
+
+  def stats(self):
+    """Returns a map containing hit and miss counts and the number of cached stations."""
+    with self.lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'size': self.stations is not None and len(self.stations) or 0,
+      }
+
+
+  def _count(self, queried):
+    with self.lock:
+      if queried:
+        self.misses += 1
+      else:
+        self.hits += 1
+
+
+  def _stations(self):
+    """Returns the map of cached stations, loading it if needed, and whether it was loaded."""
+    with self.lock:
+      if self.stations is not None and time.time() - self.loaded < self.ttl:
+        return (self.stations, False)
+    stations = dict([(s.id, s) for s in Station.objects.all()])
+    logger.debug('Loaded %s stations into registry' % len(stations))
+    with self.lock:
+      self.stations = stations
+      self.missing = set()
+      self.loaded = time.time()
+    return (stations, True)
+
+
+registry = StationRegistry(getattr(settings, 'STATION_CACHE_SECONDS', 300))
+
+
+def invalidate_registry(sender, **kwargs):
+  """Signal handler that invalidates the registry whenever a station changes."""
+  registry.invalidate()
+
+post_save.connect(invalidate_registry, sender=Station, dispatch_uid='monitor.registry.save')
+post_delete.connect(invalidate_registry, sender=Station, dispatch_uid='monitor.registry.delete')
@@ -0,0 +1,228 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Max, Min
+from monitor.models import Rollup, Station
+from monitor.util import create_or_merge, epoch, get_readings
+
+# Rollup resolutions ordered from finest to coarsest
+RESOLUTIONS = (
+  ('m', timedelta(minutes=1)),
+  ('h', timedelta(hours=1)),
+  ('d', timedelta(days=1)),
+)
+
+# Fields summarized by min, max and sum
+SUMMARY_FIELDS = ('watts', 'volts', 'amps')
+
+# Maps reading fields to the rollup attribute that represents them in a time series
+SERIES_VALUES = {
+  'watts': 'watts_mean',
+  'volts': 'volts_mean',
+  'amps': 'amps_mean',
+  'watt_hours': 'watt_hours_last',
+}
+
+
+def rollups_enabled():
+  """Determines whether rollups are maintained as readings are recorded and read by query views instead of raw
+  readings."""
+  return getattr(settings, 'USE_ROLLUPS', False)
+
+
+def bucket_start(timestamp, resolution):
+  """Truncates a timestamp to the start of the bucket that contains it at the given resolution."""
+  if resolution == 'm':
+    return timestamp.replace(second=0, microsecond=0)
+  elif resolution == 'h':
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+  return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def reading_rows(readings):
+  """Generates (station_id, timestamp, watts, volts, amps, watt_hours) tuples from a sequence of readings."""
+  for r in readings:
+    yield (r.station_id, r.timestamp, int(r.watts), int(r.volts), int(r.amps), int(r.watt_hours))
+
+
+def accumulate(rows, rollups=None):
+  """Accumulates rows produced by reading_rows into rollups at every resolution.
+  Returns a map of (station_id, resolution, bucket start) to unsaved Rollup objects, which is the rollups
+  parameter, if given, updated in place."""
+  if rollups is None:
+    rollups = {}
+  for (station_id, timestamp, watts, volts, amps, watt_hours) in rows:
+    for (resolution, length) in RESOLUTIONS:
+      key = (station_id, resolution, bucket_start(timestamp, resolution))
+      rollup = rollups.get(key)
+      if rollup is None:
+        rollups[key] = Rollup(
+          station_id=station_id,
+          resolution=resolution,
+          timestamp=key[2],
+          count=1,
+          first_timestamp=timestamp,
+          last_timestamp=timestamp,
+          watts_min=watts, watts_max=watts, watts_sum=watts,
+          volts_min=volts, volts_max=volts, volts_sum=volts,
+          amps_min=amps, amps_max=amps, amps_sum=amps,
+          watt_hours_first=watt_hours,
+          watt_hours_last=watt_hours)
+        continue
+      rollup.count += 1
+      rollup.watts_min = min(rollup.watts_min, watts)
+      rollup.watts_max = max(rollup.watts_max, watts)
+      rollup.watts_sum += watts
+      rollup.volts_min = min(rollup.volts_min, volts)
+      rollup.volts_max = max(rollup.volts_max, volts)
+      rollup.volts_sum += volts
+      rollup.amps_min = min(rollup.amps_min, amps)
+      rollup.amps_max = max(rollup.amps_max, amps)
+      rollup.amps_sum += amps
+      if timestamp < rollup.first_timestamp:
+        rollup.first_timestamp = timestamp
+        rollup.watt_hours_first = watt_hours
+      if timestamp >= rollup.last_timestamp:
+        rollup.last_timestamp = timestamp
+        rollup.watt_hours_last = watt_hours
+  return rollups
+
+
+def merge(target, source):
+  """Merges the source rollup into the target rollup for the same bucket."""
+  target.count += source.count
+  for field in SUMMARY_FIELDS:
+    setattr(target, field + '_min', min(getattr(target, field + '_min'), getattr(source, field + '_min')))
+    setattr(target, field + '_max', max(getattr(target, field + '_max'), getattr(source, field + '_max')))
+    setattr(target, field + '_sum', getattr(target, field + '_sum') + getattr(source, field + '_sum'))
+  if source.first_timestamp < target.first_timestamp:
+    target.first_timestamp = source.first_timestamp
+    target.watt_hours_first = source.watt_hours_first
+  if source.last_timestamp >= target.last_timestamp:
+    target.last_timestamp = source.last_timestamp
+    target.watt_hours_last = source.watt_hours_last
+
+
+def update_rollups(readings):
+  """Folds newly recorded readings into the stored rollups at every resolution.
+  Existing buckets are read once per station and resolution, so the cost is amortized over the number of
+  readings in the batch. This function should be called inside the transaction that saves the readings."""
+  rollups = accumulate(reading_rows(readings))
+  buckets = {}
+  for (station_id, resolution, start) in rollups.keys():
+    buckets.setdefault((station_id, resolution), []).append(start)
+  created = []
+  for ((station_id, resolution), starts) in buckets.items():
+    existing = Rollup.objects.select_for_update().filter(
+      station_id=station_id,
+      resolution=resolution,
+      timestamp__in=starts)
+    found = set()
+    for rollup in existing:
+      merge(rollup, rollups[(station_id, resolution, rollup.timestamp)])
+      rollup.save(force_update=True)
+      found.add(rollup.timestamp)
+    created.extend([rollups[(station_id, resolution, s)] for s in starts if s not in found])
+  create_or_merge(Rollup, created, rollup_key, merge)
+
+
+def rollup_key(rollup):
+  """Returns the lookup parameters of the stored bucket of a rollup."""
+  return {'station': rollup.station_id, 'resolution': rollup.resolution, 'timestamp': rollup.timestamp}
+
+
+def rebuild_rollups(station_id, start, end):
+  """Replaces the rollups of a station in [start, end), which must be day aligned, with rollups computed from
+  its stored readings. Returns the number of rollups created."""
+  Rollup.objects.filter(station=station_id, timestamp__gte=start, timestamp__lt=end).delete()
+  rows = get_readings(station_id, start, end - timedelta(microseconds=1)).values_list(
+    'station', 'timestamp', 'watts', 'volts', 'amps', 'watt_hours')
+  rollups = accumulate(rows.iterator())
+  Rollup.objects.bulk_create(rollups.values())
+  return len(rollups)
+
+
+def select_resolution(period):
+  """Selects the coarsest rollup resolution that still yields ROLLUP_MIN_POINTS buckets over the given period.
+  Returns None if the period is too short for any rollup, in which case raw readings should be used."""
+  min_points = getattr(settings, 'ROLLUP_MIN_POINTS', 100)
+  selected = None
+  for (resolution, length) in RESOLUTIONS:
+    if period.total_seconds() / length.total_seconds() >= min_points:
+      selected = resolution
+  return selected
+
+
+def get_rollups(station_id, resolution, start, end):
+  """Gets the rollups at the given resolution for the buckets of the given station that overlap [start, end]."""
+  return Rollup.objects.filter(
+    station_id=station_id,
+    resolution=resolution,
+    timestamp__gte=bucket_start(start, resolution),
+    timestamp__lte=end).order_by('timestamp')
+
+
+def get_station_rollups(station_ids, resolution, start, end):
+  """Gets the rollups like get_rollups for several stations with a single query.
+  Returns a map of each of the given station IDs to its rollups in chronological order."""
+  rollups = dict([(station_id, []) for station_id in station_ids])
+  for rollup in Rollup.objects.filter(
+      station__in=station_ids,
+      resolution=resolution,
+      timestamp__gte=bucket_start(start, resolution),
+      timestamp__lte=end).order_by('station', 'timestamp'):
+    rollups[rollup.station_id].append(rollup)
+  return rollups
+
+
+def rollup_timeseries(rollups, *fields):
+  """Converts a sequence of rollups into a list of time series in each of the given variables.
+  The result has the same form as that of monitor.analysis.timeseries with one point per bucket at the
+  bucket start time. Only the fields in SERIES_VALUES are supported."""
+  series = [[] for field in fields]
+  for rollup in rollups:
+    t = epoch(rollup.timestamp)
+    for i in range(len(fields)):
+      value = getattr(rollup, SERIES_VALUES[fields[i]])
+      if callable(value):
+        value = value()
+      series[i].append((t, value))
+  return series
+
+
+def station_energy(start, end):
+  """Gets enabled stations annotated with power_max and power_min, the greatest and least watt_hours readings
+  from rollups. Hourly rollups are used if a start time is given; they cover whole hours, from the start of the
+  hour containing start through end, so readings up to an hour before start are included. Otherwise daily
+  rollups cover the entire history."""
+  if start is None:
+    stations = Station.objects.filter(enabled=True, rollup__resolution='d')
+  else:
+    stations = Station.objects.filter(
+      enabled=True,
+      rollup__resolution='h',
+      rollup__timestamp__gte=bucket_start(start, 'h'),
+      rollup__timestamp__lte=end)
+  return stations.annotate(
+    power_max=Max('rollup__watt_hours_last'),
+    power_min=Min('rollup__watt_hours_first'))
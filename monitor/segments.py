@@ -0,0 +1,358 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import errno
+import fcntl
+import logging
+import mmap
+import numpy as np
+import os
+import struct
+import zlib
+
+from datetime import datetime, timedelta
+from django.conf import settings
+from monitor.analysis import columns, station_columns
+from monitor.util import get_readings, get_station_readings
+
+# Reading fields stored in segments in addition to the timestamp
+SEGMENT_FIELDS = ('watts', 'volts', 'amps', 'watt_hours', 'power_factor', 'volt_amps')
+
+# Block header holding a magic number and the number of rows in the block
+BLOCK_HEADER = struct.Struct('<4sI')
+BLOCK_MAGIC = 'PMSG'
+
+# Column header holding the length of the compressed column
+COLUMN_HEADER = struct.Struct('<I')
+
+# Maximum number of rows per block written by rebuild_segment
+SEGMENT_BLOCK_SIZE = 86400
+
+# Appended blocks with fewer rows than this are small; once SEGMENT_COMPACT_BLOCKS of them trail a segment,
+# they are merged into one block so that frequent small appends do not pay the block overhead per reading
+SEGMENT_COMPACT_ROWS = 4096
+SEGMENT_COMPACT_BLOCKS = 64
+
+# Number of bytes copied at a time when compaction rewrites a segment
+COPY_SIZE = 1048576
+
+logger = logging.getLogger(__name__)
+
+
+def segment_root():
+  """Returns SEGMENT_ROOT, the directory of the segment store, or None if the segment store is disabled."""
+  return getattr(settings, 'SEGMENT_ROOT', None)
+
+
+def segment_path(station_id, day):
+  """Returns the path of the segment holding the readings of a station on the given day."""
+  return os.path.join(segment_root(), station_id, day.strftime('%Y%m%d') + '.seg')
+
+
+def delta_encode(array):
+  """Replaces each value with its difference from the previous one, the first relative to zero."""
+  return np.diff(array, prepend=array.dtype.type(0))
+
+
+def encode_block(data):
+  """Encodes a map of timestamp and SEGMENT_FIELDS arrays, as produced by monitor.analysis.columns, as a block.
+  A block is a header followed by one column per field, each a length and a zlib-compressed little-endian
+  array. Timestamps are int64 microseconds stored as deltas of deltas, which are zero for readings at a
+  steady interval; all other fields are int32 deltas, which wrap around like the arrays themselves."""
+  parts = [BLOCK_HEADER.pack(BLOCK_MAGIC, len(data['timestamp']))]
+  encoded = [delta_encode(delta_encode(data['timestamp'].astype('<i8')))]
+  encoded.extend([delta_encode(data[f].astype('<i4')) for f in SEGMENT_FIELDS])
+  for column in encoded:
+    compressed = zlib.compress(column.tostring())
+    parts.append(COLUMN_HEADER.pack(len(compressed)))
+    parts.append(compressed)
+  return ''.join(parts)
+
+
+def block_extents(buf):
+  """Returns the start offset, end offset and number of rows of each complete block in a buffer.
+  A truncated block at the end, left by an interrupted append, is ignored."""
+  extents = []
+  offset = 0
+  while offset + BLOCK_HEADER.size <= len(buf):
+    (magic, rows) = BLOCK_HEADER.unpack_from(buf, offset)
+    if magic != BLOCK_MAGIC:
+      raise ValueError('Corrupt segment block at offset %s.' % offset)
+    position = offset + BLOCK_HEADER.size
+    for i in range(len(SEGMENT_FIELDS) + 1):
+      if position + COLUMN_HEADER.size > len(buf):
+        return extents
+      (length,) = COLUMN_HEADER.unpack_from(buf, position)
+      position += COLUMN_HEADER.size + length
+      if position > len(buf):
+        return extents
+    extents.append((offset, position, rows))
+    offset = position
+  return extents
+
+
+def decode_blocks(buf):
+  """Decodes all complete blocks in a buffer into a list of maps of field name to array.
+  A truncated block at the end, left by an interrupted append, is ignored."""
+  blocks = []
+  for (offset, end, rows) in block_extents(buf):
+    position = offset + BLOCK_HEADER.size
+    compressed = []
+    for i in range(len(SEGMENT_FIELDS) + 1):
+      (length,) = COLUMN_HEADER.unpack_from(buf, position)
+      position += COLUMN_HEADER.size
+      compressed.append(buf[position:position + length])
+      position += length
+    block = {'timestamp': np.cumsum(np.cumsum(np.frombuffer(zlib.decompress(compressed[0]), dtype='<i8')))}
+    for (field, column) in zip(SEGMENT_FIELDS, compressed[1:]):
+      block[field] = np.cumsum(np.frombuffer(zlib.decompress(column), dtype='<i4'), dtype=np.int32)
+    blocks.append(block)
+  return blocks
+
+
+def merge_blocks(blocks):
+  """Concatenates decoded blocks into a single map of field name to array in chronological order."""
+  data = {}
+  for field in ('timestamp',) + SEGMENT_FIELDS:
+    data[field] = np.concatenate([b[field] for b in blocks]).astype(field == 'timestamp' and np.int64 or np.int32)
+  if len(blocks) > 1 and np.any(np.diff(data['timestamp']) < 0):
+    # Blocks appended out of order, e.g. by late batches
+    order = np.argsort(data['timestamp'], kind='mergesort')
+    for field in data:
+      data[field] = data[field][order]
+  return data
+
+
+def read_segment(path):
+  """Reads a segment file through a memory map into a map of field name to array in chronological order.
+  Returns None if the segment does not exist."""
+  try:
+    f = open(path, 'rb')
+  except IOError as e:
+    if e.errno == errno.ENOENT:
+      return None
+    raise
+  try:
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+      return None
+    buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+      blocks = decode_blocks(buf)
+    finally:
+      buf.close()
+  finally:
+    f.close()
+  if len(blocks) == 0:
+    return None
+  return merge_blocks(blocks)
+
+
+def lock_segment(path):
+  """Opens the lock file of a segment and locks it exclusively, serializing appends to and replacements of the
+  segment. Unlike the segment, the lock file is never replaced, so a writer waiting for the lock always opens
+  the current segment once it holds it. Closing the returned file releases the lock."""
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+  lock = open(path + '.lock', 'a+b')
+  fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+  return lock
+
+
+def read_tail(lock):
+  """Reads the number of small blocks trailing a segment and the offset of the first of them, which appends
+  keep in the lock file of the segment. Returns (0, 0) if none are recorded."""
+  lock.seek(0)
+  try:
+    (count, offset) = [int(v) for v in lock.read().split()]
+  except ValueError:
+    return (0, 0)
+  return (count, offset)
+
+
+def write_tail(lock, count, offset):
+  """Records the number of small blocks trailing a segment and the offset of the first in its lock file."""
+  lock.seek(0)
+  lock.truncate()
+  lock.write('%d %d\n' % (count, offset))
+  lock.flush()
+
+
+def compact_segment(path, offset):
+  """Merges the blocks of a locked segment from the given offset on into one block.
+  Only those blocks are decoded; the segment up to the offset is copied as is into a new file followed by the
+  merged block, which is then renamed over the segment so that a crash leaves either segment intact.
+  Returns the number of small trailing blocks and the offset of the first after compaction."""
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    try:
+      blocks = decode_blocks(f.read())
+    except ValueError:
+      # The recorded offset is stale, e.g. after a crash between a compaction and recording its result
+      logger.warn('Not compacting %s: no block at offset %s' % (path, offset))
+      return (0, 0)
+    if len(blocks) == 0:
+      return (0, 0)
+    data = merge_blocks(blocks)
+    temp = path + '.tmp'
+    with open(temp, 'wb') as out:
+      f.seek(0)
+      remaining = offset
+      while remaining > 0:
+        chunk = f.read(min(remaining, COPY_SIZE))
+        out.write(chunk)
+        remaining -= len(chunk)
+      out.write(encode_block(data))
+      out.flush()
+      os.fsync(out.fileno())
+  os.rename(temp, path)
+  if len(data['timestamp']) < SEGMENT_COMPACT_ROWS:
+    return (1, offset)
+  return (0, 0)
+
+
+def append_readings(readings):
+  """Appends newly recorded readings to the segments of their stations and days, one block per segment.
+  Small blocks trailing a segment are counted in its lock file and compacted once there are
+  SEGMENT_COMPACT_BLOCKS of them, so appends never read the whole segment."""
+  by_segment = {}
+  for r in readings:
+    by_segment.setdefault((r.station_id, r.timestamp.date()), []).append(r)
+  for ((station_id, day), segment_readings) in by_segment.items():
+    segment_readings.sort(key=lambda r: r.timestamp)
+    block = encode_block(columns(segment_readings, 'timestamp', *SEGMENT_FIELDS))
+    path = segment_path(station_id, day)
+    lock = lock_segment(path)
+    try:
+      (count, offset) = read_tail(lock)
+      with open(path, 'ab') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.write(block)
+      if len(segment_readings) >= SEGMENT_COMPACT_ROWS:
+        (count, offset) = (0, 0)
+      elif count == 0 or offset > size:
+        (count, offset) = (1, size)
+      else:
+        count += 1
+      if count >= SEGMENT_COMPACT_BLOCKS:
+        (count, offset) = compact_segment(path, offset)
+      write_tail(lock, count, offset)
+    finally:
+      lock.close()
+
+
+def rebuild_segment(station_id, day):
+  """Replaces the segment of a station and day with the readings stored in the database.
+  The readings are queried while holding the lock of the segment, so readings appended concurrently are
+  either included or appended after the replacement. Returns the number of readings written."""
+  start = datetime(day.year, day.month, day.day)
+  path = segment_path(station_id, day)
+  lock = lock_segment(path)
+  try:
+    data = columns(
+      get_readings(station_id, start, start + timedelta(days=1) - timedelta(microseconds=1)),
+      'timestamp', *SEGMENT_FIELDS)
+    temp = path + '.tmp'
+    with open(temp, 'wb') as out:
+      for offset in range(0, len(data['timestamp']), SEGMENT_BLOCK_SIZE):
+        out.write(encode_block(dict([(k, v[offset:offset + SEGMENT_BLOCK_SIZE]) for (k, v) in data.items()])))
+    os.rename(temp, path)
+    write_tail(lock, 0, 0)
+  finally:
+    lock.close()
+  return len(data['timestamp'])
+
+
+def segment_days(station_id, first, last):
+  """Returns the days in [first, last] for which a station has a segment, in chronological order.
+  Lists the station directory once rather than probing every day of the range."""
+  try:
+    names = os.listdir(os.path.join(segment_root(), station_id))
+  except OSError as e:
+    if e.errno == errno.ENOENT:
+      return []
+    raise
+  days = []
+  for name in names:
+    if name.endswith('.seg'):
+      try:
+        day = datetime.strptime(name[:-4], '%Y%m%d').date()
+      except ValueError:
+        continue
+      if first <= day <= last:
+        days.append(day)
+  return sorted(days)
+
+
+def get_reading_arrays(station_id, start, end, *fields):
+  """Gets the given fields of the readings of a station in [start, end] from the segment store as a map of
+  field name to array in the form produced by monitor.analysis.columns."""
+  first = np.datetime64(start, 'us').astype(np.int64)
+  last = np.datetime64(end, 'us').astype(np.int64)
+  chunks = dict([(f, []) for f in fields])
+  for day in segment_days(station_id, start.date(), end.date()):
+    data = read_segment(segment_path(station_id, day))
+    if data is not None:
+      selected = (data['timestamp'] >= first) & (data['timestamp'] <= last)
+      for field in fields:
+        chunks[field].append(data[field][selected])
+  result = {}
+  for field in fields:
+    dtype = field == 'timestamp' and np.int64 or np.int32
+    result[field] = np.concatenate(chunks[field] or [np.empty(0, dtype=dtype)])
+  return result
+
+
+def reading_data(station_id, start, end, *fields):
+  """Gets the readings of a station in [start, end] for columnar analysis of the given fields.
+  Reads arrays from the segment store if it is enabled and holds every field, otherwise returns the
+  queryset of get_readings. Either may be passed to the functions of monitor.analysis."""
+  if segment_root() is not None and all([f in SEGMENT_FIELDS for f in fields]):
+    return get_reading_arrays(station_id, start, end, 'timestamp', *fields)
+  return get_readings(station_id, start, end)
+
+
+def station_reading_data(station_ids, start, end, *fields):
+  """Gets the timestamps and given fields of the readings of several stations in [start, end] as a map of each
+  of the given station IDs to a map of field name to array in the form produced by monitor.analysis.columns.
+  Reads the segment store if it is enabled and holds every field, otherwise reads all stations from the
+  database with a single query."""
+  if segment_root() is not None and all([f in SEGMENT_FIELDS for f in fields]):
+    return dict([(i, get_reading_arrays(i, start, end, 'timestamp', *fields)) for i in station_ids])
+  return station_columns(get_station_readings(station_ids, start, end), station_ids, 'timestamp', *fields)
+
+
+def store_segments(readings):
+  """Appends readings to the segment store if it is enabled.
+  Failures are logged rather than raised since the readings are already stored in the database, from which
+  the buildsegments command can rebuild any segment."""
+  if segment_root() is None:
+    return
+  try:
+    append_readings(readings)
+  except Exception:
+    logger.exception('Failed appending %s readings to segments' % len(readings))
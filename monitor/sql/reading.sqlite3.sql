@@ -0,0 +1,3 @@
+-- Composite index serving the station and time range filter shared by every reading query.
+-- The trailing watts and watt_hours columns let range aggregates be answered from the index alone.
+CREATE INDEX monitor_reading_station_timestamp ON monitor_reading (station_id, "timestamp", watts, watt_hours);
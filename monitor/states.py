@@ -0,0 +1,111 @@
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+import numpy as np
+
+from monitor.models import StationState
+
+# Fields of the station state carried by readings as they are recorded
+STATE_FIELDS = ('ip_address', 'frequency', 'relay_status', 'power_cycle')
+
+
+def reading_state(reading):
+  """Returns the station state carried by an unsaved reading as a tuple of STATE_FIELDS values.
+  Returns None unless the reading has an attribute for every state field."""
+  values = [getattr(reading, f, None) for f in STATE_FIELDS]
+  if None in values:
+    return None
+  return (str(values[0]),) + tuple([int(v) for v in values[1:]])
+
+
+def state_values(state):
+  """Returns the STATE_FIELDS values of a stored station state as a tuple."""
+  return tuple([getattr(state, f) for f in STATE_FIELDS])
+
+
+def record_states(readings):
+  """Records a station state for each reading whose state differs from the state of its station in effect
+  before it. Readings that carry no state are ignored.
+  This function should be called inside the transaction that saves the readings."""
+  by_station = {}
+  for r in readings:
+    values = reading_state(r)
+    if values is not None:
+      by_station.setdefault(r.station_id, []).append((r.timestamp, values))
+  created = []
+  for (station_id, rows) in by_station.items():
+    rows.sort()
+    current = state_at(station_id, rows[0][0])
+    if current is not None:
+      current = state_values(current)
+    for (timestamp, values) in rows:
+      if values != current:
+        created.append(StationState(station_id=station_id, timestamp=timestamp, **dict(zip(STATE_FIELDS, values))))
+        current = values
+  StationState.objects.bulk_create(created)
+
+
+def state_at(station_id, timestamp):
+  """Gets the state of a station in effect at the given time or None if none was recorded by then."""
+  states = list(StationState.objects.filter(
+    station=station_id,
+    timestamp__lte=timestamp).order_by('-timestamp')[:1])
+  return len(states) > 0 and states[0] or None
+
+
+def station_states(station_id, start, end):
+  """Gets the states of a station in effect at any time in [start, end] in chronological order."""
+  states = list(StationState.objects.filter(
+    station=station_id,
+    timestamp__gt=start,
+    timestamp__lte=end).order_by('timestamp'))
+  first = state_at(station_id, start)
+  if first is not None:
+    states.insert(0, first)
+  return states
+
+
+def rejoin(station_id, rows, start, end, *fields):
+  """Generates rows of readings of a station in [start, end] with the given state fields appended.
+  Rows are tuples whose first value is the reading time, such as those of values_list('timestamp', ...), and
+  must be in chronological order. Each row is extended with the values of the state in effect at its time,
+  or None for readings older than the first recorded state."""
+  states = station_states(station_id, start, end)
+  missing = (None,) * len(fields)
+  index = -1
+  for row in rows:
+    while index + 1 < len(states) and states[index + 1].timestamp <= row[0]:
+      index += 1
+    if index < 0:
+      yield tuple(row) + missing
+    else:
+      yield tuple(row) + tuple([getattr(states[index], f) for f in fields])
+
+
+def state_array(states, timestamps, field):
+  """Gets the value of a state field in effect at each of the given reading times as an int64 array.
+  The states are those of a station in chronological order, as returned by station_states, and the times are
+  int64 microseconds since the epoch as produced by monitor.analysis.columns. Readings older than the first
+  state get -1."""
+  times = np.array([s.timestamp for s in states], dtype='datetime64[us]').astype(np.int64)
+  # Index -1, i.e. no state in effect, selects the trailing -1
+  values = np.array([getattr(s, field) for s in states] + [-1], dtype=np.int64)
+  return values[np.searchsorted(times, timestamps, 'right') - 1]
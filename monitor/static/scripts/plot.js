@@ -19,20 +19,123 @@
 *
 ****************************************************************/
 
+var PLOT_OPTIONS = {
+  series: {
+    lines: { show: true, fill: false, lineWidth: 1}
+  },
+  xaxis: { mode: "time", twelveHourClock: false },
+  legend: {
+    backgroundOpacity: 0,
+    noColumns: 2,
+  }
+};
+
+// Appends a query parameter to a URL.
+function withParam(url, name, value) {
+  var separator = url.indexOf('?') < 0 ? '?' : '&';
+  return url + separator + name + '=' + value;
+}
+
+// Returns the maximum number of points per series requested for the given container.
+function maxPoints(plot_container) {
+  return Math.max($(plot_container).width(), 100);
+}
+
+// Appends a points parameter to a data series URL so the server downsamples
+// each series to roughly one point per horizontal pixel of the container.
+function pointsUrl(jsonUrl, plot_container) {
+  return withParam(jsonUrl, 'points', maxPoints(plot_container));
+}
+
+// Stops live updates of the plot in the given container, if any.
+function stopLive(plot_container) {
+  var timer = $(plot_container).data('liveTimer');
+  if (timer) {
+    clearInterval(timer);
+    $(plot_container).removeData('liveTimer');
+  }
+}
+
+// Returns the time of the newest point in any of the given flot series.
+function lastTime(json) {
+  var last = 0;
+  for (var i = 0; i < json.length; i++) {
+    var data = json[i].data;
+    if (data.length > 0 && data[data.length - 1][0] > last) {
+      last = data[data.length - 1][0];
+    }
+  }
+  return last;
+}
+
 // Plots a data series in flot JSON format in the given container to hold the plot.
 function plotSeries(jsonUrl, plot_container) {
-  var options = {
-    series: {
-      lines: { show: true, fill: false, lineWidth: 1}
-    },
-    xaxis: { mode: "time", twelveHourClock: false },
-    legend: {
-      backgroundOpacity: 0,
-      noColumns: 2,
+  stopLive(plot_container);
+  $.getJSON(pointsUrl(jsonUrl, plot_container), function (json) {
+    $.plot(plot_container, json, PLOT_OPTIONS);
+  });
+}
+
+// Replaces the points of each series from the time of the first newer point
+// onward with the newer points. The server returns readings from somewhat
+// before the requested time so that readings committed late are included.
+function mergeSeries(json, newer) {
+  for (var i = 0; i < json.length && i < newer.length; i++) {
+    var data = json[i].data;
+    if (newer[i].data.length > 0) {
+      var from = newer[i].data[0][0];
+      var keep = data.length;
+      while (keep > 0 && data[keep - 1][0] >= from) {
+        keep--;
+      }
+      json[i].data = data.slice(0, keep).concat(newer[i].data);
     }
-  };
+  }
+}
 
-  $.getJSON(jsonUrl, function (json) {
-    $.plot(plot_container, json, options);
-  });
+// Plots a data series like plotSeries and then every refreshSeconds fetches only the points newer than the
+// last one plotted, merges them and trims points older than periodSeconds from the left edge of the plot.
+// Once any series holds more than twice the points of the initial plot, the whole downsampled window is
+// fetched again so that the plot does not grow back to full resolution.
+function livePlotSeries(jsonUrl, plot_container, periodSeconds, refreshSeconds) {
+  stopLive(plot_container);
+  var json = null;
+  var reload = function () {
+    $.getJSON(pointsUrl(jsonUrl, plot_container), function (downsampled) {
+      json = downsampled;
+      $.plot(plot_container, json, PLOT_OPTIONS);
+    });
+  };
+  var update = function () {
+    if (json === null) {
+      return;
+    }
+    $.ajax({
+      url: withParam(jsonUrl, 'since', lastTime(json)),
+      dataType: 'json',
+      global: false,
+      success: function (newer) {
+        mergeSeries(json, newer);
+        var edge = lastTime(json) - periodSeconds * 1000;
+        var limit = 2 * maxPoints(plot_container);
+        var full = false;
+        for (var i = 0; i < json.length; i++) {
+          var data = json[i].data;
+          var first = 0;
+          while (first < data.length && data[first][0] < edge) {
+            first++;
+          }
+          json[i].data = data.slice(first);
+          full = full || json[i].data.length > limit;
+        }
+        if (full) {
+          reload();
+        } else {
+          $.plot(plot_container, json, PLOT_OPTIONS);
+        }
+      }
+    });
+  };
+  reload();
+  $(plot_container).data('liveTimer', setInterval(update, refreshSeconds * 1000));
 }
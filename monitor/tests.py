@@ -19,10 +19,41 @@
 #
 #####################################################################
 
+import json
+import monitor.ingest
+import monitor.views
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from StringIO import StringIO
+
 from datetime import datetime, timedelta
-from django.test import TestCase
-from monitor.models import Reading, Station
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from monitor.management.commands import exportreadings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from monitor.models import EnergyBucket, EnergyState, Reading, ReadingArchive, Rollup, Station, StationState
+from monitor.aggregate import *
 from monitor.analysis import *
+from monitor.archive import *
+from monitor.broker import *
+from monitor.export import *
+from monitor.benchmark import benchmark_suite, compare_results, legacy_usage_summary, populate, populate_stations, \
+  run_suite
+from monitor.ingest import *
+from monitor.leaderboard import *
+from monitor.registry import *
+from monitor.rollup import *
+from monitor.segments import *
+from monitor.states import *
+from monitor.views import align_time, leader_stations, station_status, status_counts
 from monitor.util import *
 
 
@@ -34,22 +65,17 @@ class AnalysisTest(TestCase):
     # list of (watts, watt_hours)
     data = ((10, 21000), (12, 22000), (15, 24000), (17, 25000), (19, 26000))
     self.readings = []
-    address = '127.0.0.1'
     for datum in data:
       self.readings.append(
         Reading.objects.create(
         station=station,
-        ip_address=address,
         timestamp=timestamp,
         watts=datum[0],
         volts=0,
         amps=0,
         watt_hours=datum[1],
         power_factor=0,
-        frequency=0,
-        volt_amps=0,
-        relay_status=0,
-        power_cycle=0))
+        volt_amps=0))
       timestamp += delta
 
   def test_total_kWh(self):
@@ -59,6 +85,57 @@ class AnalysisTest(TestCase):
     self.assertEqual(median_watts(self.readings), 15)
 
 
+class EnergyTest(TestCase):
+  def data(self, watt_hours, seconds=10, power_cycle=None, watts=360):
+    data = {
+      'timestamp': np.arange(len(watt_hours), dtype=np.int64) * seconds * 1000000,
+      'watts': np.array([watts] * len(watt_hours), dtype=np.int32),
+      'watt_hours': np.array(watt_hours, dtype=np.int32),
+    }
+    if power_cycle is not None:
+      data['power_cycle'] = np.array(power_cycle, dtype=np.int64)
+    return data
+
+  def test_counter(self):
+    (energy, flags) = energy_steps(self.data([100, 101, 102, 104]))
+    self.assertEquals(list(energy), [1, 1, 2])
+    self.assertEquals(list(flags), [0, 0, 0])
+
+  def test_reset(self):
+    # Power cycle changes with the counter restarted at 5, then the counter rolls over without one
+    data = self.data([100, 110, 5, 8, 2], power_cycle=[1, 1, 2, -1, 2])
+    (energy, flags) = energy_steps(data)
+    self.assertEquals(list(energy), [10, 5, 3, 2])
+    self.assertEquals(list(flags), [0, ENERGY_RESET, 0, ENERGY_RESET])
+    self.assertEquals(total_kWh(self.data([1000, 500, 2000, 3000])), 3)
+    # Integrated watts exceed the counter after the restart
+    (energy, flags) = energy_steps(self.data([100, 0], seconds=60))
+    self.assertEquals(list(energy), [6])
+    self.assertEquals(list(flags), [ENERGY_RESET | ENERGY_ESTIMATED])
+
+  def test_gap_and_spike(self):
+    data = self.data([100, 101, 5101, 5102, 5200], seconds=100)
+    data['timestamp'][-1] += 1000 * 1000000
+    with self.settings(ENERGY_MAX_WATTS=1000, ENERGY_GAP_SECONDS=300):
+      (energy, flags) = energy_steps(data)
+      segments = energy_segments(data)
+    self.assertEquals(list(energy), [1, 10, 1, 98])
+    self.assertEquals(list(flags), [0, ENERGY_SPIKE | ENERGY_ESTIMATED, 0, ENERGY_GAP])
+    self.assertEquals([(s['start'], s['end'], s['flags']) for s in segments],
+      [(0, 100000, 0), (100000, 200000, 12), (200000, 300000, 0), (300000, 1400000, ENERGY_GAP)])
+    self.assertEquals(energy_segments(self.data([100])), [])
+
+  def test_state_array(self):
+    station = Station.objects.create(id='12345', name='test')
+    start = datetime(2012, 1, 1)
+    for (minutes, cycle) in ((1, 4), (3, 5)):
+      StationState.objects.create(station=station, timestamp=start + timedelta(minutes=minutes),
+        ip_address='127.0.0.1', frequency=60, relay_status=0, power_cycle=cycle)
+    times = columns([Reading(timestamp=start + timedelta(minutes=m)) for m in range(5)], 'timestamp')['timestamp']
+    states = station_states('12345', start, start + timedelta(minutes=5))
+    self.assertEquals(list(state_array(states, times, 'power_cycle')), [-1, 4, 4, 5, 5])
+
+
 class UtilTest(TestCase):
   def test_epoch(self):
     test_date = datetime.strptime('2012-01-01 13:00:05', '%Y-%m-%d %H:%M:%S')
@@ -71,15 +148,991 @@ class ReadingTest(TestCase):
     station = Station.objects.create(id='12345', name='test_station')
     reading = Reading.objects.create(
         station=station,
-        ip_address='127.0.0.1',
         timestamp=test_date,
         watts=10,
         volts=120,
         amps=1,
         watt_hours=102000,
         power_factor=0,
-        frequency=60,
-        volt_amps=120,
-        relay_status=0,
-        power_cycle=0)
-    self.assertEquals(unicode(reading), 'test_station::102kWh@' + test_date_string)
\ No newline at end of file
+        volt_amps=120)
+    self.assertEquals(unicode(reading), 'test_station::102kWh@' + test_date_string)
+
+class IngestTest(TestCase):
+  def setUp(self):
+    self.station = Station.objects.create(id='12345', name='test')
+    self.values = {
+      'id': '12345', 'w': '10', 'v': '120', 'a': '1', 'wh': '1000',
+      'pf': '99', 'frq': '60', 'va': '12', 'rnc': '0', 'pcy': '1'
+    }
+
+  def test_record_batch(self):
+    batch = []
+    for i in range(3):
+      item = dict(self.values)
+      item['ts'] = '2012-01-01T13:00:0%s' % i
+      batch.append(item)
+    response = self.client.post('/powermon/record/batch/', json.dumps(batch), content_type='application/json')
+    self.assertEquals(response.status_code, 200)
+    self.assertEquals(Reading.objects.filter(station=self.station).count(), 3)
+
+  def test_record_batch_unknown_station(self):
+    item = dict(self.values)
+    item['id'] = 'nope'
+    response = self.client.post('/powermon/record/batch/', json.dumps([item]), content_type='application/json')
+    self.assertEquals(response.status_code, 500)
+    self.assertEquals(Reading.objects.count(), 0)
+
+  def test_parse(self):
+    values = dict(self.values, v='120.05', a='-0.5', pf=99)
+    with self.settings(METER_FIELD_SCALES={'v': 10, 'a': 1000}):
+      parsed = parse_meter_values(values)
+    self.assertEquals((parsed.station_id, parsed.volts, parsed.amps, parsed.power_factor), ('12345', 1201, -500, 99))
+    for (param, value) in (('w', '1O'), ('wh', '2147483648'), ('id', '../x'), ('v', '')):
+      self.assertRaises(MeterParseError, parse_meter_values, dict(self.values, **{param: value}))
+    self.assertRaises(MeterParseError, parse_meter_values, dict([(k, v) for (k, v) in self.values.items() if k != 'pcy']))
+
+  def test_record_queries(self):
+    with self.settings(USE_ROLLUPS=False, USE_LEADERBOARD=False, SEGMENT_ROOT=None, INGEST_MODE='direct'):
+      self.client.post('/powermon/record/', self.values)
+      with self.assertNumQueries(2):
+        response = self.client.post('/powermon/record/', self.values)
+    self.assertEquals(response.status_code, 200)
+    self.assertEquals(Reading.objects.count(), 2)
+
+  def test_record_malformed(self):
+    with self.assertNumQueries(0):
+      response = self.client.post('/powermon/record/', dict(self.values, w='ten'))
+    self.assertEquals(response.status_code, 400)
+    item = dict(self.values, ts='2012-01-01T13:00:00')
+    response = self.client.post('/powermon/record/batch/', json.dumps([item, dict(item, ts='noon')]), content_type='application/json')
+    self.assertEquals(response.status_code, 400)
+    self.assertEquals(Reading.objects.count(), 0)
+
+  def test_buffer_flushes_on_size(self):
+    buffer = ReadingBuffer(2, 60)
+    buffer.add(build_reading(self.station, parse_meter_values(self.values), '127.0.0.1', datetime.today()))
+    self.assertEquals(buffer.pending(), 1)
+    self.assertEquals(Reading.objects.count(), 0)
+    buffer.add(build_reading(self.station, parse_meter_values(self.values), '127.0.0.1', datetime.today()))
+    self.assertEquals(buffer.pending(), 0)
+    self.assertEquals(Reading.objects.count(), 2)
+
+  def test_buffer_flush(self):
+    buffer = ReadingBuffer(100, 60)
+    buffer.add(build_reading(self.station, parse_meter_values(self.values), '127.0.0.1', datetime.today()))
+    self.assertEquals(buffer.flush(), 1)
+    self.assertEquals(buffer.flush(), 0)
+    self.assertEquals(Reading.objects.count(), 1)
+
+
+class RegistryTest(TestCase):
+  def setUp(self):
+    Station.objects.create(id='1', name='one')
+    Station.objects.create(id='2', name='two', enabled=False)
+    self.registry = StationRegistry(300)
+
+  def test_get(self):
+    self.assertEquals(self.registry.get('1').name, 'one')
+    self.assertEquals(self.registry.get_by_name('two').id, '2')
+    self.assertRaises(Station.DoesNotExist, self.registry.get, '3')
+
+  def test_enabled(self):
+    self.assertEquals([s.id for s in self.registry.enabled()], ['1'])
+
+  def test_counters(self):
+    self.registry.get('1')
+    self.registry.get('1')
+    self.registry.in_bulk(['1', '2'])
+    stats = self.registry.stats()
+    self.assertEquals(stats['misses'], 1)
+    self.assertEquals(stats['hits'], 2)
+    self.assertEquals(stats['size'], 2)
+
+  def test_missing_cached(self):
+    self.registry.in_bulk(['1'])
+    for i in range(3):
+      self.assertRaises(Station.DoesNotExist, self.registry.get, '3')
+    stats = self.registry.stats()
+    self.assertEquals((stats['hits'], stats['misses']), (2, 2))
+    Station.objects.create(id='3', name='three')
+    self.registry.invalidate()
+    self.assertEquals(self.registry.get('3').name, 'three')
+
+  def test_invalidated_on_save(self):
+    self.assertEquals(registry.get('1').name, 'one')
+    station = Station.objects.get(id='1')
+    station.name = 'uno'
+    station.save()
+    self.assertEquals(registry.get('1').name, 'uno')
+
+
+class StatusTest(TestCase):
+  def setUp(self):
+    one = Station.objects.create(id='1', name='one')
+    Station.objects.create(id='2', name='two')
+    self.now = datetime(2012, 1, 1, 12, 0)
+    self.readings = create_readings(one, self.now - timedelta(minutes=1), timedelta(seconds=10), [(1, 1)] * 3)
+    monitor.views._status_cache.clear()
+
+  def get(self, url):
+    with self.settings(NOW=self.now, STATUS_CACHE_SECONDS=0):
+      return self.client.get(url, **{'wsgi.url_scheme': 'https'})
+
+  def test_status_no_data(self):
+    response = self.get('/powermon/status/')
+    self.assertEquals(response.status_code, 500)
+    self.assertTrue(response.content.startswith('ERROR'))
+
+  def test_status_warn(self):
+    Reading.objects.bulk_create(self.readings)
+    response = self.get('/powermon/status/')
+    self.assertEquals(response.status_code, 306)
+    self.assertTrue('one                       3' in response.content)
+
+  def test_status_json(self):
+    Reading.objects.bulk_create(self.readings)
+    response = self.get('/powermon/status/json/')
+    self.assertEquals(response.status_code, 306)
+    data = json.loads(response.content)
+    self.assertEquals(data['status'], 'WARN')
+    self.assertEquals(data['stations'][0]['count'], 3)
+    self.assertEquals(data['stations'][0]['last_seen'], '2012-01-01T11:59:20')
+    self.assertEquals(data['stations'][1]['last_seen'], None)
+
+  def test_status_cached(self):
+    with self.settings(NOW=self.now, STATUS_CACHE_SECONDS=60):
+      self.assertEquals(station_status()['code'], 500)
+      Reading.objects.bulk_create(self.readings)
+      self.assertEquals(station_status()['code'], 500)
+
+
+def create_readings(station, start, delta, data):
+  """Creates one reading for each (watts, watt_hours) tuple in data spaced delta apart starting at start."""
+  readings = []
+  timestamp = start
+  for datum in data:
+    readings.append(Reading(
+      station=station,
+      timestamp=timestamp,
+      watts=datum[0],
+      volts=120,
+      amps=1,
+      watt_hours=datum[1],
+      power_factor=0,
+      volt_amps=0))
+    timestamp += delta
+  return readings
+
+
+def login_with_data_access(client):
+  """Logs the test client in as a new user with the monitor.data_access permission."""
+  user = User.objects.create_user('tester', 'tester@example.com', 'secret')
+  user.user_permissions.add(Permission.objects.get(codename='data_access'))
+  client.login(username='tester', password='secret')
+
+
+class RollupTest(TestCase):
+  def setUp(self):
+    self.station = Station.objects.create(id='12345', name='test')
+    self.start = datetime(2012, 1, 1, 13, 0, 30)
+    self.readings = create_readings(self.station, self.start, timedelta(seconds=20),
+      ((10, 1000), (20, 1001), (30, 1002), (40, 1003)))
+
+  def test_store_readings(self):
+    store_readings(self.readings[:2])
+    store_readings(self.readings[2:])
+    minutes = Rollup.objects.filter(resolution='m').order_by('timestamp')
+    self.assertEquals([r.count for r in minutes], [2, 2])
+    self.assertEquals(minutes[1].watts_min, 30)
+    hour = Rollup.objects.get(resolution='h')
+    self.assertEquals(hour.count, 4)
+    self.assertEquals(hour.watts_max, 40)
+    self.assertEquals(hour.watts_mean(), 25)
+    self.assertEquals(hour.watt_hours_first, 1000)
+    self.assertEquals(hour.watt_hours_last, 1003)
+    self.assertEquals(Rollup.objects.get(resolution='d').timestamp, datetime(2012, 1, 1))
+
+  def test_disabled(self):
+    with self.settings(USE_ROLLUPS=False):
+      store_readings(self.readings)
+    self.assertEquals(Rollup.objects.count(), 0)
+
+  def test_concurrent_insert(self):
+    # Another transaction inserted the hour and day buckets after update_rollups found none
+    Rollup.objects.bulk_create(accumulate(reading_rows(self.readings[:2])).values())
+    create_or_merge(Rollup, accumulate(reading_rows(self.readings[2:])).values(), rollup_key, merge)
+    minutes = Rollup.objects.filter(resolution='m').order_by('timestamp')
+    self.assertEquals([r.count for r in minutes], [2, 2])
+    self.assertEquals(Rollup.objects.get(resolution='h').count, 4)
+    self.assertEquals(Rollup.objects.get(resolution='d').watt_hours_last, 1003)
+
+  def test_buildrollups(self):
+    Reading.objects.bulk_create(self.readings)
+    call_command('buildrollups', station='12345', stdout=StringIO())
+    self.assertEquals(Rollup.objects.count(), 4)
+    self.assertEquals(Rollup.objects.get(resolution='d').watts_sum, 100)
+
+  def test_select_resolution(self):
+    self.assertEquals(select_resolution(timedelta(hours=1)), None)
+    self.assertEquals(select_resolution(timedelta(hours=24)), 'm')
+    self.assertEquals(select_resolution(timedelta(days=7)), 'h')
+
+  def test_rollup_timeseries(self):
+    store_readings(self.readings)
+    rollups = get_rollups('12345', 'm', self.start, self.start + timedelta(minutes=2))
+    series = rollup_timeseries(rollups, 'watts', 'watt_hours')
+    t = epoch(datetime(2012, 1, 1, 13, 0))
+    self.assertEquals(series[0], [(t, 15), (t + 60000, 35)])
+    self.assertEquals(series[1], [(t, 1001), (t + 60000, 1003)])
+
+  def test_station_energy(self):
+    store_readings(self.readings)
+    stations = station_energy(None, self.start + timedelta(days=1))
+    self.assertEquals([(s.power_max, s.power_min) for s in stations], [(1003, 1000)])
+
+
+class DownsampleTest(TestCase):
+  def setUp(self):
+    self.series = [(i * 1000, (i % 10) * (i % 7)) for i in range(1000)]
+
+  def test_short_series_unchanged(self):
+    self.assertEquals(downsample(self.series[:50], 100), self.series[:50])
+
+  def test_lttb(self):
+    result = downsample(self.series, 100, 'lttb')
+    self.assertEquals(len(result), 100)
+    self.assertEquals(result[0], self.series[0])
+    self.assertEquals(result[-1], self.series[-1])
+    self.assertEquals(result, sorted(result))
+
+  def test_minmax(self):
+    series = [(i, 0) for i in range(1000)]
+    series[500] = (500, 99)
+    result = downsample(series, 100, 'minmax')
+    self.assertTrue(len(result) <= 100)
+    self.assertTrue((500, 99) in result)
+
+  def test_invalid_mode(self):
+    self.assertRaises(ValueError, downsample, self.series, 100, 'bogus')
+
+
+class FlotseriesTest(TestCase):
+  def setUp(self):
+    login_with_data_access(self.client)
+    self.station = Station.objects.create(id='12345', name='test')
+    self.end = datetime(2012, 1, 1, 13, 0)
+    data = [(i % 50, 1000 + i) for i in range(600)]
+    Reading.objects.bulk_create(create_readings(self.station, self.end - timedelta(minutes=10), timedelta(seconds=1), data))
+    cache.clear()
+
+  def get(self, url, **params):
+    with self.settings(NOW=self.end, USE_ROLLUPS=False):
+      return self.client.get(url, params, **{'wsgi.url_scheme': 'https'})
+
+  def test_downsampled(self):
+    response = self.get('/powermon/flotseries/12345/watts/1h/', points=50)
+    self.assertEquals(response.status_code, 200)
+    data = json.loads(response.content)
+    self.assertEquals(data[0]['label'], 'watts - test')
+    self.assertEquals(len(data[0]['data']), 50)
+
+  def test_bad_mode(self):
+    self.assertEquals(self.get('/powermon/flotseries/12345/watts/1h/', mode='bogus').status_code, 400)
+
+  def test_bad_points(self):
+    for points in (2, 0, -1):
+      self.assertEquals(self.get('/powermon/flotseries/12345/watts/1h/', points=points).status_code, 400)
+
+  def test_stream_identical(self):
+    with self.settings(FLOT_MAX_POINTS=None):
+      expected = self.get('/powermon/flotseries/12345/watts|watt_hours/1h/').content
+    streamed = self.get('/powermon/flotseries/12345/watts|watt_hours/1h/', stream=1).content
+    self.assertEquals(len(json.loads(streamed)[1]['data']), 600)
+    self.assertEquals(streamed, expected)
+
+  def test_state_variables(self):
+    StationState.objects.create(station=self.station, timestamp=datetime(2012, 1, 1, 12, 55),
+      ip_address='127.0.0.1', frequency=60, relay_status=1, power_cycle=7)
+    with self.settings(FLOT_MAX_POINTS=None):
+      expected = self.get('/powermon/flotseries/12345/watts|power_cycle/1h/').content
+    streamed = self.get('/powermon/flotseries/12345/watts|power_cycle/1h/', stream=1).content
+    self.assertEquals(streamed, expected)
+    cycles = [v for (t, v) in json.loads(expected)[1]['data']]
+    self.assertEquals((cycles.count(-1), cycles.count(7)), (300, 300))
+    self.assertEquals(self.get('/powermon/flotseries/12345/ip_address/1h/').status_code, 400)
+
+
+  def test_historical_cached(self):
+    url = '/powermon/flotseries/12345/watts/1h/2012-01-01T12:54:00/'
+    response = self.get(url)
+    self.assertEquals(response.status_code, 200)
+    self.assertTrue(response.has_header('Last-Modified'))
+    Reading.objects.all().delete()
+    self.assertEquals(self.get(url).content, response.content)
+    with self.settings(NOW=self.end):
+      conditional = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'], **{'wsgi.url_scheme': 'https'})
+    self.assertEquals(conditional.status_code, 304)
+
+  def test_recent_not_immutable(self):
+    with self.settings(INGEST_LAG_SECONDS=600):
+      response = self.get('/powermon/flotseries/12345/watts/1h/2012-01-01T12:54:00/')
+    self.assertFalse(response.has_header('Last-Modified'))
+    self.assertTrue('max-age=10' in response['Cache-Control'])
+    request = RequestFactory().get('/')
+    self.assertEquals(monitor.views.cached_response(request, u'caf\xe9', lambda: '[]', 10, None).content, '[]')
+
+  def test_live_aligned(self):
+    with self.settings(FLOTSERIES_LIVE_CACHE_SECONDS=60):
+      response = self.get('/powermon/flotseries/12345/watts/1h/')
+    self.assertFalse(response.has_header('Last-Modified'))
+    self.assertTrue('max-age=60' in response['Cache-Control'])
+    self.assertEquals(align_time(datetime(2012, 1, 1, 13, 0, 59, 5), 60), datetime(2012, 1, 1, 13, 0))
+
+  def test_since(self):
+    since = epoch(datetime(2012, 1, 1, 12, 59, 50))
+    response = self.get('/powermon/flotseries/12345/watts/1h/', since=since)
+    self.assertEquals(response.status_code, 200)
+    data = json.loads(response.content)[0]['data']
+    self.assertEquals(len(data), 9)
+    self.assertEquals(data[0][0], since + 1000)
+    self.assertEquals(self.get('/powermon/flotseries/12345/watts/1h/', since='soon').status_code, 400)
+    self.assertEquals(self.get('/powermon/flotseries/12345/watts/1h/', since=10 ** 20).status_code, 400)
+    with self.settings(INGEST_LAG_SECONDS=5):
+      data = json.loads(self.get('/powermon/flotseries/12345/watts/1h/', since=since).content)[0]['data']
+    self.assertEquals(data[0][0], since - 4000)
+    data = json.loads(self.get('/powermon/flotseries/12345/watts/1h/', since=0, points=50).content)[0]['data']
+    self.assertEquals(len(data), 50)
+
+
+  def test_multiple_stations(self):
+    for (station_id, offset) in (('2', 7), ('3', 13)):
+      station = Station.objects.create(id=station_id, name='test' + station_id)
+      data = [((i + offset) % 50, 2000 + i) for i in range(300)]
+      Reading.objects.bulk_create(create_readings(station, self.end - timedelta(minutes=5), timedelta(seconds=1), data))
+    expected = []
+    for station_id in ('3', '12345', '2'):
+      expected += json.loads(self.get('/powermon/flotseries/%s/watts|amps/1h/' % station_id).content)
+    cache.clear()
+    self.get('/powermon/flotseries/12345/watts|amps/1h/')
+    single = len(connection.queries)
+    cache.clear()
+    response = self.get('/powermon/flotseries/3|12345|2/watts|amps/1h/')
+    self.assertEquals(len(connection.queries), single)
+    self.assertEquals(json.loads(response.content), expected)
+
+  def test_station_columns(self):
+    readings = get_station_readings(['12345', 'none'], self.end - timedelta(hours=1), self.end)
+    data = station_columns(readings, ['12345', 'none'], 'timestamp', 'watts')
+    self.assertEquals(len(data['none']['watts']), 0)
+    self.assertEquals(list(data['12345']['watts'][:3]), [0, 1, 2])
+    self.assertTrue((np.diff(data['12345']['timestamp']) > 0).all())
+
+
+class ColumnarAnalysisTest(TestCase):
+  def setUp(self):
+    self.station = Station.objects.create(id='12345', name='test')
+    start = datetime(2012, 1, 1, 13, 0, 0, 250000)
+    data = [((i * 37) % 500, 1000 + i * 3) for i in range(3 * 3600 // 7)]
+    Reading.objects.bulk_create(create_readings(self.station, start, timedelta(seconds=7, microseconds=3), data))
+    self.readings = get_readings('12345', start, start + timedelta(hours=4))
+
+  def legacy_energy_timeseries(self, readings):
+    series = []
+    current = readings[0]
+    for reading in readings:
+      if reading.timestamp - current.timestamp >= timedelta(hours=1):
+        series.append((epoch(reading.timestamp), reading.watt_hours - current.watt_hours))
+        current = reading
+    return series
+
+  def test_timeseries(self):
+    expected = [(epoch(r.timestamp), r.watts) for r in self.readings]
+    self.assertEquals(timeseries(self.readings, 'watts')[0], expected)
+    self.assertEquals(timeseries(list(self.readings), 'watts')[0], expected)
+
+  def test_energy_timeseries(self):
+    expected = self.legacy_energy_timeseries(list(self.readings))
+    self.assertEquals(len(expected), 2)
+    self.assertEquals(energy_timeseries(self.readings), expected)
+
+  def test_empty(self):
+    readings = get_readings('12345', datetime(2000, 1, 1), datetime(2000, 1, 2))
+    self.assertEquals(timeseries(readings, 'watts', 'volts'), [[], []])
+    self.assertEquals(energy_timeseries(readings), [])
+
+
+class UsageSummaryTest(TestCase):
+  def test_matches_legacy(self):
+    station = Station.objects.create(id='12345', name='test')
+    end = datetime(2012, 1, 1)
+    start = end - timedelta(hours=6)
+    populate(station, start, end, interval=10)
+    readings = get_readings('12345', start, end)
+    summary = usage_summary(readings)
+    legacy = legacy_usage_summary(readings)
+    for key in ('count', 'median_kwh_day', 'kwh_tot', 'w_max', 'w_min'):
+      self.assertEquals(summary[key], legacy[key])
+
+  def test_no_readings(self):
+    self.assertEquals(usage_summary(get_readings('12345', datetime(2012, 1, 1), datetime(2012, 1, 2))), None)
+
+
+class BenchmarkSuiteTest(TestCase):
+  def test_suite(self):
+    end = datetime(2012, 1, 1)
+    (stations, count) = populate_stations(2, end - timedelta(days=2), end, 600)
+    self.assertEquals(count, 576)
+    self.assertEquals(Rollup.objects.filter(station=stations[1]).count() > 0, True)
+    with self.settings(NOW=end):
+      results = run_suite(benchmark_suite(stations, end, ['1d']), repeat=1)
+    for name in ('columns/1d', 'energy_timeseries/1d', 'usage_summary/1d', 'view:flotseries/1d'):
+      self.assertEquals(results[name]['readings'], 144)
+      self.assertEquals('seconds' in results[name], True)
+
+  def test_compare(self):
+    baseline = {'a': {'seconds': 1.0}, 'b': {'seconds': 1.0}, 'c': {'error': 'failed'}, 'e': {'seconds': 1.0},
+      'f': {'seconds': 1.0}}
+    results = {'a': {'seconds': 1.2}, 'b': {'seconds': 1.3}, 'c': {'seconds': 5.0}, 'd': {'seconds': 5.0},
+      'f': {'error': 'ValueError: failed'}}
+    self.assertEquals(compare_results(results, baseline, 0.25), [
+      ('b', '1.0000s -> 1.3000s'), ('e', 'missing from results'), ('f', 'ValueError: failed')])
+
+
+def query_plan(queryset):
+  """Returns the SQLite query plan of a queryset as a single string."""
+  (sql, params) = queryset.query.sql_with_params()
+  cursor = connection.cursor()
+  cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+  return '\n'.join([row[-1] for row in cursor.fetchall()])
+
+
+class QueryPlanTest(TransactionTestCase):
+  # EXPLAIN implicitly commits under the sqlite3 module, so the data cannot live in a rolled back transaction
+  def setUp(self):
+    station = Station.objects.create(id='12345', name='test')
+    Reading.objects.bulk_create(create_readings(station, datetime(2012, 1, 1), timedelta(seconds=1),
+      [(i, i) for i in range(100)]))
+    self.start = datetime(2012, 1, 1)
+    self.end = datetime(2012, 1, 2)
+
+  def assertUsesIndex(self, queryset, index):
+    plan = query_plan(queryset)
+    self.assertTrue(index in plan, 'Expected %s in query plan:\n%s' % (index, plan))
+
+  def test_get_readings(self):
+    self.assertUsesIndex(get_readings('12345', self.start, self.end), 'monitor_reading_station_timestamp')
+
+  def test_get_readings_columns(self):
+    readings = get_readings('12345', self.start, self.end).values_list('timestamp', 'watts')
+    self.assertUsesIndex(readings, 'COVERING INDEX monitor_reading_station_timestamp')
+
+  def test_leaders(self):
+    with self.settings(USE_ROLLUPS=False):
+      # Either the timestamp or the composite index is a reasonable choice depending on the window
+      self.assertUsesIndex(leader_stations(self.start, self.end), 'SEARCH monitor_reading USING')
+      self.assertFalse('SCAN monitor_reading' in query_plan(leader_stations(self.start, self.end)))
+
+  def test_leaders_rollups(self):
+    with self.settings(USE_ROLLUPS=True):
+      self.assertUsesIndex(leader_stations(self.start, self.end), 'SEARCH monitor_rollup USING')
+
+  def test_station_status(self):
+    self.assertUsesIndex(status_counts(self.start, self.end), 'SEARCH monitor_reading USING')
+    self.assertFalse('SCAN monitor_reading' in query_plan(status_counts(self.start, self.end)))
+
+
+class LeaderboardTest(TestCase):
+  def setUp(self):
+    self.end = datetime(2012, 1, 10, 12, 0)
+    self.stations = [Station.objects.create(id=str(i), name='station %s' % i) for i in range(3)]
+
+  def record(self, station, start, data, power_cycle=0):
+    readings = create_readings(station, start, timedelta(minutes=10), data)
+    for r in readings:
+      (r.ip_address, r.frequency, r.relay_status, r.power_cycle) = ('127.0.0.1', 60, 0, power_cycle)
+    store_readings(readings)
+
+  def test_matches_annotate(self):
+    # Hourly readings over 35 days with no consumption around the window edges at noon, where the
+    # leaderboard and the annotate-based computation legitimately differ by the energy of one interval
+    start = self.end - timedelta(days=35, minutes=-30)
+    for (i, station) in enumerate(self.stations):
+      watt_hours = 1000 * i
+      readings = []
+      for hour in range(35 * 24):
+        timestamp = start + timedelta(hours=hour)
+        if not 10 <= timestamp.hour <= 13:
+          watt_hours += 100 * (i + 1) + hour % 7 * 13
+        readings.extend(create_readings(station, timestamp, timedelta(0), [(0, watt_hours)]))
+      store_readings(readings)
+    states = dict([(s.station_id, s) for s in leaderboard(self.end)])
+    with self.settings(USE_ROLLUPS=False):
+      for (period, attribute) in (('24h', 'day'), ('7d', 'week'), ('30d', 'month'), (None, 'total')):
+        for station in leader_stations(period and self.end - parse_period(period), self.end):
+          expected = (station.power_max - station.power_min) / 1000
+          self.assertEquals(getattr(states[station.id], attribute) / 1000, expected, '%s %s' % (station, period))
+
+  def test_power_cycle(self):
+    start = self.end - timedelta(hours=1)
+    self.record(self.stations[0], start, [(0, 100), (0, 110)], power_cycle=1)
+    self.record(self.stations[0], start + timedelta(minutes=20), [(0, 5), (0, 8)], power_cycle=2)
+    state = EnergyState.objects.get(station=self.stations[0])
+    self.assertEquals(state.total, 18)
+    self.assertEquals(state.day, 18)
+
+  def test_advance(self):
+    self.record(self.stations[0], self.end - timedelta(days=2), [(0, 100), (0, 150)])
+    self.record(self.stations[0], self.end - timedelta(hours=1), [(0, 200), (0, 210)])
+    state = EnergyState.objects.get(station=self.stations[0])
+    self.assertEquals((state.day, state.week, state.total), (110, 110, 110))
+    advance(state, self.end)
+    state = EnergyState.objects.get(station=self.stations[0])
+    self.assertEquals((state.day, state.week, state.total), (60, 110, 110))
+
+  def test_advance_stale(self):
+    self.record(self.stations[0], self.end - timedelta(days=2), [(0, 100), (0, 150)])
+    stale = EnergyState.objects.get(station=self.stations[0])
+    self.record(self.stations[0], self.end - timedelta(hours=1), [(0, 200), (0, 210)])
+    advance(stale, self.end)
+    state = EnergyState.objects.get(station=self.stations[0])
+    self.assertEquals((state.day, state.week, state.total, state.last_watt_hours), (60, 110, 110, 210))
+    self.assertEquals((stale.day, stale.total), (60, 110))
+
+  def test_rebuild(self):
+    self.record(self.stations[0], self.end - timedelta(days=2), [(0, 100), (0, 150)])
+    self.record(self.stations[0], self.end - timedelta(hours=1), [(0, 200), (0, 210)])
+    advance(EnergyState.objects.get(station=self.stations[0]), self.end)
+    expected = EnergyState.objects.get(station=self.stations[0])
+    with self.settings(NOW=self.end):
+      call_command('buildleaders', stdout=StringIO())
+    state = EnergyState.objects.get(station=self.stations[0])
+    self.assertEquals((state.day, state.week, state.total), (expected.day, expected.week, expected.total))
+    self.assertEquals(EnergyBucket.objects.count(), 2)
+
+  def test_disabled(self):
+    with self.settings(USE_LEADERBOARD=False):
+      self.record(self.stations[0], self.end - timedelta(hours=1), [(0, 100), (0, 110)])
+    self.assertEquals((EnergyState.objects.count(), EnergyBucket.objects.count()), (0, 0))
+
+  def test_rebuild_power_cycle(self):
+    start = self.end - timedelta(hours=1)
+    self.record(self.stations[0], start, [(0, 100), (0, 110)], power_cycle=1)
+    self.record(self.stations[0], start + timedelta(minutes=20), [(0, 5), (0, 8)], power_cycle=2)
+    rebuild_leaderboard(self.stations[0], self.end)
+    self.assertEquals(EnergyState.objects.get(station=self.stations[0]).total, 18)
+
+
+class EventTest(TestCase):
+  def setUp(self):
+    self.station = Station.objects.create(id='12345', name='test')
+    self.readings = create_readings(self.station, datetime(2012, 1, 1, 13, 0), timedelta(seconds=1), [(10, 1), (20, 2)])
+
+  def test_coalesced(self):
+    broker = LocalBroker()
+    subscription = broker.subscribe(['12345'])
+    other = broker.subscribe(['other'])
+    broker.publish([reading_event(r) for r in self.readings])
+    events = subscription.get(0)
+    self.assertEquals(len(events), 1)
+    self.assertEquals(events[0]['watts'], 20)
+    self.assertEquals(subscription.dropped, 1)
+    self.assertEquals(other.get(0), [])
+
+  def test_sqlite_broker(self):
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      broker = SQLiteBroker(path, poll=0.01)
+      subscription = broker.subscribe(['12345'])
+      SQLiteBroker(path).publish([reading_event(self.readings[0])])
+      self.assertEquals(subscription.get(5)[0]['watts'], 10)
+      tailer = broker.tailer
+      broker.unsubscribe(subscription)
+      tailer.join(5)
+      self.assertEquals(broker.tailer, None)
+    finally:
+      os.remove(path)
+
+  def test_stream(self):
+    login_with_data_access(self.client)
+    with self.settings(EVENT_BROKER='local', EVENT_HEARTBEAT_SECONDS=0.05, EVENT_STREAM_SECONDS=0.2):
+      response = self.client.get('/powermon/events/12345/', **{'wsgi.url_scheme': 'https'})
+      self.assertEquals(response['Content-Type'], 'text/event-stream')
+      store_readings(self.readings)
+      content = response.content
+    self.assertTrue('event: reading\ndata: {' in content)
+    self.assertTrue('"watts": 20' in content)
+    self.assertTrue(': heartbeat' in content)
+
+
+class ExportTest(TestCase):
+  def setUp(self):
+    self.station = Station.objects.create(id='12345', name='test')
+    self.start = datetime(2012, 1, 1, 13, 0, 0, 500000)
+    data = [((i * 37) % 500, 2 ** 31 - 100 + i) for i in range(250)]
+    Reading.objects.bulk_create(create_readings(self.station, self.start, timedelta(seconds=1), data))
+    self.end = self.start + timedelta(hours=1)
+
+  def export(self, format, **kwargs):
+    return ''.join(export_chunks('12345', self.start, self.end, format, **kwargs))
+
+  def test_command_bad_time(self):
+    options = {'station': '12345', 'format': 'csv', 'fields': None, 'start': 'yesterday', 'end': None}
+    self.assertRaises(CommandError, exportreadings.Command().handle, **options)
+
+  def test_binary_round_trip(self):
+    expected = columns(get_readings('12345', self.start, self.end), 'timestamp', *EXPORT_FIELDS)
+    for (delta, compress) in ((True, True), (False, False)):
+      decoded = read_binary(StringIO(self.export('bin', delta=delta, compress=compress)))
+      self.assertEquals(sorted(decoded.keys()), sorted(expected.keys()))
+      for field in expected:
+        self.assertEquals(decoded[field].tolist(), expected[field].tolist())
+
+  def test_binary_chunked(self):
+    chunks = fetch_chunks('12345', self.start, self.end, ('watts',), chunk_size=100)
+    decoded = read_binary(StringIO(''.join(binary_chunks(chunks, ('watts',)))))
+    self.assertEquals(len(decoded['watts']), 250)
+    self.assertEquals(decoded['watts'][-1], (249 * 37) % 500)
+
+  def test_text_formats(self):
+    lines = self.export('csv', fields=('watts',)).splitlines()
+    self.assertEquals(lines[0], 'timestamp,watts')
+    self.assertEquals(lines[2], '2012-01-01T13:00:01.500000,37')
+    self.assertEquals(len(lines), 251)
+    lines = self.export('ndjson').splitlines()
+    self.assertEquals(json.loads(lines[1])['watts'], 37)
+    self.assertEquals(len(lines), 250)
+
+  def test_view(self):
+    login_with_data_access(self.client)
+    response = self.client.get(
+      '/powermon/export/12345/csv/',
+      {'start': '2012-01-01T13:00:00', 'end': '2012-01-01T14:00:00', 'fields': 'watts|volts'},
+      **{'wsgi.url_scheme': 'https'})
+    self.assertEquals(response['Content-Type'], 'text/csv')
+    self.assertEquals(len(response.content.splitlines()), 251)
+    response = self.client.get('/powermon/export/12345/csv/', {'fields': 'ip_address'}, **{'wsgi.url_scheme': 'https'})
+    self.assertEquals(response.status_code, 400)
+
+
+class ArchiveTest(TransactionTestCase):
+  def setUp(self):
+    self.station = Station.objects.create(id='12345', name='test')
+    self.start = datetime(2012, 1, 31, 12, 0)
+    data = [(i % 50, 1000 + i) for i in range(24 * 60)]
+    Reading.objects.bulk_create(create_readings(self.station, self.start, timedelta(minutes=1), data))
+    self.end = self.start + timedelta(days=1)
+
+  def tearDown(self):
+    cursor = connection.cursor()
+    for archive in ReadingArchive.objects.all():
+      cursor.execute('DROP TABLE %s' % archive.table)
+
+  def test_archive_month(self):
+    expected = columns(get_readings('12345', self.start, self.end), 'timestamp', 'watts', 'watt_hours')
+    self.assertEquals(archive_month(datetime(2012, 1, 1)), 720)
+    self.assertEquals(Reading.objects.count(), 720)
+    self.assertEquals(ReadingArchive.objects.get(month=datetime(2012, 1, 1)).table, 'monitor_reading_201201')
+    self.assertEquals(Rollup.objects.get(resolution='d', timestamp=datetime(2012, 1, 31)).count, 720)
+    readings = get_readings('12345', self.start, self.end)
+    self.assertTrue(isinstance(readings, ReadingSet))
+    actual = columns(readings, 'timestamp', 'watts', 'watt_hours')
+    for field in expected:
+      self.assertEquals(actual[field].tolist(), expected[field].tolist())
+    self.assertEquals(readings.aggregate(Count('id'), Max('watt_hours'))['id__count'], 1440)
+    self.assertEquals(readings.aggregate(Max('watt_hours'))['watt_hours__max'], 1000 + 24 * 60 - 1)
+    self.assertEquals(len(''.join(export_chunks('12345', self.start, self.end, 'csv')).splitlines()), 1441)
+    self.assertEquals(usage_summary(readings)['w_max'], 49)
+
+  def test_command(self):
+    call_command('archivereadings', days=31, stdout=StringIO())
+    self.assertEquals(Reading.objects.count(), 0)
+    self.assertEquals(ReadingArchive.objects.count(), 2)
+    self.assertEquals(get_readings('12345', self.start, self.end).count(), 1440)
+
+  def test_leader_stations(self):
+    archive_month(datetime(2012, 1, 1))
+    with self.settings(USE_ROLLUPS=False):
+      (station,) = leader_stations(None, self.end)
+    self.assertEquals((station.power_min, station.power_max), (1000, 1000 + 24 * 60 - 1))
+
+
+class SegmentTest(TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.station = Station.objects.create(id='12345', name='test')
+    self.start = datetime(2012, 1, 1, 23, 0, 0, 250000)
+    data = [((i * 37) % 500 - 100, 2 ** 31 - 1000 + i) for i in range(7200)]
+    self.readings = create_readings(self.station, self.start, timedelta(seconds=1), data)
+    self.end = self.start + timedelta(hours=2)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def assertArraysEqual(self, actual, expected):
+    self.assertEquals(sorted(actual.keys()), sorted(expected.keys()))
+    for field in expected:
+      self.assertEquals(actual[field].tolist(), expected[field].tolist())
+
+  def test_append(self):
+    with self.settings(SEGMENT_ROOT=self.root):
+      store_readings(self.readings[3600:])
+      store_readings(self.readings[:3600])
+      actual = get_reading_arrays('12345', self.start, self.end, 'timestamp', 'watts', 'watt_hours')
+      names = [n for n in os.listdir(os.path.join(self.root, '12345')) if not n.endswith('.lock')]
+      self.assertEquals(sorted(names), ['20120101.seg', '20120102.seg'])
+    expected = columns(get_readings('12345', self.start, self.end), 'timestamp', 'watts', 'watt_hours')
+    self.assertArraysEqual(actual, expected)
+
+  def test_compact_and_bounded_range(self):
+    with self.settings(SEGMENT_ROOT=self.root):
+      for i in range(200):
+        store_readings(self.readings[i:i + 1])
+      path = segment_path('12345', self.start)
+      # A stale compaction offset that does not start a block is ignored
+      with open(path + '.lock', 'w') as f:
+        f.write('%d 3\n' % (SEGMENT_COMPACT_BLOCKS - 1))
+      store_readings(self.readings[200:201])
+      with open(path) as f:
+        extents = block_extents(f.read())
+      self.assertFalse(os.path.exists(path + '.tmp'))
+      actual = get_reading_arrays('12345', datetime(1970, 1, 1), self.end, 'timestamp', 'watts', 'watt_hours')
+      self.assertEquals(segment_days('12345', datetime(1970, 1, 1).date(), self.end.date()), [self.start.date()])
+    self.assertTrue(len(extents) < SEGMENT_COMPACT_BLOCKS)
+    self.assertEquals(sum([rows for (offset, end, rows) in extents]), 201)
+    expected = columns(self.readings[:201], 'timestamp', 'watts', 'watt_hours')
+    self.assertArraysEqual(actual, expected)
+
+  def test_rebuild_and_truncated(self):
+    Reading.objects.bulk_create(self.readings)
+    with self.settings(SEGMENT_ROOT=self.root):
+      self.assertEquals(rebuild_segment('12345', datetime(2012, 1, 2).date()), 3600)
+      store_readings(create_readings(self.station, self.end, timedelta(seconds=1), [(1, 1)]))
+      path = segment_path('12345', datetime(2012, 1, 2))
+      with open(path, 'ab') as f:
+        f.write(encode_block(columns(self.readings[:10], 'timestamp', *SEGMENT_FIELDS))[:-5])
+      start = datetime(2012, 1, 2)
+      actual = reading_data('12345', start, self.end + timedelta(seconds=1), 'watts')
+      summary = usage_summary(reading_data('12345', start, self.end, 'watts', 'watt_hours'))
+    expected = columns(get_readings('12345', start, self.end + timedelta(seconds=1)), 'timestamp', 'watts')
+    self.assertArraysEqual(actual, expected)
+    self.assertEquals(len(actual['watts']), 3601)
+    self.assertEquals(summary['w_min'], -100)
+    self.assertEquals(summary['count'], 3601)
+
+
+class StateTest(TestCase):
+  def setUp(self):
+    self.station = Station.objects.create(id='12345', name='test')
+    self.start = datetime(2012, 1, 1, 13, 0)
+    self.values = {
+      'id': '12345', 'w': '10', 'v': '120', 'a': '1', 'wh': '1000',
+      'pf': '99', 'frq': '60', 'va': '12', 'rnc': '0', 'pcy': '1'
+    }
+
+  def record(self, seconds, ip_address, **values):
+    params = dict(self.values)
+    params.update(values)
+    store_readings([build_reading(self.station, parse_meter_values(params), ip_address, self.start + timedelta(seconds=seconds))])
+
+  def test_changes_recorded(self):
+    self.record(0, '10.0.0.1')
+    self.record(1, '10.0.0.1')
+    self.record(2, '10.0.0.1', rnc='1')
+    self.record(3, '10.0.0.2', rnc='1')
+    states = StationState.objects.order_by('timestamp')
+    self.assertEquals([s.relay_status for s in states], [0, 1, 1])
+    self.assertEquals([s.ip_address for s in states], ['10.0.0.1', '10.0.0.1', '10.0.0.2'])
+    self.assertEquals(state_at('12345', self.start + timedelta(seconds=1)).timestamp, self.start)
+
+  def test_rejoin(self):
+    Reading.objects.bulk_create(create_readings(self.station, self.start - timedelta(seconds=1), timedelta(0), [(1, 1)]))
+    self.record(0, '10.0.0.1')
+    self.record(1, '10.0.0.1', pcy='2')
+    end = self.start + timedelta(seconds=1)
+    rows = get_readings('12345', self.start - timedelta(seconds=1), end).values_list('timestamp', 'watts')
+    rows = list(rejoin('12345', rows, self.start - timedelta(seconds=1), end, 'ip_address', 'power_cycle'))
+    self.assertEquals([r[2:] for r in rows], [(None, None), ('10.0.0.1', 1), ('10.0.0.1', 2)])
+
+
+class BuildStatesTest(TransactionTestCase):
+  def setUp(self):
+    self.station = Station.objects.create(id='12345', name='test')
+    Reading.objects.bulk_create(create_readings(self.station, datetime(2012, 1, 1), timedelta(seconds=1), [(1, 1)] * 4))
+    cursor = connection.cursor()
+    for (column, default) in (('ip_address', "'10.0.0.1'"), ('frequency', 60), ('relay_status', 0), ('power_cycle', 1)):
+      cursor.execute('ALTER TABLE monitor_reading ADD COLUMN %s DEFAULT %s' % (column, default))
+    cursor.execute("UPDATE monitor_reading SET relay_status = 1 WHERE timestamp >= '2012-01-01 00:00:02'")
+
+  def tearDown(self):
+    cursor = connection.cursor()
+    for column in STATE_FIELDS:
+      cursor.execute('ALTER TABLE monitor_reading DROP COLUMN %s' % column)
+
+  def test_build_states(self):
+    call_command('buildstates', stdout=StringIO())
+    states = StationState.objects.order_by('timestamp')
+    self.assertEquals([(s.timestamp.second, s.relay_status) for s in states], [(0, 0), (2, 1)])
+
+  def test_build_states_after_upgrade(self):
+    # Readings stored by this version leave the legacy columns NULL and record their states as they are stored
+    readings = create_readings(self.station, datetime(2012, 1, 1, 0, 0, 10), timedelta(seconds=1), [(1, 1)] * 2)
+    for r in readings:
+      (r.ip_address, r.frequency, r.relay_status, r.power_cycle) = ('10.0.0.2', 60, 1, 1)
+    store_readings(readings)
+    cursor = connection.cursor()
+    cursor.execute("UPDATE monitor_reading SET ip_address = NULL, frequency = NULL, relay_status = NULL, "
+      "power_cycle = NULL WHERE timestamp >= '2012-01-01 00:00:10'")
+    call_command('buildstates', stdout=StringIO())
+    states = StationState.objects.order_by('timestamp')
+    self.assertEquals([(s.timestamp.second, s.ip_address) for s in states],
+      [(0, '10.0.0.1'), (2, '10.0.0.1'), (10, '10.0.0.2')])
+
+
+class IngestQueueTest(TestCase):
+  def setUp(self):
+    (fd, self.path) = tempfile.mkstemp()
+    os.close(fd)
+    monitor.ingest._queue = IngestQueue(self.path)
+    monitor.views._status_cache.clear()
+    self.station = Station.objects.create(id='12345', name='test')
+    self.values = {
+      'id': '12345', 'w': '10', 'v': '120', 'a': '1', 'wh': '1000',
+      'pf': '99', 'frq': '60', 'va': '12', 'rnc': '0', 'pcy': '1'
+    }
+
+  def tearDown(self):
+    monitor.ingest._queue = None
+    os.remove(self.path)
+
+  def test_record_queued(self):
+    with self.settings(INGEST_MODE='queue'):
+      response = self.client.post('/powermon/record/', self.values)
+      self.assertEquals(response.status_code, 200)
+      self.assertEquals(Reading.objects.count(), 0)
+      status = json.loads(self.client.get('/powermon/status/json/', **{'wsgi.url_scheme': 'https'}).content)
+    self.assertEquals(status['ingest_queue']['depth'], 1)
+    call_command('drainqueue', once=True)
+    self.assertEquals(Reading.objects.count(), 1)
+    self.assertEquals(StationState.objects.get().ip_address, '127.0.0.1')
+    self.assertEquals(get_queue().stats(), {'depth': 0, 'lag': 0})
+
+  def test_replay_skips_stored(self):
+    timestamp = datetime(2012, 1, 1, 13, 0, 0, 500)
+    readings = [build_reading(self.station, parse_meter_values(self.values), '127.0.0.1', timestamp + timedelta(seconds=i)) for i in range(4)]
+    get_queue().append(readings + readings[:1])
+    # Readings committed by a drain that crashed before removing them from the queue
+    store_readings(readings[:2])
+    self.assertEquals(get_queue().drain(100), 5)
+    self.assertEquals(
+      list(Reading.objects.order_by('timestamp').values_list('timestamp', flat=True)),
+      [r.timestamp for r in readings])
+
+  def test_replay_large_batch(self):
+    # More readings than SQLite allows query parameters
+    timestamp = datetime(2012, 1, 1, 13, 0, 0, 500)
+    readings = [build_reading(self.station, parse_meter_values(self.values), '127.0.0.1', timestamp + timedelta(seconds=i)) for i in range(1200)]
+    get_queue().append(readings)
+    store_readings(readings[:600])
+    self.assertEquals(get_queue().drain(2000), 1200)
+    self.assertEquals(Reading.objects.count(), 1200)
+
+
+@override_settings(PROFILE_REQUESTS=True)
+class ProfilingTest(TestCase):
+  def setUp(self):
+    request_metrics.reset()
+    monitor.views._status_cache.clear()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def get(self, url):
+    return self.client.get(url, **{'wsgi.url_scheme': 'https'})
+
+  def test_metrics(self):
+    with self.settings(STATUS_CACHE_SECONDS=0):
+      self.get('/powermon/status/json/')
+      self.get('/powermon/status/json/')
+    text = request_metrics.prometheus()
+    self.assertTrue('# TYPE powermon_request_seconds histogram' in text)
+    self.assertTrue('powermon_request_seconds_count{view="monitor.views.status_json"} 2' in text)
+    self.assertTrue('powermon_request_queries_bucket{view="monitor.views.status_json",le="0"} 0' in text)
+    self.assertEquals(connection.use_debug_cursor, None)
+
+  def test_metrics_admin_only(self):
+    User.objects.create_user('tester', 'tester@example.com', 'secret')
+    self.client.login(username='tester', password='secret')
+    self.assertEquals(self.get('/powermon/metrics/').status_code, 302)
+    User.objects.filter(username='tester').update(is_staff=True)
+    response = self.get('/powermon/metrics/')
+    self.assertEquals(response.status_code, 200)
+    self.assertTrue('powermon_request_seconds_count{view="monitor.views.metrics"} 1' in response.content)
+
+  def test_profile_dump(self):
+    with self.settings(PROFILE_THRESHOLD_SECONDS=0, PROFILE_DIR=self.directory):
+      self.get('/powermon/status/')
+    self.assertEquals(os.listdir(self.directory)[0].startswith('monitor.views.status-'), True)
+
+  def test_disabled(self):
+    with self.settings(PROFILE_REQUESTS=False):
+      self.get('/powermon/status/json/')
+    self.assertFalse('monitor.views.status_json' in request_metrics.prometheus())
+
+
+class AggregateTest(TestCase):
+  def setUp(self):
+    self.stations = [Station.objects.create(id=str(i), name='station %s' % i) for i in range(2)]
+    # Readings every 20 minutes from the Friday before to the Tuesday after the switch to daylight saving time
+    self.start = datetime(2012, 3, 9)
+    for (i, station) in enumerate(self.stations):
+      data = [(100 * (i + 1) + n % 10, 1000 + 10 * n) for n in range(5 * 72 + 1)]
+      Reading.objects.bulk_create(create_readings(station, self.start, timedelta(minutes=20), data))
+
+  def test_calendar(self):
+    self.assertEquals(calendar_start(datetime(2012, 3, 11, 5, 30), 'week'), datetime(2012, 3, 5))
+    self.assertEquals(calendar_start(datetime(2012, 3, 11, 5, 30), 'month'), datetime(2012, 3, 1))
+    self.assertEquals(calendar_next(datetime(2012, 12, 1), 'month'), datetime(2013, 1, 1))
+    self.assertEquals(elapsed_hours(datetime(2012, 3, 11), datetime(2012, 3, 12)), 23)
+    self.assertEquals(elapsed_hours(datetime(2012, 11, 4), datetime(2012, 11, 5)), 25)
+
+  def test_days(self):
+    result = aggregate_stations(['0', '1'], self.start, self.start + timedelta(days=5), 'day', [50, 95])
+    days = result['1']
+    self.assertEquals([d['start'].day for d in days], [9, 10, 11, 12, 13, 14])
+    self.assertEquals([d['hours'] for d in days[:4]], [24, 24, 23, 24])
+    self.assertEquals([d['count'] for d in days], [72, 72, 72, 72, 72, 1])
+    # The first reading has no preceding interval
+    self.assertEquals([d['watt_hours'] for d in days], [710, 720, 720, 720, 720, 10])
+    watts = [200 + n % 10 for n in range(72)]
+    self.assertEquals((days[0]['watts_min'], days[0]['watts_max']), (200, 209))
+    self.assertAlmostEquals(days[0]['watts_mean'], np.mean(watts))
+    self.assertAlmostEquals(days[0]['watts_p95'], np.percentile(watts, 95))
+    self.assertEquals(result['0'][0]['watts_p50'], np.percentile([w - 100 for w in watts], 50))
+
+  def test_view(self):
+    login_with_data_access(self.client)
+    url = '/powermon/aggregate/1|0/week/'
+    params = {'start': '2012-03-10T00:00:00', 'end': '2012-03-20T00:00:00', 'percentiles': '99'}
+    response = self.client.get(url, params, **{'wsgi.url_scheme': 'https'})
+    self.assertEquals(response.status_code, 200)
+    data = json.loads(response.content)
+    self.assertEquals([s['id'] for s in data['stations']], ['1', '0'])
+    self.assertEquals(data['start'], '2012-03-05T00:00:00')
+    weeks = data['stations'][0]['buckets']
+    self.assertEquals([(w['start'], w['count'], w['hours']) for w in weeks],
+      [('2012-03-05T00:00:00', 216, 167.0), ('2012-03-12T00:00:00', 145, 168.0)])
+    self.assertTrue('watts_p99' in weeks[0])
+    params['percentiles'] = '0|2.5'
+    weeks = json.loads(self.client.get(url, params, **{'wsgi.url_scheme': 'https'}).content)['stations'][0]['buckets']
+    self.assertTrue('watts_p0' in weeks[0] and 'watts_p2.5' in weeks[0])
+    params['percentiles'] = '101'
+    self.assertEquals(self.client.get(url, params, **{'wsgi.url_scheme': 'https'}).status_code, 400)
+    params = {'start': '2000-01-01T00:00:00', 'end': '2012-03-20T00:00:00'}
+    response = self.client.get('/powermon/aggregate/1/hour/', params, **{'wsgi.url_scheme': 'https'})
+    self.assertEquals(response.status_code, 400)
+    params = {'start': '2012-03-10T00:00:00', 'end': '2012-03-20T00:00:00'}
+    with self.settings(USE_ROLLUPS=False, AGGREGATE_MAX_READINGS=100):
+      response = self.client.get('/powermon/aggregate/1/day/', params, **{'wsgi.url_scheme': 'https'})
+    self.assertEquals(response.status_code, 400)
@@ -24,12 +24,19 @@ from monitor.views import *
 
 urlpatterns = patterns('',
   url(r'^$', index),
+  url(r'^aggregate/([0-9A-Za-z._|]+)/(hour|day|week|month)/$', aggregate),
+  url(r'^events/([0-9A-Za-z._|]+)/$', events),
+  url(r'^export/([0-9A-Za-z._]+)/(csv|ndjson|bin)/$', export),
   url(r'^flotseries/([0-9A-Za-z._|]+)/([a-z_|]+)/(\w{2,})/$', flotseries),
+  url(r'^flotseries/([0-9A-Za-z._|]+)/([a-z_|]+)/(\w{2,})/(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})/$', flotseries),
   url(r'^leaders/$', leaders),
   url(r'^logout/$', logout),
   url(r'^logout_success/$', logout_success),
+  url(r'^metrics/$', metrics),
   url(r'^record/$', record),
+  url(r'^record/batch/$', record_batch),
   url(r'^select_station/$', select_station),
   url(r'^status/$', status),
+  url(r'^status/json/$', status_json),
   url(r'^usage/$', usage),
 )
@@ -20,18 +20,43 @@
 #####################################################################
 
 import calendar
+import cProfile
 import inspect
 import logging
+import os
 import re
+import tempfile
+import threading
 import time
 
 from datetime import datetime,timedelta
 from django.conf import settings
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import MiddlewareNotUsed, PermissionDenied
+from django.db import IntegrityError, connections, transaction
 from django.http import HttpResponsePermanentRedirect
+from django.template.base import Template
 from monitor.models import Reading
 
 PERIOD_REGEX = re.compile(r'(\d+)([mhd])')
+
+# Upper bounds of the buckets of request time histograms in seconds
+PROFILE_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the buckets of the database query count histogram
+PROFILE_QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Histograms recorded for every request as (name, help text, bucket bounds)
+PROFILE_METRICS = (
+  ('seconds', 'Time spent handling requests in seconds.', PROFILE_TIME_BUCKETS),
+  ('db_seconds', 'Time spent executing database queries in seconds.', PROFILE_TIME_BUCKETS),
+  ('render_seconds', 'Time spent rendering templates in seconds.', PROFILE_TIME_BUCKETS),
+  ('python_seconds', 'Time spent outside database queries and template rendering in seconds.', PROFILE_TIME_BUCKETS),
+  ('queries', 'Number of database queries executed.', PROFILE_QUERY_BUCKETS),
+)
+
+# Bounds of the time interval passed to get_readings to query the entire history of a station
+EARLIEST = datetime(1970, 1, 1)
+LATEST = datetime(9999, 12, 31)
 logger = logging.getLogger(__name__)
 
 class SecureTransportMiddleware(object):
@@ -66,6 +91,155 @@ class SecureTransportMiddleware(object):
     return result
 
 
+class RequestMetrics(object):
+  """Histograms of the profiles of the requests handled by this process by view.
+  Every worker process keeps its own histograms, so a scraper sees those of the process that serves it."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+
+  def reset(self):
+    """Discards all recorded profiles."""
+    with self.lock:
+      self.views = {}
+
+
+  def observe(self, view, values):
+    """Records a request profile given as a map of each name in PROFILE_METRICS to its value."""
+    with self.lock:
+      if view not in self.views:
+        self.views[view] = dict([(name, [0] * (len(buckets) + 2)) for (name, text, buckets) in PROFILE_METRICS])
+      for (name, text, buckets) in PROFILE_METRICS:
+        histogram = self.views[view][name]
+        for i in range(len(buckets)):
+          if values[name] <= buckets[i]:
+            histogram[i] += 1
+        histogram[-2] += values[name]
+        histogram[-1] += 1
+
+
+  def prometheus(self):
+    """Renders the histograms in the Prometheus text exposition format."""
+    lines = []
+    with self.lock:
+      for (name, text, buckets) in PROFILE_METRICS:
+        metric = 'powermon_request_' + name
+        lines.append('# HELP %s %s' % (metric, text))
+        lines.append('# TYPE %s histogram' % metric)
+        for view in sorted(self.views):
+          histogram = self.views[view][name]
+          for i in range(len(buckets)):
+            lines.append('%s_bucket{view="%s",le="%s"} %d' % (metric, view, buckets[i], histogram[i]))
+          lines.append('%s_bucket{view="%s",le="+Inf"} %d' % (metric, view, histogram[-1]))
+          lines.append('%s_sum{view="%s"} %s' % (metric, view, repr(float(histogram[-2]))))
+          lines.append('%s_count{view="%s"} %d' % (metric, view, histogram[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+# Profile of the request being handled by the current thread, if any
+_current = threading.local()
+
+
+class RequestProfile(object):
+  """Time and query accounting of a single request."""
+  def __init__(self):
+    self.started = time.time()
+    self.view = 'unresolved'
+    self.render_seconds = 0.0
+    self.rendering = False
+    self.queries = {}
+    self.debug_cursors = {}
+    self.profiler = None
+
+
+def profiled_render(render):
+  """Wraps Template.render to add the time spent rendering the outermost template of a request to its profile."""
+  def wrapper(self, context):
+    profile = getattr(_current, 'profile', None)
+    if profile is None or profile.rendering:
+      return render(self, context)
+    profile.rendering = True
+    started = time.time()
+    try:
+      return render(self, context)
+    finally:
+      profile.render_seconds += time.time() - started
+      profile.rendering = False
+  wrapper.profiled = True
+  return wrapper
+
+
+class ProfilingMiddleware(object):
+  """Profiles every request and records its total time, database query time and count, template rendering time
+  and the remaining Python time in request_metrics under the name of the view that handled it.
+  Database time is the time spent executing queries as recorded by Django's debug cursor, which is enabled for
+  the duration of each request; fetching and materializing rows counts as Python time. Work done while a
+  streamed response is sent after the view returns is not included.
+  If PROFILE_THRESHOLD_SECONDS is set, every request also runs under cProfile and the statistics of requests
+  taking at least that long are written to PROFILE_DIR for analysis with the pstats module.
+  Capturing every query has a cost, so the middleware removes itself unless PROFILE_REQUESTS is set."""
+  def __init__(self):
+    if not getattr(settings, 'PROFILE_REQUESTS', False):
+      raise MiddlewareNotUsed()
+    self.threshold = getattr(settings, 'PROFILE_THRESHOLD_SECONDS', None)
+    self.directory = getattr(settings, 'PROFILE_DIR', None) or tempfile.gettempdir()
+    if not getattr(Template.render, 'profiled', False):
+      Template.render = profiled_render(Template.render)
+
+
+  def process_request(self, request):
+    profile = RequestProfile()
+    for connection in connections.all():
+      profile.debug_cursors[connection.alias] = connection.use_debug_cursor
+      profile.queries[connection.alias] = len(connection.queries)
+      connection.use_debug_cursor = True
+    if self.threshold is not None:
+      profile.profiler = cProfile.Profile()
+      profile.profiler.enable()
+    request.profile = profile
+    _current.profile = profile
+    return None
+
+
+  def process_view(self, request, view_func, view_args, view_kwargs):
+    if hasattr(request, 'profile'):
+      request.profile.view = '%s.%s' % (view_func.__module__, view_func.__name__)
+    return None
+
+
+  def process_response(self, request, response):
+    profile = getattr(request, 'profile', None)
+    if profile is None:
+      return response
+    elapsed = time.time() - profile.started
+    if profile.profiler is not None:
+      profile.profiler.disable()
+    _current.profile = None
+    queries = 0
+    db_seconds = 0.0
+    for connection in connections.all():
+      executed = connection.queries[profile.queries.get(connection.alias, 0):]
+      queries += len(executed)
+      db_seconds += sum([float(q['time']) for q in executed])
+      connection.use_debug_cursor = profile.debug_cursors.get(connection.alias)
+    request_metrics.observe(profile.view, {
+      'seconds': elapsed,
+      'db_seconds': db_seconds,
+      'render_seconds': profile.render_seconds,
+      'python_seconds': max(0.0, elapsed - db_seconds - profile.render_seconds),
+      'queries': queries,
+    })
+    if profile.profiler is not None and elapsed >= self.threshold:
+      path = os.path.join(self.directory, '%s-%s.prof' % (profile.view, datetime.now().strftime('%Y%m%dT%H%M%S%f')))
+      profile.profiler.dump_stats(path)
+      logger.info('%s took %.3fs; wrote profile to %s' % (request.get_full_path(), elapsed, path))
+    return response
+
+
+
 def queryset_to_list(queryset, *fields, **kwargs):
   """Converts a queryset to a list of n-tuples containing only the given fields from each model in the queryset
   with the option to permute values by a function.
@@ -79,19 +253,16 @@ def queryset_to_list(queryset, *fields, **kwargs):
     permutations = kwargs['permutations']
   else:
     permutations = {}
-  value = 0
+  for (field, fun) in permutations.items():
+    argsize = len(inspect.getargspec(fun).args)
+    if argsize != 1:
+      raise Exception('Expected permutation function that takes one argument but got %s' % argsize)
   for item in queryset:
     values = []
     for field in fields:
-      previous = value
       value = getattr(item, field)
       if field in permutations:
-        fun = permutations[field]
-        argsize = len(inspect.getargspec(fun).args)
-        if argsize == 1:
-          value = fun(value)
-        else:
-          raise Exception('Expected permutation function that takes one argument but got %s' % argsize)
+        value = permutations[field](value)
       values.append(value)
     items.append(tuple(values))
   return items
@@ -124,11 +295,66 @@ def now():
 
 
 def get_readings(station_id, start, end):
-  """Gets a sequence of power readings for the given station in the time interval [start, end]."""
-  return Reading.objects.filter(
+  """Gets a sequence of power readings for the given station in the time interval [start, end] in chronological
+  order.
+  This is a QuerySet unless the interval overlaps months moved to archive tables by the archivereadings command,
+  in which case it is a monitor.archive.ReadingSet spanning the archive tables and the reading table."""
+  from monitor.archive import ReadingSet, archived_querysets
+  readings = Reading.objects.filter(
     station_id=station_id,
     timestamp__gte=start,
-    timestamp__lte=end)
+    timestamp__lte=end).order_by('timestamp')
+  archived = archived_querysets(station_id, start, end)
+  if len(archived) > 0:
+    return ReadingSet(archived + [readings])
+  return readings
+
+
+def get_station_readings(station_ids, start, end):
+  """Gets the power readings of several stations in the time interval [start, end] ordered by station and time,
+  i.e. chronologically for each station, with a single query per table like get_readings. Use
+  monitor.analysis.station_columns to split the readings by station."""
+  from monitor.archive import ReadingSet, archived_station_querysets
+  readings = Reading.objects.filter(
+    station_id__in=station_ids,
+    timestamp__gte=start,
+    timestamp__lte=end).order_by('station', 'timestamp')
+  archived = archived_station_querysets(station_ids, start, end)
+  if len(archived) > 0:
+    return ReadingSet(archived + [readings])
+  return readings
+
+
+def create_or_merge(model, objects, key, merge):
+  """Inserts new model objects with a single bulk insert inside the current transaction.
+  select_for_update cannot lock rows that do not exist yet, so another transaction may insert the same rows
+  first, which fails the bulk insert with an IntegrityError. In that case each object is inserted on its own or,
+  if its row now exists, merged into that row under a row lock. The key function maps an object to the lookup
+  parameters of its row and the merge function merges an object into the existing row, which is then saved."""
+  if len(objects) == 0:
+    return
+  sid = transaction.savepoint()
+  try:
+    model.objects.bulk_create(objects)
+    transaction.savepoint_commit(sid)
+    return
+  except IntegrityError:
+    transaction.savepoint_rollback(sid)
+  for obj in objects:
+    sid = transaction.savepoint()
+    try:
+      obj.save(force_insert=True)
+      transaction.savepoint_commit(sid)
+    except IntegrityError:
+      transaction.savepoint_rollback(sid)
+      existing = model.objects.select_for_update().get(**key(obj))
+      merge(existing, obj)
+      existing.save(force_update=True)
+
+
+def has_admin_access(user):
+  """Determines whether the user is an active staff member, i.e. may use the admin application."""
+  return user.is_active and user.is_staff
 
 
 def has_data_access_permission(user):
@@ -20,35 +20,84 @@
 #####################################################################
 
 import django.contrib.auth
+import hashlib
 import logging
 import json
+import threading
+import time
 
 from datetime import datetime, timedelta
 from django import forms
+from django.conf import settings
 from django.contrib.auth.decorators import user_passes_test
-from django.db.models import Max, Min
-from django.http import HttpResponse, HttpResponseServerError
-from django.shortcuts import redirect, render, render_to_response, get_object_or_404
+from django.db.models import Count, Max, Min
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, \
+  HttpResponseServerError
+from django.shortcuts import redirect, render, render_to_response
 from django.template import RequestContext
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
 from django.views.decorators.csrf import csrf_exempt
+from monitor.aggregate import AGGREGATE_RESOLUTIONS, aggregate_stations, calendar_count, calendar_start, \
+  reading_count
 from monitor.analysis import *
+from monitor.archive import archived_station_querysets
+from monitor.broker import get_broker
+from monitor.export import EXPORT_FIELDS, EXPORT_FORMATS, export_chunks
+from monitor.ingest import MeterParseError, build_reading, get_queue, ingest, ingest_lag, ingest_mode, \
+  parse_meter_values
+from monitor.leaderboard import leaderboard, leaderboard_enabled
 from monitor.models import Reading, Station
+from monitor.registry import registry
+from monitor.rollup import get_station_rollups, rollup_timeseries, rollups_enabled, select_resolution, \
+  station_energy, SERIES_VALUES
+from monitor.segments import reading_data, station_reading_data
+from monitor.states import rejoin, state_array, station_states
 from monitor.util import *
 from powermon.settings import *
 from types import *
 
 ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
 JSON_MIMETYPE = 'application/json'
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4'
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+EXPORT_MIMETYPES = {
+  'csv': 'text/csv',
+  'ndjson': 'application/x-ndjson',
+  'bin': 'application/octet-stream',
+}
+# Reading fields and numeric station state fields that may be charted
+FLOT_READING_VARIABLES = ('watts', 'volts', 'amps', 'watt_hours', 'power_factor', 'volt_amps')
+FLOT_STATE_VARIABLES = ('frequency', 'relay_status', 'power_cycle')
+# Keys of a flot series object in the order json.dumps emits them
+FLOT_SERIES_KEYS = {'data': None, 'label': None}.keys()
+# Approximate size in bytes of each chunk of a streamed response
+STREAM_CHUNK_SIZE = 65536
 STATION_COOKIE = "powermon_station"
 
+# Most recent result of station_status
+_status_cache = {}
+_status_lock = threading.Lock()
+
 logger = logging.getLogger(__name__)
 
 
 class StationForm(forms.Form):
   """Describes a station selection form."""
-  station_id = forms.ChoiceField(
-    label='Station',
-    choices=queryset_to_list(Station.objects.filter(enabled=True), 'id', 'name'))
+  station_id = forms.ChoiceField(label='Station')
+
+  def __init__(self, *args, **kwargs):
+    super(StationForm, self).__init__(*args, **kwargs)
+    self.fields['station_id'].choices = queryset_to_list(registry.enabled(), 'id', 'name')
+
+
+def get_station_or_404(lookup, key):
+  """Looks up a station in the station registry and raises Http404 if it does not exist."""
+  try:
+    return lookup(key)
+  except Station.DoesNotExist:
+    raise Http404('No station matches %s.' % key)
 
 
 def index(request):
@@ -69,37 +118,77 @@ def logout_success(request):
 
 @csrf_exempt
 def record(request):
-  """Records a reading provided by a power monitoring station."""
+  """Records a reading provided by a power monitoring station.
+  Malformed posts are rejected with status 400 before the station is looked up."""
   if request.method != 'POST':
     return HttpResponse(request.method + ' not allowed.', status=405)
 
+  try:
+    values = parse_meter_values(request.POST)
+  except MeterParseError as e:
+    return HttpResponseBadRequest(str(e))
   station = None
-  station_id = request.POST['id']
   try:
-    station = Station.objects.get(id=station_id)
+    station = registry.get(values.station_id)
   except Station.DoesNotExist:
-    logger.warn('Cannot record data for non-existent station ' + station_id)
-    return HttpResponseServerError('Station %s does not exist.' % station_id)
-
-  reading = Reading()
-  reading.station = station
-  reading.timestamp = now()
-  reading.ip_address = request.META['REMOTE_ADDR']
-  reading.watts = request.POST['w']
-  reading.volts = request.POST['v']
-  reading.amps = request.POST['a']
-  reading.watt_hours = request.POST['wh']
-  reading.power_factor = request.POST['pf']
-  reading.frequency = request.POST['frq']
-  reading.volt_amps = request.POST['va']
-  reading.relay_status = request.POST['rnc']
-  reading.power_cycle = request.POST['pcy']
-  reading.save()
+    logger.warn('Cannot record data for non-existent station ' + values.station_id)
+    return HttpResponseServerError('Station %s does not exist.' % values.station_id)
+
+  reading = build_reading(station, values, request.META['REMOTE_ADDR'], now())
+  ingest([reading])
 
   message = 'Recorded %s' % reading
   logger.info(message)
   return HttpResponse(message)
 
+
+@csrf_exempt
+def record_batch(request):
+  """Records many readings, possibly for many stations, provided in a single request.
+  The request body is a JSON list of objects with the same parameters posted by a monitoring station
+  plus an optional ts parameter, the ISO format time of the reading, which defaults to the current time.
+  The whole batch is rejected with status 400 if any reading is malformed.
+  All readings are ingested together, i.e. stored with a single bulk insert in direct mode."""
+  if request.method != 'POST':
+    return HttpResponse(request.method + ' not allowed.', status=405)
+
+  try:
+    items = json.loads(request.body)
+  except ValueError:
+    return HttpResponseBadRequest('Invalid JSON reading batch.')
+  if type(items) is not ListType:
+    return HttpResponseBadRequest('Expected a JSON list of readings.')
+
+  timestamp = now()
+  parsed = []
+  for (i, item) in enumerate(items):
+    try:
+      if type(item) is not DictType:
+        raise MeterParseError('Expected a JSON object.')
+      reading_time = timestamp
+      if 'ts' in item:
+        try:
+          reading_time = datetime.strptime(item['ts'], ISO_FORMAT)
+        except (TypeError, ValueError):
+          raise MeterParseError('Invalid ts %r.' % (item['ts'],))
+      parsed.append((parse_meter_values(item), reading_time))
+    except MeterParseError as e:
+      return HttpResponseBadRequest('Reading %s: %s' % (i, e))
+
+  stations = registry.in_bulk(set([values.station_id for (values, reading_time) in parsed]))
+  readings = []
+  for (values, reading_time) in parsed:
+    if values.station_id not in stations:
+      logger.warn('Cannot record data for non-existent station ' + values.station_id)
+      return HttpResponseServerError('Station %s does not exist.' % values.station_id)
+    readings.append(build_reading(stations[values.station_id], values, request.META['REMOTE_ADDR'], reading_time))
+  ingest(readings)
+
+  message = 'Recorded %s readings' % len(readings)
+  logger.info(message)
+  return HttpResponse(message)
+
+
 @user_passes_test(has_data_access_permission)
 def select_station(request):
   """Handles selection of the station for which data summary and analysis views are generated.
@@ -124,7 +213,7 @@ def usage(request):
   """Generates a summary of power usage data for a particular station."""
   station = None
   if 'station_name' in request.GET:
-    station = get_object_or_404(Station, name=request.GET['station_name'])
+    station = get_station_or_404(registry.get_by_name, request.GET['station_name'])
   else:
     station_id = None
     if 'station_id' in request.POST:
@@ -133,26 +222,24 @@ def usage(request):
       station_id = request.COOKIES[STATION_COOKIE]
     if not station_id:
       return redirect(select_station)
-    station = get_object_or_404(Station, id=station_id)
+    station = get_station_or_404(registry.get, station_id)
   end = now()
   interval = timedelta(7)
   start = end - interval
-  readings = get_readings(station.id, start, end)
-  if len(readings) == 0:
+  data = energy_data(reading_data(station.id, start, end, 'watts', 'watt_hours'))
+  data['power_cycle'] = state_array(station_states(station.id, start, end), data['timestamp'], 'power_cycle')
+  summary = usage_summary(data)
+  if summary is None:
     return render_to_response('nodata.html', {'station': station}, context_instance=RequestContext(request))
 
-  energy_series = energy_timeseries(readings)
-  median_usage = 'ERR'
-  if len(energy_series) > 0:
-     median_usage = median(energy_series) * 24 / 1000
   return render_to_response('usage.html',
     {
       'station': station,
-      'stations': '|'.join([s.id for s in Station.objects.filter(enabled=True)]),
-      'median_kwh_day': median_usage,
-      'kwh_tot': total_kWh(readings),
-      'w_max' : max(r.watts for r in readings),
-      'w_min' : min(r.watts for r in readings)
+      'stations': '|'.join([s.id for s in registry.enabled()]),
+      'median_kwh_day': summary['median_kwh_day'],
+      'kwh_tot': summary['kwh_tot'],
+      'w_max' : summary['w_max'],
+      'w_min' : summary['w_min']
     },
     context_instance=RequestContext(request))
 
@@ -161,53 +248,454 @@ def usage(request):
 def flotseries(request, stations, variables, period, end=None):
   """Produces a JSON list of time series for one or more power monitoring variables and one or more stations.
   The stations and variables parameters are pipe-delimited lists of station IDs and power variables
-  (watts, amps,etc), respectively.
+  (watts, amps,etc), respectively. The frequency, relay_status and power_cycle variables give the station state in
+  effect at each reading, or -1 before the first recorded state.
   The end parameter is optional and is specified to mark the right-hand side of the time interval, otherwise the
   current time is used. Times nust be in ISO format, 'YYYY-mm-ddTHH:MM:SS'.
   Periods are simple strings of the format nX where n is an integer and X is either h for hours or d for days.
   The time interval for the data set is the interval [t - period, t], inclusive, where t is either end or the
   current time.
-  The JSON string conforms to that required by the flot API, http://flot.googlecode.com/svn/trunk/API.txt"""
+  The JSON string conforms to that required by the flot API, http://flot.googlecode.com/svn/trunk/API.txt
+  Responses are cached: windows that ended longer ago than the ingest lag plus FLOTSERIES_SETTLE_SECONDS are
+  immutable and cached for FLOTSERIES_CACHE_SECONDS, while more recent windows are cached for
+  FLOTSERIES_LIVE_CACHE_SECONDS and windows anchored to the current time also end at a multiple of it. Clients
+  may revalidate with If-None-Match or If-Modified-Since.
+  If the since query parameter is given as a time in the same representation as the series, milliseconds since
+  the epoch, only the readings after that time, less the ingest lag so that readings committed late are not
+  missed, are returned so that live charts can replace the tail of the points they already have with them.
+  Such incremental responses are not cached, and they are downsampled like full responses if they hold more
+  readings than points, e.g. for a since older than the period.
+  Each series is downsampled on the server to at most FLOT_MAX_POINTS points or fewer if the points query
+  parameter is given, which must be at least 3. The mode query parameter selects the downsampling algorithm,
+  lttb (default) or minmax.
+  The readings or rollups of all stations are fetched together with a single query and split by station.
+  If the stream query parameter is given, every raw reading is instead streamed to the client as it is read
+  from the database, keeping memory use flat regardless of the time interval. The streamed JSON is identical
+  to the response produced without streaming when neither rollups nor downsampling apply."""
+  points = getattr(settings, 'FLOT_MAX_POINTS', 1000)
+  if 'points' in request.GET:
+    try:
+      requested = int(request.GET['points'])
+    except ValueError:
+      return HttpResponseBadRequest('Invalid points %s.' % request.GET['points'])
+    if requested < 3:
+      # Downsampling needs the first and last points plus at least one more
+      return HttpResponseBadRequest('Points must be at least 3.')
+    points = points is None and requested or min(points, requested)
+  mode = request.GET.get('mode', 'lttb')
+  if mode not in DOWNSAMPLE_MODES:
+    return HttpResponseBadRequest('Invalid mode %s.' % mode)
+  since = None
+  if 'since' in request.GET:
+    try:
+      # Readings whose epoch time, which has whole-second resolution, is later than since
+      since = datetime.utcfromtimestamp(int(request.GET['since']) // 1000 + 1)
+    except ValueError:
+      return HttpResponseBadRequest('Invalid since %s.' % request.GET['since'])
+  live_ttl = getattr(settings, 'FLOTSERIES_LIVE_CACHE_SECONDS', 10)
   if end is None:
+    live = True
     end = now()
+    if since is None:
+      end = align_time(end, live_ttl)
   else:
     end = datetime.strptime(end, ISO_FORMAT)
+    # Readings may still arrive for windows that ended within the ingest lag and settling time
+    settle = ingest_lag() + getattr(settings, 'FLOTSERIES_SETTLE_SECONDS', 300)
+    live = end >= now() - timedelta(seconds=settle)
   start = end - parse_period(period)
   stationlist = stations.split('|')
   fieldlist = variables.split('|')
-  flot_data = []
+  for field in fieldlist:
+    if field not in FLOT_READING_VARIABLES + FLOT_STATE_VARIABLES:
+      return HttpResponseBadRequest('Invalid variable %s.' % field)
+  station_map = registry.in_bulk(stationlist)
   for station_id in stationlist:
-    station = Station.objects.get(pk=station_id)
-    readings = get_readings(station_id, start, end)
-    series = timeseries(readings, *fieldlist)
-    for i in range(len(fieldlist)):
-      flot_data.append({'data': series[i], 'label': "%s - %s" % (fieldlist[i], station.name)})
-  return HttpResponse(json.dumps(flot_data), content_type=JSON_MIMETYPE)
+    if station_id not in station_map:
+      raise Http404('No station matches %s.' % station_id)
+  station_ids = sorted(station_map.keys())
+  if since is not None:
+    start = max(start, since - timedelta(seconds=ingest_lag()))
+    data = series_data(station_ids, start, end, fieldlist)
+    flot_data = []
+    for station_id in stationlist:
+      series = timeseries(data[station_id], *fieldlist, points=points, mode=mode)
+      for i in range(len(fieldlist)):
+        flot_data.append({'data': series[i], 'label': "%s - %s" % (fieldlist[i], station_map[station_id].name)})
+    return HttpResponse(json.dumps(flot_data), content_type=JSON_MIMETYPE)
+  if 'stream' in request.GET:
+    return HttpResponse(stream_flotseries(stationlist, fieldlist, start, end), content_type=JSON_MIMETYPE)
+  resolution = None
+  if rollups_enabled() and all([f in SERIES_VALUES for f in fieldlist]):
+    resolution = select_resolution(end - start)
 
+  def build():
+    if resolution is None:
+      data = series_data(station_ids, start, end, fieldlist)
+    else:
+      rollups = get_station_rollups(station_ids, resolution, start, end)
+    flot_data = []
+    for station_id in stationlist:
+      if resolution is None:
+        series = timeseries(data[station_id], *fieldlist, points=points, mode=mode)
+      else:
+        series = rollup_timeseries(rollups[station_id], *fieldlist)
+        if points is not None:
+          series = [downsample(s, points, mode) for s in series]
+      for i in range(len(fieldlist)):
+        flot_data.append({'data': series[i], 'label': "%s - %s" % (fieldlist[i], station_map[station_id].name)})
+    return json.dumps(flot_data)
 
-def status(request):
-  """Presents a status page that provides a suitable target for health checks."""
-  reading_map = {}
+  key = '|'.join([stations, variables, period, end.strftime(ISO_FORMAT), str(points), mode, str(resolution)])
+  if live:
+    return cached_response(request, key, build, live_ttl, None)
+  return cached_response(request, key, build, getattr(settings, 'FLOTSERIES_CACHE_SECONDS', 86400), end)
+
+
+@user_passes_test(has_data_access_permission)
+def aggregate(request, stations, resolution):
+  """Produces a JSON summary of the power usage of one or more stations in calendar-aligned buckets.
+  The stations parameter is a pipe-delimited list of station IDs and resolution is one of hour, day, week or
+  month. Buckets follow the wall clock of the site time zone, TIME_ZONE, so days start at local midnight and
+  the hours of each bucket reflect daylight saving time changes. The start and end query parameters are ISO
+  format times, 'YYYY-mm-ddTHH:MM:SS', bounding the readings inclusively; end defaults to the current time and
+  start to AGGREGATE_DEFAULT_BUCKETS buckets before end, and start is moved back to the start of its bucket.
+  Requests spanning more than AGGREGATE_MAX_BUCKETS buckets or AGGREGATE_MAX_READINGS readings are refused.
+  The percentiles query parameter is a pipe-delimited list of watts percentiles to compute, 50|95 by default.
+  Each bucket holds its start time, hours, reading count, watt_hours, watts_mean, watts_min, watts_max,
+  watts_pN for each percentile N and flags, the monitor.analysis ENERGY_* quality flags of its energy."""
+  if resolution not in AGGREGATE_RESOLUTIONS:
+    raise Http404('Invalid resolution %s.' % resolution)
+  stationlist = stations.split('|')
+  station_map = registry.in_bulk(stationlist)
+  for station_id in stationlist:
+    if station_id not in station_map:
+      raise Http404('No station matches %s.' % station_id)
+  try:
+    percentiles = [float(p) for p in request.GET.get('percentiles', '50|95').split('|') if p]
+  except ValueError:
+    return HttpResponseBadRequest('Invalid percentiles %s.' % request.GET['percentiles'])
+  for p in percentiles:
+    if not 0 <= p <= 100:
+      return HttpResponseBadRequest('Percentile %s out of range.' % p)
+  percentiles = [int(p) if int(p) == p else p for p in percentiles]
+  try:
+    end = 'end' in request.GET and datetime.strptime(request.GET['end'], ISO_FORMAT) or now()
+    if 'start' in request.GET:
+      start = datetime.strptime(request.GET['start'], ISO_FORMAT)
+    else:
+      start = calendar_start(end, resolution)
+      for i in range(getattr(settings, 'AGGREGATE_DEFAULT_BUCKETS', 30) - 1):
+        start = calendar_start(start - timedelta(microseconds=1), resolution)
+  except ValueError:
+    return HttpResponseBadRequest('Times must be in ISO format.')
+  start = calendar_start(start, resolution)
+  limit = getattr(settings, 'AGGREGATE_MAX_BUCKETS', 1000)
+  if calendar_count(start, end, resolution, limit) > limit:
+    return HttpResponseBadRequest('At most %s %s buckets may be requested.' % (limit, resolution))
+  station_ids = sorted(station_map.keys())
+  # Every reading in the interval is held in memory while it is aggregated
+  limit = getattr(settings, 'AGGREGATE_MAX_READINGS', 2000000)
+  if reading_count(station_ids, start, end) > limit:
+    return HttpResponseBadRequest('At most %s readings may be aggregated; narrow the interval.' % limit)
+  aggregates = aggregate_stations(station_ids, start, end, resolution, percentiles)
+  for buckets in aggregates.values():
+    for bucket in buckets:
+      bucket['start'] = bucket['start'].strftime(ISO_FORMAT)
+  data = {
+    'resolution': resolution,
+    'time_zone': settings.TIME_ZONE,
+    'start': start.strftime(ISO_FORMAT),
+    'end': end.strftime(ISO_FORMAT),
+    'stations': [
+      {'id': i, 'name': station_map[i].name, 'buckets': aggregates[i]} for i in stationlist
+    ],
+  }
+  return HttpResponse(json.dumps(data), content_type=JSON_MIMETYPE)
+
+
+@user_passes_test(has_data_access_permission)
+def export(request, station_id, format):
+  """Streams the readings of a station for download as CSV, newline-delimited JSON or compact binary.
+  The start and end query parameters are ISO format times, 'YYYY-mm-ddTHH:MM:SS', bounding the readings
+  inclusively; end defaults to the current time and start to one day before end. The optional fields query
+  parameter is a pipe-delimited subset of the exported fields. For the binary format, delta=0 and zlib=0
+  turn off delta encoding and compression; see monitor.export.binary_chunks for the layout.
+  Readings are read through a server-side cursor and encoded a chunk at a time as they are sent."""
+  station = get_station_or_404(registry.get, station_id)
+  if format not in EXPORT_FORMATS:
+    raise Http404('Invalid export format %s.' % format)
+  fields = EXPORT_FIELDS
+  if 'fields' in request.GET:
+    fields = tuple(request.GET['fields'].split('|'))
+    for field in fields:
+      if field not in EXPORT_FIELDS:
+        return HttpResponseBadRequest('Invalid field %s.' % field)
+  try:
+    end = 'end' in request.GET and datetime.strptime(request.GET['end'], ISO_FORMAT) or now()
+    start = 'start' in request.GET and datetime.strptime(request.GET['start'], ISO_FORMAT) \
+      or end - timedelta(days=1)
+  except ValueError:
+    return HttpResponseBadRequest('Times must be in ISO format.')
+  chunks = export_chunks(
+    station.id, start, end, format, fields,
+    delta=request.GET.get('delta') != '0',
+    compress=request.GET.get('zlib') != '0')
+  response = HttpResponse(chunks, content_type=EXPORT_MIMETYPES[format])
+  response['Content-Disposition'] = 'attachment; filename=%s-%s.%s' % (
+    station.id, start.strftime('%Y%m%dT%H%M%S'), format)
+  return response
+
+
+@user_passes_test(has_data_access_permission)
+def events(request, stations):
+  """Pushes the readings of the given stations to the client as server-sent events as they are recorded.
+  The stations parameter is a pipe-delimited list of station IDs. Each reading event carries the station ID,
+  the time of the reading in milliseconds since the epoch and its watts, volts, amps and watt hours in JSON.
+  A client that reads slower than readings arrive receives only the newest reading of each station.
+  A comment line is sent after EVENT_HEARTBEAT_SECONDS without readings to keep idle connections open, and
+  the stream ends after EVENT_STREAM_SECONDS so that no worker is held indefinitely; EventSource clients
+  reconnect automatically."""
+  broker = get_broker()
+  if broker is None:
+    raise Http404('Events are disabled.')
+  stationlist = stations.split('|')
+  for station_id in stationlist:
+    get_station_or_404(registry.get, station_id)
+  subscription = broker.subscribe(stationlist)
+  response = HttpResponse(
+    stream_events(
+      broker,
+      subscription,
+      getattr(settings, 'EVENT_HEARTBEAT_SECONDS', 15),
+      getattr(settings, 'EVENT_STREAM_SECONDS', 300)),
+    content_type=EVENT_STREAM_MIMETYPE)
+  patch_cache_control(response, no_cache=True)
+  return response
+
+
+def stream_events(broker, subscription, heartbeat, duration):
+  """Generates the server-sent event stream of a subscription for duration seconds."""
+  try:
+    yield 'retry: 1000\n\n'
+    deadline = time.time() + duration
+    remaining = duration
+    while remaining > 0:
+      events = subscription.get(min(heartbeat, remaining))
+      if len(events) > 0:
+        yield ''.join(['event: reading\ndata: %s\n\n' % json.dumps(e) for e in events])
+      else:
+        yield ': heartbeat\n\n'
+      remaining = deadline - time.time()
+  finally:
+    broker.unsubscribe(subscription)
+
+
+def align_time(timestamp, seconds):
+  """Truncates a time to a multiple of the given number of seconds since midnight."""
+  if not seconds:
+    return timestamp
+  offset = (timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second) % seconds
+  return timestamp - timedelta(seconds=offset, microseconds=timestamp.microsecond)
+
+
+def cached_response(request, key, build, ttl, last_modified):
+  """Produces a JSON response whose content is cached for ttl seconds and supports conditional GET.
+  The build function computes the content on a cache miss. Every response carries an ETag derived from
+  the content; immutable content also carries the given Last-Modified time. A request whose If-None-Match
+  or If-Modified-Since header shows the client already has the content receives a 304 response."""
+  key = 'monitor.views:%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+  entry = cache.get(key)
+  if entry is None:
+    content = build()
+    entry = (content, '"%s"' % hashlib.md5(content).hexdigest())
+    if ttl:
+      cache.set(key, entry, ttl)
+  (content, etag) = entry
+  modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+  if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+    response = HttpResponseNotModified()
+  elif last_modified and modified_since and modified_since >= int(time.mktime(last_modified.timetuple())):
+    response = HttpResponseNotModified()
+  else:
+    response = HttpResponse(content, content_type=JSON_MIMETYPE)
+  response['ETag'] = etag
+  if last_modified:
+    response['Last-Modified'] = http_date(time.mktime(last_modified.timetuple()))
+  patch_cache_control(response, private=True, max_age=ttl)
+  return response
+
+
+def series_data(station_ids, start, end, fieldlist):
+  """Gets the timestamps and given fields of the readings of several stations in [start, end] like
+  station_reading_data, where fields in FLOT_STATE_VARIABLES are the values of the station state in effect at
+  each reading as produced by state_array."""
+  data = station_reading_data(station_ids, start, end, *[f for f in fieldlist if f in FLOT_READING_VARIABLES])
+  fields = [f for f in fieldlist if f in FLOT_STATE_VARIABLES]
+  if len(fields) > 0:
+    for station_id in station_ids:
+      states = station_states(station_id, start, end)
+      for field in fields:
+        data[station_id][field] = state_array(states, data[station_id]['timestamp'], field)
+  return data
+
+
+def stream_flotseries(stationlist, fieldlist, start, end):
+  """Generates the flot JSON for the raw readings of each station and field in chunks of roughly
+  STREAM_CHUNK_SIZE bytes. Readings are iterated from the database one field at a time without caching."""
+  chunk = ['[']
+  size = 1
+  separator = ''
+  for station_id in stationlist:
+    station = registry.get(station_id)
+    for field in fieldlist:
+      chunk.append(separator + '{')
+      pair_separator = ''
+      for key in FLOT_SERIES_KEYS:
+        if key == 'label':
+          chunk.append('%s"label": %s' % (pair_separator, json.dumps('%s - %s' % (field, station.name))))
+        else:
+          chunk.append(pair_separator + '"data": [')
+          point_separator = ''
+          if field in FLOT_STATE_VARIABLES:
+            times = get_readings(station_id, start, end).values_list('timestamp').iterator()
+            rows = rejoin(station_id, times, start, end, field)
+          else:
+            rows = get_readings(station_id, start, end).values_list('timestamp', field).iterator()
+          for (timestamp, value) in rows:
+            if value is None:
+              value = -1
+            point = '%s[%d, %d]' % (point_separator, epoch(timestamp), value)
+            chunk.append(point)
+            size += len(point)
+            point_separator = ', '
+            if size >= STREAM_CHUNK_SIZE:
+              yield ''.join(chunk)
+              chunk = []
+              size = 0
+          chunk.append(']')
+        pair_separator = ', '
+      chunk.append('}')
+      separator = ', '
+  chunk.append(']')
+  yield ''.join(chunk)
+
+
+def status_counts(start, end):
+  """Gets the number and time of the latest reading of each enabled station in [start, end] as a queryset of
+  maps of station, count and last_seen, grouped in the database."""
+  return Reading.objects.filter(
+    station__enabled=True,
+    timestamp__gte=start,
+    timestamp__lte=end).values('station').annotate(count=Count('id'), last_seen=Max('timestamp'))
+
+
+def station_status():
+  """Gets the health of every enabled station over the past STATUS_TIMEOUT minutes.
+  Returns a map containing the overall result, HTTP status code and interval along with a list of
+  (station, reading count, time of latest reading) tuples. Counts come from a single grouped query whose result
+  is reused for STATUS_CACHE_SECONDS so that frequent health checks cost at most one query per interval."""
+  with _status_lock:
+    if _status_cache and time.time() - _status_cache['computed'] < getattr(settings, 'STATUS_CACHE_SECONDS', 10):
+      return dict(_status_cache)
   end = now()
   interval = timedelta(minutes=STATUS_TIMEOUT)
-  start = end - interval
-  zero_count = 0
-  for station in Station.objects.filter(enabled=True):
-    readings = get_readings(station.id, start, end)
-    if len(readings) == 0:
-      zero_count += 1
-    reading_map[station.name] = readings
+  rows = status_counts(end - interval, end)
+  counts = dict([(row['station'], (row['count'], row['last_seen'])) for row in rows])
+  stations = [(s,) + counts.get(s.id, (0, None)) for s in registry.enabled()]
+  zero_count = len([s for s in stations if s[1] == 0])
   result = 'OK'
   code = 200
-  if zero_count == len(reading_map):
+  if zero_count == len(stations):
     result = 'ERROR: no stations have reported data in the past %s' % interval
     code = 500
   elif zero_count > 0:
     result = 'WARN: at least one station has not reported data in the past %s' % interval
     code = 306
-  message = '%s\n\nStation reading counts in past %s\n' % (result, interval)
-  message += '\n'.join(['%-26s%d' % (k, len(v)) for (k, v) in reading_map.items()])
-  return HttpResponse(message, 'text/plain', code)
+  with _status_lock:
+    _status_cache.clear()
+    _status_cache.update({
+      'computed': time.time(),
+      'time': end,
+      'interval': interval,
+      'result': result,
+      'code': code,
+      'stations': stations,
+    })
+    return dict(_status_cache)
+
+
+def status(request):
+  """Presents a status page that provides a suitable target for health checks."""
+  summary = station_status()
+  message = '%s\n\nStation reading counts in past %s\n' % (summary['result'], summary['interval'])
+  message += '\n'.join(['%-26s%d' % (s.name, count) for (s, count, last_seen) in summary['stations']])
+  message += '\n\nStation cache %(hits)d hits, %(misses)d misses, %(size)d stations\n' % registry.stats()
+  if ingest_mode() == 'queue':
+    message += 'Ingest queue %(depth)d readings, %(lag).1f seconds behind\n' % get_queue().stats()
+  return HttpResponse(message, 'text/plain', summary['code'])
+
+
+def status_json(request):
+  """Presents the status page information as a JSON object for machine consumption."""
+  summary = station_status()
+  data = {
+    'status': summary['result'].split(':')[0],
+    'message': summary['result'],
+    'time': summary['time'].strftime(ISO_FORMAT),
+    'interval_seconds': int(summary['interval'].total_seconds()),
+    'stations': [
+      {
+        'id': s.id,
+        'name': s.name,
+        'count': count,
+        'last_seen': last_seen and last_seen.strftime(ISO_FORMAT),
+      } for (s, count, last_seen) in summary['stations']
+    ],
+    'station_cache': registry.stats(),
+  }
+  if ingest_mode() == 'queue':
+    data['ingest_queue'] = get_queue().stats()
+  return HttpResponse(json.dumps(data), JSON_MIMETYPE, summary['code'])
+
+
+@user_passes_test(has_admin_access)
+def metrics(request):
+  """Exposes the request profiles recorded by monitor.util.ProfilingMiddleware in this process as histograms in
+  the Prometheus text format. Only available to staff users."""
+  return HttpResponse(request_metrics.prometheus(), PROMETHEUS_MIMETYPE)
+
+
+def leader_stations(start, end):
+  """Gets enabled stations annotated with power_max and power_min, the greatest and least watt hours readings
+  in the interval [start, end] or over all time if start is None. All-time extremes include archived readings;
+  the archivereadings command keeps at least a month of readings in the reading table, so shorter intervals
+  never reach the archive."""
+  if rollups_enabled():
+    return station_energy(start, end)
+  if start is None:
+    stations = Station.objects.filter(enabled=True)
+  else:
+    stations = Station.objects.filter(
+      enabled=True,
+      reading__timestamp__gte=start,
+      reading__timestamp__lte=end)
+  stations = stations.annotate(
+    power_max=Max('reading__watt_hours'),
+    power_min=Min('reading__watt_hours'))
+  if start is None:
+    archived = archived_station_querysets([s.id for s in stations], EARLIEST, LATEST)
+    if len(archived) > 0:
+      stations = list(stations)
+      for queryset in archived:
+        rows = queryset.order_by().values('station').annotate(high=Max('watt_hours'), low=Min('watt_hours'))
+        extremes = dict([(row['station'], (row['high'], row['low'])) for row in rows])
+        for station in stations:
+          if station.id in extremes:
+            (power_max, power_min) = extremes[station.id]
+            station.power_max = max([v for v in (station.power_max, power_max) if v is not None])
+            station.power_min = min([v for v in (station.power_min, power_min) if v is not None])
+  return stations
 
 
 @user_passes_test(has_data_access_permission)
@@ -216,22 +704,18 @@ def leaders(request):
   end = now()
   leaders = {}
   period = ('24h', '7d', '30d', None)
-  for p in period:
-    if p is None:
-      stations = Station.objects.filter(enabled=True)
-    else:
-      start = end - parse_period(p)
-      stations = Station.objects.filter(
-        enabled=True,
-        reading__timestamp__gte=start,
-        reading__timestamp__lte=end)
-    leaders[p] = stations.annotate(
-      power_max=Max('reading__watt_hours'),
-      power_min=Min('reading__watt_hours'))
-    # Add computed attribute to each station
-    for row in leaders[p]:
-      setattr(row, 'total_kwh', (row.power_max - row.power_min) / 1000)
-    leaders[p] = sorted(leaders[p], key=lambda r: r.total_kwh)
+  if leaderboard_enabled():
+    states = leaderboard(end)
+    for (p, attribute) in zip(period, ('day', 'week', 'month', 'total')):
+      rows = [{'name': s.station.name, 'total_kwh': getattr(s, attribute) / 1000} for s in states]
+      leaders[p] = sorted(rows, key=lambda r: r['total_kwh'])
+  else:
+    for p in period:
+      leaders[p] = leader_stations(p and end - parse_period(p), end)
+      # Add computed attribute to each station
+      for row in leaders[p]:
+        setattr(row, 'total_kwh', (row.power_max - row.power_min) / 1000)
+      leaders[p] = sorted(leaders[p], key=lambda r: r.total_kwh)
   return render_to_response('leaders.html',
     {
       'leaders_day': leaders['24h'],
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+#####################################################################
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+#####################################################################
+
+# Load test that simulates a fleet of watts up? .net meters posting readings
+# to the record URI and reports throughput, latency and database row rate.
+# Runs offline against a throwaway SQLite database, either through the Django
+# test client in this process or over HTTP against a local threaded WSGI
+# server. Run from any directory, e.g.
+#
+#   tools/load-test.py --meters 50 --interval 1 --duration 30 --server
+#
+# Settings are read from powermon.settings (see --settings) except for the
+# database, which is always a SQLite file removed after the run.
+
+from httplib import HTTPConnection
+from optparse import OptionParser
+from os.path import abspath, dirname, join
+from Queue import Empty, Queue
+from SocketServer import ThreadingMixIn
+from urllib import urlencode
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+import heapq
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+RECORD_PATH = '/powermon/record/'
+
+
+class Meter(object):
+  """Simulated meter whose watts follow a slow random drift around a base load with occasional spikes.
+  Watt hours integrate the watts between posts like the counter of a real meter."""
+
+  def __init__(self, station_id, seed):
+    self.station_id = station_id
+    self.rng = random.Random('%s-%s' % (station_id, seed))
+    self.base = self.rng.randint(40, 400)
+    self.drift = 0.0
+    self.watt_hours = float(self.rng.randint(0, 100000))
+    self.power_cycle = 1
+    self.last = None
+
+
+  def post(self, now):
+    """Returns the parameters of the next post made at the given time in seconds."""
+    self.drift = max(-self.base / 2.0, min(self.base, self.drift + self.rng.gauss(0, 2)))
+    watts = int(self.base + self.drift)
+    if self.rng.random() < 0.001:
+      watts += self.rng.randint(500, 1500)
+    if self.last is not None:
+      self.watt_hours += watts * (now - self.last) / 3600.0
+    self.last = now
+    if self.rng.random() < 0.0001:
+      self.power_cycle += 1
+    volts = 1200 + self.rng.randint(-20, 20)
+    return {
+      'id': self.station_id,
+      'w': watts,
+      'v': volts,
+      'a': watts * 10000 / volts,
+      'wh': int(self.watt_hours),
+      'pf': 95,
+      'frq': 600,
+      'va': watts * 105 / 100,
+      'rnc': 0,
+      'pcy': self.power_cycle,
+    }
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+  daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+  def log_message(self, format, *args):
+    pass
+
+
+def configure(options):
+  """Points Django at the given settings module with a fresh SQLite database file and creates its tables."""
+  sys.path.insert(0, dirname(dirname(abspath(__file__))))
+  os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
+  from django.conf import settings
+  settings.DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': options.database}
+  if options.ingest_mode:
+    settings.INGEST_MODE = options.ingest_mode
+  if settings.INGEST_MODE == 'queue':
+    settings.INGEST_QUEUE_FILE = options.database + '-queue'
+  settings.EVENT_BROKER = None
+  settings.SEGMENT_ROOT = None
+  from django.core.management import call_command
+  call_command('syncdb', interactive=False, verbosity=0)
+
+
+def schedule(meters, interval, duration):
+  """Generates (due time in seconds from start, meter) for every post in the run in order of due time.
+  Meters start at random offsets within the first interval so posts are spread evenly."""
+  rng = random.Random(0)
+  heap = [(rng.uniform(0, interval), i) for i in range(len(meters))]
+  heapq.heapify(heap)
+  while heap[0][0] < duration:
+    (due, i) = heapq.heappop(heap)
+    yield (due, meters[i])
+    heapq.heappush(heap, (due + interval, i))
+
+
+def client_poster():
+  """Returns a function that posts parameters through the Django test client and returns the status."""
+  from django.test.client import Client
+  client = Client()
+  return lambda params: client.post(RECORD_PATH, params).status_code
+
+
+def http_poster(port):
+  """Returns a function that posts parameters over HTTP to a local server and returns the status.
+  Each thread keeps its own persistent connection."""
+  local = threading.local()
+  headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Connection': 'keep-alive'}
+  def post(params):
+    if not hasattr(local, 'conn'):
+      local.conn = HTTPConnection('127.0.0.1', port)
+    try:
+      local.conn.request('POST', RECORD_PATH, urlencode(params), headers)
+      response = local.conn.getresponse()
+      response.read()
+      return response.status
+    except Exception:
+      local.conn.close()
+      del local.conn
+      return 0
+  return post
+
+
+def start_server():
+  """Starts a threaded WSGI server for the Django application on a free local port and returns it."""
+  from django.core.handlers.wsgi import WSGIHandler
+  server = ThreadingWSGIServer(('127.0.0.1', 0), QuietHandler)
+  server.set_app(WSGIHandler())
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def run(meters, options, post):
+  """Posts readings of the meters on schedule with the given number of concurrent clients.
+  Posts are open-loop: each is due at a fixed time regardless of how long earlier posts took, so a
+  saturated server shows up as growing lag. Returns (elapsed seconds, latencies in seconds, statuses, lag)."""
+  posts = Queue(maxsize=options.concurrency * 4)
+  latencies = []
+  statuses = {}
+  lock = threading.Lock()
+  def worker():
+    while True:
+      item = posts.get()
+      if item is None:
+        return
+      started = time.time()
+      status = post(item)
+      latency = time.time() - started
+      with lock:
+        latencies.append(latency)
+        statuses[status] = statuses.get(status, 0) + 1
+  workers = [threading.Thread(target=worker) for i in range(options.concurrency)]
+  for w in workers:
+    w.start()
+  start = time.time()
+  lag = 0.0
+  for (due, meter) in schedule(meters, options.interval, options.duration):
+    wait = start + due - time.time()
+    if wait > 0:
+      time.sleep(wait)
+    else:
+      lag = max(lag, -wait)
+    posts.put(meter.post(due))
+  for w in workers:
+    posts.put(None)
+  for w in workers:
+    w.join()
+  return (time.time() - start, latencies, statuses, lag)
+
+
+def percentile(values, p):
+  """Returns the nearest-rank percentile of sorted values."""
+  if not values:
+    return 0.0
+  return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def main():
+  parser = OptionParser(usage='%prog [options]')
+  parser.add_option('--meters', type='int', default=10, help='Number of simulated meters; defaults to 10')
+  parser.add_option('--interval', type='float', default=1.0,
+    help='Seconds between posts of each meter; defaults to 1')
+  parser.add_option('--duration', type='float', default=30.0, help='Seconds to post for; defaults to 30')
+  parser.add_option('--server', action='store_true', default=False,
+    help='Post over HTTP to a local threaded WSGI server instead of through the Django test client')
+  parser.add_option('--concurrency', type='int', default=None,
+    help='Concurrent clients; defaults to 8 with --server and 1 otherwise')
+  parser.add_option('--ingest-mode', dest='ingest_mode', choices=('direct', 'buffer', 'queue'), default=None,
+    help='Overrides INGEST_MODE of the settings')
+  parser.add_option('--settings', default='powermon.settings', help='Django settings module')
+  parser.add_option('--seed', type='int', default=0, help='Seed of the simulated readings')
+  (options, args) = parser.parse_args()
+  if options.concurrency is None:
+    options.concurrency = options.server and 8 or 1
+  if not options.server and options.concurrency != 1:
+    parser.error('The Django test client supports a concurrency of 1 only')
+  (fd, options.database) = tempfile.mkstemp(prefix='powermon-load-', suffix='.sqlite3')
+  os.close(fd)
+  try:
+    configure(options)
+    from django.conf import settings
+    from monitor.ingest import flush_buffer, get_queue, ingest_mode
+    from monitor.models import Reading, Station, StationState
+    meters = []
+    for i in range(options.meters):
+      station = Station.objects.create(id='load%04d' % i, name='Load Test Meter %d' % i)
+      meters.append(Meter(station.id, options.seed))
+    server = None
+    if options.server:
+      server = start_server()
+      post = http_poster(server.server_address[1])
+    else:
+      post = client_poster()
+    print 'Simulating %d meters posting every %gs for %gs in %s mode via %s' % (
+      options.meters, options.interval, options.duration, ingest_mode(),
+      options.server and 'WSGI server' or 'test client')
+    (elapsed, latencies, statuses, lag) = run(meters, options, post)
+    if server:
+      server.shutdown()
+    started = time.time()
+    if ingest_mode() == 'buffer':
+      flush_buffer()
+    elif ingest_mode() == 'queue':
+      while get_queue().drain(1000):
+        pass
+    store_elapsed = elapsed + time.time() - started
+    rows = Reading.objects.count()
+    states = StationState.objects.count()
+    latencies.sort()
+    print
+    print 'Requests:     %d (%s)' % (len(latencies),
+      ', '.join(['%s: %d' % (status, count) for (status, count) in sorted(statuses.items())]))
+    print 'Throughput:   %.1f requests/s (offered %.1f/s)' % (
+      len(latencies) / elapsed, options.meters / options.interval)
+    print 'Latency:      p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+      percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, percentile(latencies, 100) * 1000)
+    print 'Schedule lag: %.1f ms' % (lag * 1000)
+    print 'Stored:       %d readings, %d state changes, %.1f readings/s' % (rows, states, rows / store_elapsed)
+  finally:
+    for path in (options.database, options.database + '-queue'):
+      for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+          os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+  main()